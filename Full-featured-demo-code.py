@@ -5,31 +5,59 @@
 Advanced users can select the functions they need through the function options provided in the code below to customize and develop them to meet their needs.
 '''
 
+import os
+import sys
 import time
 import smbus2
 import logging
 from ina219 import INA219,DeviceRangeError
 
+# Share the register map decoder & control socket client with the daemon
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'daemon'))
+import UpsPlusRegisters
+import UpsPlusControl
+
 DEVICE_BUS = 1
 DEVICE_ADDR = 0x17
 PROTECT_VOLT = 3700
 SAMPLE_TIME = 2
 
-ina_supply = INA219(0.00725, busnum=DEVICE_BUS, address=0x40)
-ina_supply.configure()
-supply_voltage = ina_supply.voltage()
-supply_current = ina_supply.current()
-supply_power = ina_supply.power()
+# Use the status sampled by the UPS daemon when it runs, rather than reading the bus alongside it.
+client = UpsPlusControl.connect()
+if client:
+    try:
+        (status, _) = client.getStatus()
+    except (UpsPlusControl.ControlError, OSError) as e:
+        # No status sampled yet, or the daemon doesn't answer: read the bus instead
+        print("UPS daemon status unavailable, read the UPS directly: %s" % e)
+        client.close()
+        client = None
+
+if client:
+    supply_voltage = status.inaOutputVoltage
+    supply_current = status.inaOutputCurrent * 1000
+    supply_power = status.inaOutputPower * 1000
+else:
+    ina_supply = INA219(0.00725, busnum=DEVICE_BUS, address=0x40)
+    ina_supply.configure()
+    supply_voltage = ina_supply.voltage()
+    supply_current = ina_supply.current()
+    supply_power = ina_supply.power()
 print("Raspberry Pi power supply voltage: %.3f V" % supply_voltage)
 print("Current current consumption of Raspberry Pi: %.3f mA" % supply_current)
 print("Current power consumption of Raspberry Pi: %.3f mW" % supply_power)
 
 
-ina_batt = INA219(0.005, busnum=DEVICE_BUS, address=0x45)
-ina_batt.configure()
-batt_voltage = ina_batt.voltage()
-batt_current = ina_batt.current()
-batt_power = ina_batt.power()
+if client:
+    batt_voltage = status.inaBatteryVoltage
+    batt_current = status.inaBatteryCurrent * 1000
+    batt_power = status.inaBatteryPower * 1000
+else:
+    ina_batt = INA219(0.005, busnum=DEVICE_BUS, address=0x45)
+    ina_batt.configure()
+    batt_voltage = ina_batt.voltage()
+    batt_current = ina_batt.current()
+    batt_power = ina_batt.power()
 print("Batteries Voltage: %.3f V" % batt_voltage)
 try:
     if batt_current > 0:
@@ -41,73 +69,87 @@ try:
 except DeviceRangeError:
     print('Battery power is too high.')
 
-bus = smbus2.SMBus(DEVICE_BUS)
+if not client:
+    bus = smbus2.SMBus(DEVICE_BUS)
+
+    aReceiveBuf = []
+    aReceiveBuf.append(0x00)   # Placeholder
 
-aReceiveBuf = []
-aReceiveBuf.append(0x00)   # Placeholder
+    for i in range(1,255):
+        aReceiveBuf.append(bus.read_byte_data(DEVICE_ADDR, i))
 
-for i in range(1,255):
-    aReceiveBuf.append(bus.read_byte_data(DEVICE_ADDR, i))
+    status = UpsPlusRegisters.decode(bytearray(aReceiveBuf), validate=False)
 
-print("Current processor voltage: %d mV"% (aReceiveBuf[2] << 8 | aReceiveBuf[1]))
-print("Current Raspberry Pi report voltage: %d mV"% (aReceiveBuf[4] << 8 | aReceiveBuf[3]))
-print("Current battery port report voltage: %d mV"% (aReceiveBuf[6] << 8 | aReceiveBuf[5])) # This value is inaccurate during charging
-print("Current charging interface report voltage (Type C): %d mV"% (aReceiveBuf[8] << 8 | aReceiveBuf[7]))
-print("Current charging interface report voltage (Micro USB): %d mV"% (aReceiveBuf[10] << 8 | aReceiveBuf[9]))
+print("Current processor voltage: %d mV"% status.raw('mcuVoltage'))
+print("Current Raspberry Pi report voltage: %d mV"% status.raw('pogoPinVoltage'))
+print("Current battery port report voltage: %d mV"% status.raw('batteryVoltage')) # This value is inaccurate during charging
+print("Current charging interface report voltage (Type C): %d mV"% status.raw('typecVoltage'))
+print("Current charging interface report voltage (Micro USB): %d mV"% status.raw('microUsbVoltage'))
 
-if (aReceiveBuf[8] << 8 | aReceiveBuf[7]) > 4000:
+if status.raw('typecVoltage') > 4000:
     print('Currently charging through Type C.')
-elif (aReceiveBuf[10] << 8 | aReceiveBuf[9]) > 4000:
+elif status.raw('microUsbVoltage') > 4000:
     print('Currently charging via Micro USB.')
 else:
     print('Currently not charging.')   # Consider shutting down to save data or send notifications 
 
-print("Current battery temperature (estimated): %d degC"% (aReceiveBuf[12] << 8 | aReceiveBuf[11])) # Learned from the battery internal resistance change, the longer the use, the more stable the data.
-print("Full battery voltage: %d mV"% (aReceiveBuf[14] << 8 | aReceiveBuf[13]))
-print("Battery empty voltage: %d mV"% (aReceiveBuf[16] << 8 | aReceiveBuf[15]))
-print("Battery protection voltage: %d mV"% (aReceiveBuf[18] << 8 | aReceiveBuf[17]))
-print("Battery remaining capacity: %d %%"% (aReceiveBuf[20] << 8 | aReceiveBuf[19]))  # At least one complete charge and discharge cycle is passed before this value is meaningful.
-print("Sampling period: %d Min"% (aReceiveBuf[22] << 8 | aReceiveBuf[21]))
-if aReceiveBuf[23] == 1:
+print("Current battery temperature (estimated): %d degC"% status.raw('batteryTemperature')) # Learned from the battery internal resistance change, the longer the use, the more stable the data.
+print("Full battery voltage: %d mV"% status.raw('batteryFullVoltage'))
+print("Battery empty voltage: %d mV"% status.raw('batteryEmptyVoltage'))
+print("Battery protection voltage: %d mV"% status.raw('batteryProtectionVoltage'))
+print("Battery remaining capacity: %d %%"% status.raw('batteryRemaining'))  # At least one complete charge and discharge cycle is passed before this value is meaningful.
+print("Sampling period: %d Min"% status.raw('samplePeriod'))
+if status.raw('powerStatus') == 1:
     print("Current power state: normal")
 else:
     print("Current power status: off")
 
-if aReceiveBuf[24] == 0:
+if status.raw('shutdownCountdown') == 0:
     print('No shutdown countdown!')
 else:
-    print("Shutdown countdown: %d sec"% (aReceiveBuf[24]))
+    print("Shutdown countdown: %d sec"% status.raw('shutdownCountdown'))
 
-if aReceiveBuf[25] == 1:
+if status.raw('autoPowerOn') == 1:
     print("Automatically turn on when there is external power supply!")
 else:
     print("Does not automatically turn on when there is an external power supply!")
-if aReceiveBuf[26] == 0:
+if status.raw('restartCountdown') == 0:
     print('No restart countdown!')
 else:
-    print("Restart countdown: %d sec"% (aReceiveBuf[26]))
+    print("Restart countdown: %d sec"% status.raw('restartCountdown'))
 
-print("Accumulated running time: %d sec"% (aReceiveBuf[31] << 24 | aReceiveBuf[30] << 16 | aReceiveBuf[29] << 8 | aReceiveBuf[28]))
-print("Accumulated charged time: %d sec"% (aReceiveBuf[35] << 24 | aReceiveBuf[34] << 16 | aReceiveBuf[33] << 8 | aReceiveBuf[32]))
-print("This running time: %d sec"% (aReceiveBuf[39] << 24 | aReceiveBuf[38] << 16 | aReceiveBuf[37] << 8 | aReceiveBuf[36]))
-print("Version number: %d "% (aReceiveBuf[41] << 8 | aReceiveBuf[40]))
+print("Accumulated running time: %d sec"% status.raw('accumulatedRunningTime'))
+print("Accumulated charged time: %d sec"% status.raw('accumulatedChargingTime'))
+print("This running time: %d sec"% status.raw('currentRunningTime'))
+print("Version number: %d "% status.raw('version'))
 
 #The following code demonstrates resetting the protection voltage
 # bus.write_byte_data(DEVICE_ADDR, 17,PROTECT_VOLT & 0xFF)
 # bus.write_byte_data(DEVICE_ADDR, 18,(PROTECT_VOLT >> 8)& 0xFF)
+# With the UPS daemon running: client.set('batteryProtectionVoltage', PROTECT_VOLT / 1000)
+# (kept by the daemon until its config is reloaded, not written to /etc/upsplus.conf: set it there to keep it)
 # print("Successfully set the protection voltage as: %d mV"% PROTECT_VOLT)
 
 #The following code demonstrates resetting the sampling period
 # bus.write_byte_data(DEVICE_ADDR, 21,SAMPLE_TIME & 0xFF)
 # bus.write_byte_data(DEVICE_ADDR, 22,(SAMPLE_TIME >> 8)& 0xFF)
+# With the UPS daemon running: client.set('samplePeriod', SAMPLE_TIME) (kept until the daemon config is reloaded)
 # print("Successfully set the sampling period as: %d Min"% SAMPLE_TIME)
 
 # Set to shut down after 240 seconds (can be reset repeatedly)
 # bus.write_byte_data(DEVICE_ADDR, 24,240)
-bus.write_byte_data(DEVICE_ADDR, 24,240)
+# With the UPS daemon running: client.countdown('shutdownCountdown', 240)
+if client:
+    try:
+        client.countdown('shutdownCountdown', 240)
+    except (UpsPlusControl.ControlError, OSError) as e:
+        print("UPS daemon refused the shutdown countdown: %s" % e)
+else:
+    bus.write_byte_data(DEVICE_ADDR, 24,240)
 
 # Cancel automatic shutdown
 # bus.write_byte_data(DEVICE_ADDR, 24,0)
+# With the UPS daemon running: client.countdown('shutdownCountdown', 0)
 
 # Automatically turn on when there is an external power supply (If the automatic shutdown is set, when there is an external power supply, it will shut down and restart the board.)
 # 1) If you want to completely shut down, please don't turn on the automatic startup when there is an external power supply.
@@ -116,11 +158,24 @@ bus.write_byte_data(DEVICE_ADDR, 24,240)
 # 4) Set to 0 to cancel automatic startup.
 # 5) If this automatic startup is not set, and the battery is exhausted and shut down, the system will resume work when the power is restored as much as possible, but it is not necessarily when the external power supply is plugged in.
 # bus.write_byte_data(DEVICE_ADDR, 25,1)
-bus.write_byte_data(DEVICE_ADDR, 25,1)
+# With the UPS daemon running, kept until the daemon config is reloaded, set autoPowerOn in /etc/upsplus.conf to keep it
+if client:
+    try:
+        print(client.set('autoPowerOn', 1)['message'])
+    except (UpsPlusControl.ControlError, OSError) as e:
+        print("UPS daemon refused to enable auto power on: %s" % e)
+else:
+    bus.write_byte_data(DEVICE_ADDR, 25,1)
 
 # Force restart (simulate power plug, write the corresponding number of seconds, shut down 5 seconds before the end of the countdown, and then turn on at 0 seconds.)
 # bus.write_byte_data(DEVICE_ADDR, 26,30)
-bus.write_byte_data(DEVICE_ADDR, 26, 10)
+if client:
+    try:
+        client.countdown('restartCountdown', 10)
+    except (UpsPlusControl.ControlError, OSError) as e:
+        print("UPS daemon refused the restart countdown: %s" % e)
+else:
+    bus.write_byte_data(DEVICE_ADDR, 26, 10)
 
 # Restore factory settings (clear memory, clear learning parameters, can not clear the cumulative running time, used for after-sales purposes.)
 # bus.write_byte_data(DEVICE_ADDR, 27,1)
@@ -129,7 +184,4 @@ bus.write_byte_data(DEVICE_ADDR, 26, 10)
 # bus.write_byte_data(DEVICE_ADDR, 50,127)
 
 # Serial Number 
-UID0 = "%08X" % (aReceiveBuf[243] << 24 | aReceiveBuf[242] << 16 | aReceiveBuf[241] << 8 | aReceiveBuf[240])
-UID1 = "%08X" % (aReceiveBuf[247] << 24 | aReceiveBuf[246] << 16 | aReceiveBuf[245] << 8 | aReceiveBuf[244]) 
-UID2 = "%08X" % (aReceiveBuf[251] << 24 | aReceiveBuf[250] << 16 | aReceiveBuf[249] << 8 | aReceiveBuf[248])
-print("Serial Number is:" + UID0 + "-" + UID1 + "-" + UID2 )
+print("Serial Number is:" + status.serialNumber)
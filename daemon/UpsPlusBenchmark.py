@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import platform
+import threading
+from types import MappingProxyType
+import UpsPlusConfig
+import UpsPlusDaemon
+import UpsPlusDetector
+import UpsPlusDevice
+
+log = logging.getLogger('UPS')
+
+# Per transaction overhead (syscall, start, address & stop) and time per byte of a 100kHz I2C bus
+DEFAULT_LATENCY = 0.0002
+DEFAULT_BYTE_TIME = 0.00009
+
+# Power loss detector interval of the power loss benchmark, the detector is disabled by default
+POWER_LOSS_DETECT_INTERVAL = 0.2
+
+# Status reads to benchmark: (name, fields, maxAge)
+READ_CASES = (
+    ('fullStatus', None, 0),
+    ('powerInput', UpsPlusDevice.POWER_INPUT_FIELDS, 0),
+    ('detect', UpsPlusDetector.DETECT_FIELDS, 0),
+    ('cachedStatus', None, None),
+)
+
+def percentile(values, fraction):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+def latencyStats(seconds):
+    return {
+        'p50Ms': round(percentile(seconds, 0.5) * 1000, 3),
+        'p99Ms': round(percentile(seconds, 0.99) * 1000, 3),
+        'maxMs': round(max(seconds) * 1000, 3),
+        'meanMs': round(sum(seconds) / len(seconds) * 1000, 3),
+    }
+
+def emulatorSpec(args):
+    return 'latency=%s,byteTime=%s,seed=1' % (args.latency, args.byteTime)
+
+def benchmarkReads(args):
+    """Latency, transactions & bytes of getStatus() on each READ_CASES field set."""
+    os.environ['UPSPLUS_EMULATOR'] = emulatorSpec(args)
+    ups = UpsPlusDevice.get({ 'busBackend': 'emulator' })
+    ups.configureIna()
+    bus = ups.bus
+    results = {}
+    for (name, fields, maxAge) in READ_CASES:
+        # Warm up read plans & static fields
+        ups.getStatus(fields, maxAge=maxAge)
+        seconds = []
+        transactionCount = bus.transactionCount
+        byteCount = bus.byteCount
+        for _ in range(args.reads):
+            startTime = time.perf_counter()
+            ups.getStatus(fields, maxAge=maxAge)
+            seconds.append(time.perf_counter() - startTime)
+        result = latencyStats(seconds)
+        result['transactionsPerRead'] = round((bus.transactionCount - transactionCount) / args.reads, 3)
+        result['bytesPerRead'] = round((bus.byteCount - byteCount) / args.reads, 1)
+        results[name] = result
+    return results
+
+
+class BenchmarkDaemon(UpsPlusDaemon.UpsPlusDaemon):
+    """The daemon on an emulated UPS, with config given in memory, no files written and shutdown only recorded."""
+
+    def __init__(self, overrides):
+        super().__init__(logFilePath=None)
+        config = dict(UpsPlusConfig.defaults())
+        config.update({ 'busBackend': 'emulator', 'statePath': '', 'batteryStatePath': '', 'shutdownReportPath': '', 'journalPath': '',
+                        'controlSocketPath': '' })
+        config.update(overrides)
+        self.overrides = MappingProxyType(config)
+        self.shutdownTime = None
+        self.started = threading.Event()
+
+    def loadConfig(self):
+        self.config = self.overrides
+
+    def markStartup(self, name):
+        value = super().markStartup(name)
+        if name == 'ready':
+            self.started.set()
+        return value
+
+    async def shutdown(self):
+        self.shutdownTime = time.monotonic()
+        self.context['shutdown'] = True
+
+    def runEmulated(self):
+        """Run like run(), without log files or a config file. Return when stopped."""
+        self.loadConfig()
+        asyncio.run(self.asyncMain())
+
+def runDaemon(daemon, driver):
+    """Run daemon in this thread and driver(daemon) in another once the daemon is ready, then stop the daemon.
+    Return the driver result."""
+    result = {}
+    def drive():
+        if not daemon.started.wait(30):
+            daemon.stop()
+            return
+        try:
+            result['value'] = driver(daemon)
+        finally:
+            daemon.stop()
+    thread = threading.Thread(target=drive, name='UpsBenchmark')
+    thread.start()
+    daemon.runEmulated()
+    thread.join()
+    return result.get('value')
+
+def benchmarkLoop(args):
+    """Bus cost & CPU time of the daemon running steady on power input."""
+    os.environ['UPSPLUS_EMULATOR'] = emulatorSpec(args)
+    daemon = BenchmarkDaemon({})
+
+    def drive(daemon):
+        bus = daemon.ups.bus
+        telemetry = daemon.context['telemetry']
+        # Let startup work settle
+        time.sleep(1)
+        samples = len(telemetry.samples)
+        transactionCount = bus.transactionCount
+        byteCount = bus.byteCount
+        cpuTime = time.process_time()
+        wakeups = daemon.scheduler.wakeupCount
+        time.sleep(args.duration)
+        cpuTime = time.process_time() - cpuTime
+        samples = len(telemetry.samples) - samples
+        transactions = bus.transactionCount - transactionCount
+        bytes = bus.byteCount - byteCount
+        return {
+            'durationSeconds': args.duration,
+            'sampleInterval': daemon.context['sampleInterval'],
+            'samples': samples,
+            # Bus traffic below includes the power loss detector and the coulomb counter
+            'detectorEnabled': 'detector' in daemon.context,
+            'coulombInterval': daemon.config['coulombInterval'],
+            'transactionsPerSecond': round(transactions / args.duration, 2),
+            'bytesPerSecond': round(bytes / args.duration, 1),
+            'transactionsPerSample': round(transactions / samples, 2) if samples else None,
+            'bytesPerSample': round(bytes / samples, 1) if samples else None,
+            'schedulerWakeupsPerHour': round((daemon.scheduler.wakeupCount - wakeups) / args.duration * 3600),
+            'cpuSecondsPerHour': round(cpuTime / args.duration * 3600, 2),
+        }
+    return runDaemon(daemon, drive)
+
+def benchmarkPowerLoss(args):
+    """Time from power loss on the emulated UPS to the daemon starting shutdown, with an immediate shutdown policy and
+    the power loss detector enabled."""
+    latencies = []
+    for trial in range(args.trials):
+        os.environ['UPSPLUS_EMULATOR'] = emulatorSpec(args)
+        daemon = BenchmarkDaemon({ 'powerFailureToShutdownTime': 0, 'powerDetectInterval': POWER_LOSS_DETECT_INTERVAL })
+
+        def drive(daemon):
+            # Cut power at a different point of the sampling cycles on each trial
+            time.sleep(1 + trial * 0.037)
+            lossTime = time.monotonic()
+            daemon.ups.bus.model.typecVoltage = 0.0
+            deadline = lossTime + 60
+            while (daemon.shutdownTime is None) and (time.monotonic() < deadline):
+                time.sleep(0.005)
+            return None if daemon.shutdownTime is None else daemon.shutdownTime - lossTime
+        latency = runDaemon(daemon, drive)
+        if latency is None:
+            log.error("Power loss trial %d: no shutdown within 60 seconds", trial)
+        else:
+            latencies.append(latency)
+    result = { 'trials': args.trials, 'powerDetectInterval': POWER_LOSS_DETECT_INTERVAL, 'shutdowns': len(latencies) }
+    if latencies:
+        result.update(latencyStats(latencies))
+    return result
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Benchmark UPS status reads and the daemon against an emulated UPS Plus.")
+    parser.add_argument('-o', '--output', default='upsplus-benchmark.json', help="JSON result file (default: %(default)s)")
+    parser.add_argument('--latency', type=float, default=DEFAULT_LATENCY, help="Per transaction latency in seconds (default: %(default)s)")
+    parser.add_argument('--byte-time', dest='byteTime', type=float, default=DEFAULT_BYTE_TIME, help="Time per byte in seconds (default: %(default)s)")
+    parser.add_argument('--reads', type=int, default=500, help="Status reads per case (default: %(default)s)")
+    parser.add_argument('--duration', type=float, default=20, help="Seconds to run the daemon loop (default: %(default)s)")
+    parser.add_argument('--trials', type=int, default=5, help="Power loss trials (default: %(default)s)")
+    parser.add_argument('--only', choices=('reads', 'loop', 'powerLoss'), help="Run a single benchmark")
+    args = parser.parse_args(argv[1:])
+
+    # Daemon messages would be noise here
+    logging.basicConfig(level=logging.ERROR, format='%(message)s')
+
+    benchmarks = (('reads', benchmarkReads), ('loop', benchmarkLoop), ('powerLoss', benchmarkPowerLoss))
+    report = {
+        'time': time.time(),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'settings': { 'latency': args.latency, 'byteTime': args.byteTime, 'reads': args.reads, 'duration': args.duration, 'trials': args.trials },
+        'results': {},
+    }
+    for (name, benchmark) in benchmarks:
+        if args.only and (args.only != name):
+            continue
+        print("Running %s benchmark..." % name, flush=True)
+        report['results'][name] = benchmark(args)
+        print(json.dumps(report['results'][name], indent=2), flush=True)
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2)
+        f.write('\n')
+    print("Results written to %s" % args.output)
+    return 0
+
+if __name__=="__main__":
+    sys.exit(main(sys.argv))
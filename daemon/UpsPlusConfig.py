@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+
+import os
+import struct
+import ctypes
+import ctypes.util
+import logging
+import configparser
+from types import MappingProxyType
+import UpsPlusLogging
+import UpsPlusShutdown
+
+log = logging.getLogger('UPS')
+
+CONFIG_FILE = 'upsplus.conf'
+CONFIG_PATH_LIST = [
+    os.path.abspath(os.path.join(os.path.dirname(__file__), CONFIG_FILE)),
+    os.path.abspath(os.path.join('/etc', CONFIG_FILE)),
+]
+CONFIG_SECTION = 'ups'
+
+class ConfigError(Exception):
+    pass
+
+class Option:
+    """A config option, parsed to the type of its default value and checked against its valid range or choices.
+
+    An option with convert is parsed by convert(text) instead, which raises ValueError if invalid.
+    """
+
+    __slots__ = ('key', 'default', 'minimum', 'maximum', 'choices', 'convert')
+
+    def __init__(self, key, default, minimum=None, maximum=None, choices=None, convert=None):
+        self.key = key
+        self.default = default
+        self.minimum = minimum
+        self.maximum = maximum
+        self.choices = choices
+        self.convert = convert
+
+    def parse(self, section):
+        try:
+            if self.convert is not None:
+                text = section.get(self.key)
+                value = self.default if text is None else self.convert(text)
+            elif type(self.default) is bool:
+                value = section.getboolean(self.key, self.default)
+            elif type(self.default) is int:
+                value = section.getint(self.key, self.default)
+            elif type(self.default) is float:
+                value = section.getfloat(self.key, self.default)
+            else:
+                value = section.get(self.key, self.default)
+        except ValueError as e:
+            raise ConfigError("Invalid %s: %s" % (self.key, e))
+        self.check(value)
+        return value
+
+    def check(self, value):
+        if (self.choices is not None) and (value not in self.choices):
+            raise ConfigError("Invalid %s: %s, must be one of: %s" % (self.key, value, ', '.join(str(c) for c in self.choices)))
+        if ((self.minimum is not None) and (value < self.minimum)) or ((self.maximum is not None) and (value > self.maximum)):
+            raise ConfigError("Invalid %s: %s out of range [%s, %s]" % (self.key, value, self.minimum, self.maximum))
+
+
+OPTIONS = (
+    Option('powerFailureToShutdownTime', 600, minimum=-1),
+    Option('runtimeShutdownFactor', 0.0, minimum=0),
+    Option('shutdownVoltage', 3.80, minimum=0, maximum=4.5),
+    Option('shutdownCmd', 'sudo shutdown -h now'),
+    Option('shutdownCountdown', 30, minimum=1, maximum=255),
+    Option('shutdownHooks', (), convert=UpsPlusShutdown.parseHooks),
+    Option('shutdownHookTimeout', 20.0, minimum=0.1),
+    Option('shutdownHookWorkers', 4, minimum=1),
+    Option('shutdownReserveTime', 10.0, minimum=0),
+    Option('shutdownReportPath', '/var/lib/upsplus/shutdown.json'),
+    Option('loopInterval', 5, minimum=1),
+    Option('pollIntervalMin', 1.0, minimum=0.1),
+    Option('pollIntervalMax', 60, minimum=1),
+    Option('logStatusInterval', 60, minimum=-1),
+    Option('logStatsInterval', 3600, minimum=-1),
+    Option('metricsPort', 0, minimum=0, maximum=65535),
+    Option('metricsAddress', ''),
+    Option('controlSocketPath', '/run/upsplus/upsplus.sock'),
+    Option('autoPowerOn', 1, choices=(0, 1)),
+    Option('batteryProtectionVoltage', 3.50, minimum=0, maximum=4.5),
+    Option('samplePeriod', 2, minimum=1, maximum=1440),
+    Option('busBackend', 'smbus', choices=('smbus', 'emulator')),
+    Option('snapshotMaxAge', 0.5, minimum=0),
+    Option('retryMaxAttempts', 4, minimum=1),
+    Option('retryBudget', 3.0, minimum=0),
+    Option('inaVoltageRange', 32, choices=(16, 32)),
+    Option('inaGain', 'auto', choices=('auto', '40', '80', '160', '320')),
+    Option('inaAdcSamples', 1, choices=(1, 2, 4, 8, 16, 32, 64, 128)),
+    Option('inaTriggered', False),
+    Option('powerDetectInterval', 0.0, minimum=0),
+    Option('powerDetectDebounce', 3, minimum=1),
+    Option('reconcileInterval', 60, minimum=1),
+    Option('logMode', 'verbose', choices=('verbose', 'change')),
+    Option('logVoltageDeadband', UpsPlusLogging.DEADBANDS['Voltage'], minimum=0),
+    Option('logCurrentDeadband', UpsPlusLogging.DEADBANDS['Current'], minimum=0),
+    Option('logPowerDeadband', UpsPlusLogging.DEADBANDS['Power'], minimum=0),
+    Option('logTemperatureDeadband', UpsPlusLogging.DEADBANDS['Temperature'], minimum=0),
+    Option('logRemainingDeadband', UpsPlusLogging.DEADBANDS['Remaining'], minimum=0),
+    Option('statePath', '/var/lib/upsplus/state.json'),
+    Option('coulombInterval', 0.0, minimum=0),
+    Option('batteryDesignCapacity', 4000, minimum=1),
+    Option('batteryStatePath', '/var/lib/upsplus/battery.json'),
+    Option('journalPath', ''),
+    Option('journalInterval', 60, minimum=1),
+    Option('journalSyncInterval', 300, minimum=1),
+    Option('journalSegmentSize', 1024 * 1024, minimum=1024),
+    Option('journalSegments', 8, minimum=1),
+)
+
+# Options only applied on daemon start
+RESTART_OPTIONS = frozenset((
+    'busBackend', 'snapshotMaxAge', 'retryMaxAttempts', 'retryBudget', 'inaVoltageRange', 'inaGain', 'inaAdcSamples', 'inaTriggered',
+    'powerDetectInterval', 'powerDetectDebounce', 'logMode', 'logVoltageDeadband', 'logCurrentDeadband',
+    'logPowerDeadband', 'logTemperatureDeadband', 'logRemainingDeadband', 'statePath', 'coulombInterval',
+    'batteryDesignCapacity', 'batteryStatePath', 'journalPath', 'journalSegmentSize', 'journalSegments', 'metricsPort', 'metricsAddress',
+    'controlSocketPath',
+))
+
+def defaults():
+    return MappingProxyType({ option.key: option.default for option in OPTIONS })
+
+def findConfigPath(pathList=CONFIG_PATH_LIST):
+    for configPath in pathList:
+        if os.path.exists(configPath):
+            return configPath
+    return None
+
+def load(configPath):
+    """Parse and validate a config file into a new read-only config mapping. Raise ConfigError if invalid.
+
+    Options missing in the file take their default value. A missing file gives the default config.
+    """
+    parser = configparser.ConfigParser()
+    if configPath is not None:
+        try:
+            with open(configPath, 'r', encoding='utf-8') as f:
+                parser.read_file(f, configPath)
+        except (OSError, configparser.Error) as e:
+            raise ConfigError("Error read config %s: %s" % (configPath, e))
+    if not parser.has_section(CONFIG_SECTION):
+        return defaults()
+    section = parser[CONFIG_SECTION]
+    return MappingProxyType({ option.key: option.parse(section) for option in OPTIONS })
+
+def diff(oldConfig, newConfig):
+    """Return the keys of options with a different value."""
+    return [ option.key for option in OPTIONS if oldConfig[option.key] != newConfig[option.key] ]
+
+
+# inotify(7) constants
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct('iIII')
+
+class ConfigWatcher:
+    """Watch a config file for changes with inotify, calling callback() from the asyncio loop once writes settle.
+
+    The directory is watched rather than the file, so editors replacing the file by rename are seen too.
+    """
+
+    def __init__(self, configPath, callback, settleTime=0.5):
+        self.configPath = configPath
+        self.callback = callback
+        self.settleTime = settleTime
+        self.fd = None
+        self.loop = None
+        self.__pending = None
+
+    def start(self, loop):
+        """Start watching. Return False if inotify is not available."""
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+            fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if fd < 0:
+                raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+            directory = os.path.dirname(self.configPath)
+            if libc.inotify_add_watch(fd, os.fsencode(directory), IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE) < 0:
+                errno = ctypes.get_errno()
+                os.close(fd)
+                raise OSError(errno, os.strerror(errno))
+        except (OSError, AttributeError) as e:
+            log.warning("Error watch config %s, reload on SIGHUP only: %s", self.configPath, e)
+            return False
+        self.fd = fd
+        self.loop = loop
+        loop.add_reader(fd, self.__onReadable)
+        return True
+
+    def __onReadable(self):
+        try:
+            data = os.read(self.fd, 4096)
+        except BlockingIOError:
+            return
+        name = os.fsencode(os.path.basename(self.configPath))
+        offset = 0
+        changed = False
+        while offset + INOTIFY_EVENT.size <= len(data):
+            (_, _, _, nameLength) = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            if data[offset : offset + nameLength].rstrip(b'\0') == name:
+                changed = True
+            offset += nameLength
+        if changed:
+            # Editors may write a file in several steps, reload once they are done
+            if self.__pending is not None:
+                self.__pending.cancel()
+            self.__pending = self.loop.call_later(self.settleTime, self.callback)
+
+    def close(self):
+        if self.fd is not None:
+            self.loop.remove_reader(self.fd)
+            os.close(self.fd)
+            self.fd = None
+        if self.__pending is not None:
+            self.__pending.cancel()
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import stat
+import socket
+import asyncio
+import logging
+import UpsPlusRegisters
+
+log = logging.getLogger('UPS')
+
+SOCKET_PATH = '/run/upsplus/upsplus.sock'
+# Mode of the socket, its group is the group of the I2C device so users allowed on the bus may use it
+SOCKET_MODE = 0o660
+I2C_DEVICE = '/dev/i2c-%d'
+
+# Settings a client may change, kept by the daemon until the config is reloaded
+SETTINGS = ('batteryProtectionVoltage', 'samplePeriod', 'autoPowerOn')
+# Countdowns a client may start (or cancel with 0), left to run by the daemon
+COUNTDOWNS = ('shutdownCountdown', 'restartCountdown')
+
+# Max length of a request line
+REQUEST_LIMIT = 4096
+
+class ControlError(Exception):
+    pass
+
+
+class ControlServer:
+    """Serve the daemon status & control commands on a Unix domain socket, one JSON object per line each way.
+
+    Requests are {"cmd": <command>, ...} and responses {"ok": true, ...} or {"ok": false, "error": <message>}.
+    The "status" response is built by status() on the first request after invalidate(), and sent as is to later
+    requests, so clients polling the status never touch the bus. Other commands are dispatched to
+    commands[cmd](request), a coroutine returning the response fields; ControlError is reported to the client.
+    """
+
+    def __init__(self, status, commands, path=SOCKET_PATH, bus=1):
+        self.status = status
+        self.commands = commands
+        self.path = path
+        self.bus = bus
+        self.requestCount = 0
+        self.__statusLine = None
+        self.__server = None
+
+    def invalidate(self):
+        self.__statusLine = None
+
+    def statusLine(self):
+        if self.__statusLine is None:
+            self.__statusLine = encode(self.status())
+        return self.__statusLine
+
+    async def start(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        try:
+            if stat.S_ISSOCK(os.lstat(self.path).st_mode):
+                # Left by a daemon that didn't exit cleanly
+                os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        self.__server = await asyncio.start_unix_server(self.handle, self.path, limit=REQUEST_LIMIT)
+        os.chmod(self.path, SOCKET_MODE)
+        try:
+            os.chown(self.path, -1, os.stat(I2C_DEVICE % self.bus).st_gid)
+        except FileNotFoundError:
+            # No I2C device, e.g. on the emulator backend
+            pass
+
+    def close(self):
+        if self.__server is not None:
+            self.__server.close()
+            self.__server = None
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                self.requestCount += 1
+                writer.write(await self.respond(line))
+                await writer.drain()
+        except (asyncio.LimitOverrunError, ValueError):
+            writer.write(encode({ 'ok': False, 'error': "Request too long" }))
+        except ConnectionError:
+            pass
+        except Exception:
+            log.exception("Error serve control client")
+        finally:
+            writer.close()
+
+    async def respond(self, line):
+        try:
+            request = json.loads(line)
+            cmd = request['cmd']
+        except (ValueError, TypeError, KeyError):
+            return encode({ 'ok': False, 'error': "Invalid request" })
+        if cmd == 'status':
+            return self.statusLine()
+        command = self.commands.get(cmd)
+        if command is None:
+            return encode({ 'ok': False, 'error': "Unknown command: %s" % cmd })
+        try:
+            response = { 'ok': True }
+            response.update(await command(request))
+            return encode(response)
+        except ControlError as e:
+            return encode({ 'ok': False, 'error': str(e) })
+        except Exception as e:
+            log.exception("Error control command: %s", cmd)
+            return encode({ 'ok': False, 'error': "%s: %s" % (type(e).__name__, e) })
+
+
+class ControlClient:
+    """Client of the daemon control socket, see connect()."""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.file = sock.makefile('rwb')
+
+    def close(self):
+        self.file.close()
+        self.sock.close()
+
+    def request(self, cmd, **args):
+        """Send a command and return the response fields. Raise ControlError if the daemon refused it."""
+        args['cmd'] = cmd
+        self.file.write(encode(args))
+        self.file.flush()
+        line = self.file.readline()
+        if not line:
+            raise ControlError("Daemon closed the connection")
+        response = json.loads(line)
+        if not response.get('ok'):
+            raise ControlError(response.get('error'))
+        return response
+
+    def getStatus(self):
+        """Return the last UPS status sampled by the daemon as an UpsPlusRegisters.UpsStatus, and the daemon status
+        (power input type, outage & battery estimations)."""
+        response = self.request('status')
+        ina = response.get('ina')
+        status = UpsPlusRegisters.decode(bytes.fromhex(response['registers']), None if ina is None else tuple(ina), validate=False)
+        return (status, response['daemon'])
+
+    def set(self, name, value):
+        """Set a setting of SETTINGS, in the unit of the field (e.g. volts).
+
+        The daemon keeps the value as an override of its config until the config is reloaded, it is not written to the
+        config file. The response 'message' says so.
+        """
+        return self.request('set', name=name, value=value)
+
+    def countdown(self, name, seconds):
+        """Start a countdown of COUNTDOWNS in seconds, or cancel it with 0."""
+        return self.request('countdown', name=name, value=seconds)
+
+    def stats(self):
+        return self.request('stats')
+
+def connect(path=SOCKET_PATH, timeout=2.0):
+    """Connect to the daemon. Return a ControlClient, or None if the daemon isn't running or can't be used."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    return ControlClient(sock)
+
+def encode(value):
+    return json.dumps(value, separators=(',', ':')).encode('utf-8') + b'\n'
@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+
+import json
+import time
+import logging
+import threading
+import UpsPlusState
+import UpsPlusStats
+
+log = logging.getLogger('UPS')
+
+# Battery counts as full on charger within this voltage of the full voltage, at a charge current below fullCurrent
+FULL_VOLTAGE_MARGIN = 0.05
+# Weight of a new capacity measurement in the learned capacity
+CAPACITY_LEARN_RATE = 0.5
+# A discharge from full to empty must measure at least this fraction of the capacity to be learned from
+CAPACITY_LEARN_MIN = 0.5
+
+# Duration of each battery current read in seconds
+READ_TIME = UpsPlusStats.histogram('busRead.coulomb')
+
+class CoulombCounter:
+    """Count the charge in & out of the battery by integrating the battery INA219 current at a high rate.
+
+    Runs in its own thread, reading only bus voltage & current of the battery sensor per sample (one combined
+    transfer into a preallocated buffer, see UpsPlusIna219.Ina219.readFast()), and keeps only running sums.
+
+    Drift is corrected at two anchors: the battery is full on charger at fullVoltage with the charge current tapered
+    off, and empty when discharged down to emptyVoltage. A discharge from full to empty measures the capacity, which
+    is learned into `capacity`. Learned capacity, cycle count and totals are persisted to statePath.
+    """
+
+    def __init__(self, ups, interval=0.1, designCapacity=4000, statePath=None, fullCurrent=100.0, saveInterval=600):
+        self.ups = ups
+        self.interval = interval
+        # Design capacity in mAh
+        self.designCapacity = designCapacity
+        self.statePath = statePath
+        # Charge current in mA below which the battery counts as full at fullVoltage
+        self.fullCurrent = fullCurrent
+        self.saveInterval = saveInterval
+        # Battery full & empty voltages, see setVoltages()
+        self.fullVoltage = None
+        self.emptyVoltage = None
+
+        # Learned capacity in mAh
+        self.capacity = float(designCapacity)
+        # Equivalent full discharge cycles
+        self.cycles = 0.0
+        # Charge left in mAh, None until anchored or seeded
+        self.charge = None
+        # Total charge in & out in mAh
+        self.chargeIn = 0.0
+        self.chargeOut = 0.0
+
+        self.sampleCount = 0
+        self.errorCount = 0
+        # Samples taken late by more than an interval
+        self.overrunCount = 0
+
+        # Charge discharged since the last full anchor in mAh, None when not anchored full since
+        self.__dischargedSinceFull = None
+        self.__anchor = None
+        self.__lastTime = None
+        self.__lastSaveTime = None
+        self.__stopEvent = threading.Event()
+        self.__thread = None
+
+    @property
+    def stateOfCharge(self):
+        """Charge left in percent of the learned capacity, or None if unknown."""
+        return None if self.charge is None else 100 * self.charge / self.capacity
+
+    @property
+    def stateOfHealth(self):
+        """Learned capacity in percent of the design capacity."""
+        return 100 * self.capacity / self.designCapacity
+
+    def stats(self):
+        return {
+            'batteryCharge': None if self.charge is None else round(self.charge, 1),
+            'batteryCapacity': round(self.capacity, 1),
+            'batteryStateOfCharge': None if self.charge is None else round(self.stateOfCharge, 1),
+            'batteryStateOfHealth': round(self.stateOfHealth, 1),
+            'batteryCycles': round(self.cycles, 2),
+        }
+
+    def setVoltages(self, fullVoltage, emptyVoltage):
+        """Set the battery full & empty anchor voltages, e.g. from the batteryFullVoltage & batteryEmptyVoltage settings."""
+        self.fullVoltage = fullVoltage
+        self.emptyVoltage = emptyVoltage
+
+    def seed(self, remaining):
+        """Start from a remaining percent (e.g. batteryRemaining) if the charge is not known yet."""
+        if self.charge is None:
+            self.charge = self.capacity * min(max(remaining, 0), 100) / 100
+
+    def start(self):
+        self.load()
+        self.__thread = threading.Thread(target=self.run, name='UpsCoulomb', daemon=True)
+        self.__thread.start()
+
+    def stop(self):
+        self.__stopEvent.set()
+        if self.__thread is not None:
+            self.__thread.join(self.interval * 10)
+        self.save()
+
+    def run(self):
+        ina = self.ups.inaBattery
+        lock = self.ups.lock
+        interval = self.interval
+        stopEvent = self.__stopEvent
+        nextTime = time.monotonic()
+        while not stopEvent.is_set():
+            try:
+                startTime = time.perf_counter()
+                try:
+                    with lock:
+                        ina.readFast()
+                finally:
+                    READ_TIME.observe(time.perf_counter() - startTime)
+                self.integrate(time.monotonic(), ina.voltage, ina.current)
+            except Exception as e:
+                # The next sample integrates over the gap
+                self.errorCount += 1
+                log.debug("Error sample battery current: %s", e)
+
+            nextTime += interval
+            delay = nextTime - time.monotonic()
+            if delay < 0:
+                self.overrunCount += 1
+                nextTime = time.monotonic()
+                delay = 0
+            stopEvent.wait(delay)
+
+    def integrate(self, now, voltage, current):
+        """Add a sample of battery voltage in V and current in mA, positive when charging, taken at monotonic time now."""
+        lastTime = self.__lastTime
+        self.__lastTime = now
+        self.sampleCount += 1
+        if lastTime is not None:
+            delta = current * (now - lastTime) / 3600
+            if delta >= 0:
+                self.chargeIn += delta
+            else:
+                self.chargeOut -= delta
+                self.cycles -= delta / self.capacity
+                if self.__dischargedSinceFull is not None:
+                    self.__dischargedSinceFull -= delta
+            if self.charge is not None:
+                self.charge = min(max(self.charge + delta, 0.0), self.capacity)
+
+        if (self.fullVoltage is not None) and (voltage >= self.fullVoltage - FULL_VOLTAGE_MARGIN) and (0 <= current < self.fullCurrent):
+            self.__anchorFull()
+        elif (self.emptyVoltage is not None) and (voltage <= self.emptyVoltage) and (current < 0):
+            self.__anchorEmpty()
+        else:
+            self.__anchor = None
+
+        if (self.__lastSaveTime is None) or (now - self.__lastSaveTime >= self.saveInterval):
+            self.__lastSaveTime = now
+            self.save()
+
+    def __anchorFull(self):
+        if self.__anchor == 'full':
+            return
+        self.__anchor = 'full'
+        log.info("Battery full, correct charge from %s to %.1f mAh", 'unknown' if self.charge is None else '%.1f' % self.charge, self.capacity)
+        self.charge = self.capacity
+        self.__dischargedSinceFull = 0.0
+
+    def __anchorEmpty(self):
+        if self.__anchor == 'empty':
+            return
+        self.__anchor = 'empty'
+        log.info("Battery empty, correct charge from %s to 0 mAh", 'unknown' if self.charge is None else '%.1f' % self.charge)
+        self.charge = 0.0
+        measured = self.__dischargedSinceFull
+        self.__dischargedSinceFull = None
+        if (measured is not None) and (measured >= self.capacity * CAPACITY_LEARN_MIN):
+            capacity = self.capacity + CAPACITY_LEARN_RATE * (measured - self.capacity)
+            log.info("Battery discharged %.1f mAh from full to empty, learned capacity %.1f -> %.1f mAh, health %.1f%%",
+                     measured, self.capacity, capacity, 100 * capacity / self.designCapacity)
+            self.capacity = capacity
+        self.save()
+
+    def load(self):
+        """Load the learned state. The charge is only restored when saved during the current boot."""
+        if not self.statePath:
+            return
+        try:
+            with open(self.statePath, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            return
+        except Exception:
+            log.exception("Error read battery state: %s", self.statePath)
+            return
+        self.capacity = state.get('capacity', self.capacity)
+        self.cycles = state.get('cycles', self.cycles)
+        self.chargeIn = state.get('chargeIn', self.chargeIn)
+        self.chargeOut = state.get('chargeOut', self.chargeOut)
+        if state.get('bootId') == UpsPlusState.bootId():
+            self.charge = state.get('charge')
+        log.info("Battery capacity %.1f mAh, health %.1f%%, %.2f cycles", self.capacity, self.stateOfHealth, self.cycles)
+
+    def save(self):
+        if not self.statePath:
+            return
+        state = {
+            'bootId': UpsPlusState.bootId(),
+            'capacity': self.capacity,
+            'cycles': self.cycles,
+            'charge': self.charge,
+            'chargeIn': self.chargeIn,
+            'chargeOut': self.chargeOut,
+        }
+        try:
+            UpsPlusState.saveAtomic(self.statePath, json.dumps(state).encode('utf-8'))
+        except Exception:
+            log.exception("Error save battery state: %s", self.statePath)
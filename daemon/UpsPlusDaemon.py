@@ -1,108 +1,48 @@
 #!/usr/bin/env python3
 
+import time
+# Taken first thing on import, to measure startup time
+START_TIME = time.monotonic()
+
 import os
 import signal
-import time
-from threading import Event
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from datetime import timezone
 import logging
-from logging.handlers import TimedRotatingFileHandler
-import configparser
 import UpsPlusDevice
+import UpsPlusConfig
+import UpsPlusControl
+import UpsPlusCoulomb
+import UpsPlusIna219
+import UpsPlusDetector
+import UpsPlusExporter
+import UpsPlusEstimator
+import UpsPlusTelemetry
+import UpsPlusJournal
+import UpsPlusLogging
+import UpsPlusReconciler
+import UpsPlusRegisters
+import UpsPlusScheduler
+import UpsPlusShutdown
+import UpsPlusState
+import UpsPlusStats
+import UpsPlusSystemd
 
 
 LOG_FILE_PATH="/var/log/upsplus.log"
 
-# Create log file directory
-os.makedirs(os.path.dirname(LOG_FILE_PATH), exist_ok=True)
-
-logFileHandler = TimedRotatingFileHandler(LOG_FILE_PATH, when='D', interval=1, backupCount=7, encoding='utf-8', utc=True)
-logStreamHandler = logging.StreamHandler()
-logging.basicConfig(format='%(asctime)s [%(name)s][%(levelname)-4s] - %(message)s', level=logging.INFO, handlers=[logFileHandler,logStreamHandler])
-logging.Formatter.converter = time.gmtime
-
 log = logging.getLogger('UPS')
 
-
-# Read configuration from file
-CONFIG_FILE = 'upsplus.conf'
-CONFIG_PATH_LIST = [
-    os.path.abspath(os.path.join(os.path.dirname(__file__), CONFIG_FILE)),
-    os.path.abspath(os.path.join('/etc', CONFIG_FILE)),
-]
-
-config = configparser.ConfigParser()
-
-def readConfig(configPath):
-    if os.path.exists(configPath):
-        try:
-            config.read(configPath)
-            log.info("Read config: %s", configPath)
-            return True
-        except:
-            log.exception("Error read config: %s", configPath)
-    return False
-def loadConfig():
-    for configPath in CONFIG_PATH_LIST:
-        if (readConfig(configPath)):
-            return True
-    return False
-def getConfig(key, default=None):
-    if config.has_section('ups'):
-        if type(default) is int:
-            return config['ups'].getint(key, default)
-        elif type(default) is float:
-            return config['ups'].getfloat(key, default)
-        elif type(default) is bool:
-            return config['ups'].getboolean(key, default)
-        else:
-            return config['ups'].get(key, default)
-    return default
-loadConfig()
-
-UPS_CONFIG = {}
-def buildConfig(key, default):
-    UPS_CONFIG[key] = getConfig(key, default)
-
-buildConfig('powerFailureToShutdownTime', 600)
-buildConfig('shutdownVoltage', 3.80)
-buildConfig('shutdownCmd', 'sudo shutdown -h now')
-buildConfig('shutdownCountdown', 30)
-buildConfig('loopInterval', 5)
-buildConfig('logStatusInterval', 60)
-buildConfig('autoPowerOn', 1)
-buildConfig('batteryProtectionVoltage', 3.50)
-buildConfig('samplePeriod', 2)
-
-
-ups = UpsPlusDevice.get()
-
+# Duration of each task loop iteration in seconds
+SAMPLE_TIME = UpsPlusStats.histogram('loop.sample')
+DETECT_TIME = UpsPlusStats.histogram('loop.detect')
+POLICY_TIME = UpsPlusStats.histogram('loop.policy')
+RECONCILE_TIME = UpsPlusStats.histogram('loop.reconcile')
 
 
-def getUpsPowerInputType():
-    powerInput = ups.getPowerInput()
-
-    powerInputType = ''
-    if powerInput['typecVoltage'] > 4:
-        powerInputType = 'TypeC'
-    elif powerInput['microUsbVoltage'] > 4:
-        powerInputType = 'MicroUSB'
-
-    return powerInputType
-
-############################## Main Loop ##############################
-def upsLoop(context={}):
-    log.info("-" * 60)
-
-    currentTime = time.time()
-
-    prevStatus = context.get('prevStatus') or {}
-    prevPowerInType = prevStatus.get('powerInputType') or ''
-    prevPowerFailure = not prevPowerInType
-
-    upsStatus = ups.getStatus()
-
+def getUpsPowerInput(upsStatus):
     powerInputType = ''
     powerInputVoltage = ''
     if upsStatus['typecVoltage'] > 4:
@@ -111,93 +51,11 @@ def upsLoop(context={}):
     elif upsStatus['microUsbVoltage'] > 4:
         powerInputType = 'MicroUSB'
         powerInputVoltage = upsStatus['microUsbVoltage']
-    if powerInputType and (upsStatus['inaBatteryCurrent'] < 0):
+    if powerInputType and ('inaBatteryCurrent' in upsStatus) and (upsStatus['inaBatteryCurrent'] < 0):
         log.warning("Illegal ups status: powerInputType[%s] inaBatteryCurrent[%.3f], force powerInputType to empty", powerInputType, upsStatus['inaBatteryCurrent'])
         powerInputType = ''
-    powerFailure = not powerInputType
-
-    newStatus = {
-        'time': formatTimestamp(currentTime),
-        'powerInputType': powerInputType,
-        'powerInputVoltage': powerInputVoltage,
-        'batteryVoltage': upsStatus['batteryVoltage']
-    }
-
-    log.info(">"*20 + " UPS Loop " + ">"*20)
-
-    # Update UPS device configuration
-    if (upsStatus['batteryProtectionVoltage'] != UPS_CONFIG['batteryProtectionVoltage']):
-        ups.setBatteryProtectionVoltage(round(UPS_CONFIG['batteryProtectionVoltage'] * 1000))    
-    if (upsStatus['samplePeriod'] != UPS_CONFIG['samplePeriod']):
-        ups.setSamplePeriod(UPS_CONFIG['samplePeriod'])
-    if (upsStatus['autoPowerOn'] != UPS_CONFIG['autoPowerOn']):
-        ups.setAutoPowerOn(UPS_CONFIG['autoPowerOn'])
-    # Disable shutdown countdown
-    if (upsStatus['shutdownCountdown'] != 0):
-        ups.setShutdownCountdown(0)
-    # Disable restart countdown
-    if (upsStatus['restartCountdown'] != 0):
-        ups.setRestartCountdown(0)
-
-    shutdownNow = False
-
-    if not powerFailure:
-        log.info("Input power OK on %s", powerInputType)
-    else:
-        if not prevPowerFailure:
-            log.warning("Input power failure detected, running on battery!")
-            newStatus['powerFailureTimestamp'] = currentTime
-            newStatus['powerFailureTime'] = formatTimestamp(currentTime)
-        else:
-            log.warning("Input power failure continue, running on battery!")
-            if (prevStatus.get('powerFailureTimestamp') is None) or (prevStatus.get('powerFailureTimestamp') >= currentTime):
-                log.warning("Power failure time not valid, reset to current time")
-                newStatus['powerFailureTimestamp'] = currentTime
-                newStatus['powerFailureTime'] = formatTimestamp(currentTime)
-            else:
-                # Keep power failure time to calculate power off time
-                newStatus['powerFailureTimestamp'] = prevStatus.get('powerFailureTimestamp')
-                newStatus['powerFailureTime'] = prevStatus.get('powerFailureTime')
-
-        if UPS_CONFIG['powerFailureToShutdownTime'] >= 0:
-            shutdownTimeout = UPS_CONFIG['powerFailureToShutdownTime'] - round(currentTime - newStatus['powerFailureTimestamp'])
-            if shutdownTimeout > 0:
-                log.warning("About to shutdown in %d seconds", shutdownTimeout)
-            else:
-                log.warning("About to shutdown immediately due to power failure timeout")
-                shutdownNow = True
-
-        if not shutdownNow:
-            if newStatus['batteryVoltage'] > UPS_CONFIG['shutdownVoltage']:
-                log.warning("About to shutdown after batteryVoltage[%.3f] <= shutdownVoltage[%.3f]", newStatus['batteryVoltage'], UPS_CONFIG['shutdownVoltage'])
-            else:
-                log.warning("About to shutdown immediately due to batteryVoltage[%.3f] <= shutdownVoltage[%.3f]", newStatus['batteryVoltage'], UPS_CONFIG['shutdownVoltage'])
-                shutdownNow = True
-
-    log.info("<"*20 + " UPS Loop " + "<"*20)
-
-    newStatus['upsStatus'] = upsStatus
-    if UPS_CONFIG['logStatusInterval'] >= 0:
-        log.info("UPS status:")
-        logDict(newStatus)
-
-    if shutdownNow:
-        shutdown()
-
-    context['prevStatus'] = newStatus
-    return newStatus
-
-def shutdown():
-    log.warning("X"*20 + " Shutdown on Power Failure " + "X"*20)
-    log.warning("Shutdown the UPS after: %d seconds", UPS_CONFIG['shutdownCountdown'])
-    ups.setShutdownCountdown(UPS_CONFIG['shutdownCountdown'])
-
-    shutdownCmd = UPS_CONFIG['shutdownCmd']
-    log.warning("Shutdown the OS by execute: %s", shutdownCmd)
-    os.system(shutdownCmd)
-
-    while True:
-        time.sleep(10)
+        powerInputVoltage = ''
+    return (powerInputType, powerInputVoltage)
 
 def formatTimestamp(ts):
     return datetime.fromtimestamp(ts, tz=timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
@@ -211,45 +69,837 @@ def __logDict(prefix, value):
         keyLen = len(str(k))
         keyLenMax = keyLen if (keyLen > keyLenMax) else keyLenMax
     for (k, v) in value.items():
-        if type(v) is not dict:
+        if not hasattr(v, 'items'):
             log.info(prefix + str(k).ljust(keyLenMax) + ': ' + str(v))
         else:
             log.info(prefix + str(k).ljust(keyLenMax) + ':')
             __logDict(prefix + '    ', v)
 
-
-
-exit = Event()
-
-def exitHandler(_signo, _stack_frame):
-    log.info("Receive signal[%d] to exit UPS daemon", _signo)
-    exit.set()
+async def waitEvent(event, timeout):
+    """Wait until event is set or timeout, and clear the event."""
+    try:
+        await asyncio.wait_for(event.wait(), timeout)
+    except asyncio.TimeoutError:
+        pass
+    event.clear()
+
+def _callSoon(loop, callback):
+    """Schedule callback on loop from another thread, unless the loop is already closed."""
+    try:
+        loop.call_soon_threadsafe(callback)
+    except RuntimeError:
+        pass
+
+def processAge():
+    """Return seconds since the process started, or None if unknown."""
+    try:
+        with open('/proc/self/stat', 'r') as f:
+            # Fields after the command name, starting with field 3 (state); field 22 is the start time in clock ticks
+            fields = f.read().rsplit(')', 1)[1].split()
+        return time.clock_gettime(time.CLOCK_BOOTTIME) - int(fields[19]) / os.sysconf('SC_CLK_TCK')
+    except Exception:
+        return None
+
+
+class UpsPlusDaemon:
+    """The UPS daemon application.
+
+    Creating the daemon has no side effects. run() sets up logging and config, then starts the hardware in order
+    of urgency: the power input is checked with a single MCU read before anything else, and the INA219 sensors are
+    only configured after that.
+    """
+
+    def __init__(self, logFilePath=LOG_FILE_PATH, configPath=None):
+        self.logFilePath = logFilePath
+        # Config file path, found in UpsPlusConfig.CONFIG_PATH_LIST if not set
+        self.configPath = configPath
+        self.config = UpsPlusConfig.defaults()
+        self.ups = None
+        self.logListener = None
+        # Single thread for all bus I/O, so a slow or hung bus operation never blocks the event loop
+        self.busExecutor = None
+        # Bus calls submitted and not completed yet, and the loop time of the last completion (or of the first call
+        # submitted on an idle bus), for the watchdog to tell a stuck bus from an idle one
+        self.busPending = 0
+        self.busProgressTime = None
+        self.context = {}
+        self.events = None
+        self.scheduler = None
+        self.stopEvent = None
+        self.loop = None
+        # Startup timings in milliseconds since process start
+        self.startupTimes = {}
+
+    def setupLogging(self):
+        self.logListener = UpsPlusLogging.setupLogging(self.logFilePath)
+
+    def loadConfig(self):
+        if self.configPath is None:
+            self.configPath = UpsPlusConfig.findConfigPath()
+        try:
+            self.config = UpsPlusConfig.load(self.configPath)
+            if self.configPath:
+                log.info("Read config: %s", self.configPath)
+        except UpsPlusConfig.ConfigError:
+            log.exception("Error read config, use default config")
+            self.config = UpsPlusConfig.defaults()
+
+    def createDevice(self):
+        """Open the bus. No bus transaction is issued until the device is used."""
+        return UpsPlusDevice.get({
+            'busBackend': self.config['busBackend'],
+            'snapshotMaxAge': self.config['snapshotMaxAge'],
+            'retryMaxAttempts': self.config['retryMaxAttempts'],
+            'retryBudget': self.config['retryBudget'],
+            'inaVoltageRange': self.config['inaVoltageRange'],
+            'inaGain': UpsPlusIna219.GAIN_AUTO if self.config['inaGain'] == 'auto' else int(self.config['inaGain']) / 1000,
+            'inaAdcSamples': self.config['inaAdcSamples'],
+            'inaTriggered': self.config['inaTriggered'],
+        })
+
+    def markStartup(self, name):
+        """Record a startup milestone, in milliseconds since process start (or since import if unknown)."""
+        age = processAge()
+        if age is None:
+            age = time.monotonic() - START_TIME
+        self.startupTimes[name] = round(age * 1000, 1)
+        return self.startupTimes[name]
+
+    async def runBus(self, func, *args):
+        loop = asyncio.get_running_loop()
+        if self.busPending == 0:
+            self.busProgressTime = loop.time()
+        self.busPending += 1
+        future = self.busExecutor.submit(func, *args)
+        # Done when the bus thread is, even if the caller stopped waiting
+        future.add_done_callback(lambda f: _callSoon(loop, self.busDone))
+        return await asyncio.wrap_future(future)
+
+    def busDone(self):
+        self.busPending -= 1
+        self.busProgressTime = asyncio.get_running_loop().time()
+
+    ############################## Main Loop ##############################
+    def upsLoop(self, verbose=True):
+        """Evaluate power status and shutdown policy on the latest data in context. Never touches the bus.
+
+        Return the new status, and whether to shutdown now. Routine messages are only logged if verbose is set or the
+        power input changed.
+        """
+        context = self.context
+        config = self.config
+        currentTime = time.time()
+
+        prevStatus = context.get('prevStatus') or {}
+        prevPowerInType = prevStatus.get('powerInputType') or ''
+        prevPowerFailure = not prevPowerInType
+
+        upsStatus = context.get('lastGoodStatus')
+        powerInputType = ''
+        powerInputVoltage = ''
+        if upsStatus is not None:
+            (powerInputType, powerInputVoltage) = getUpsPowerInput(upsStatus)
+            statusAge = currentTime - context['lastGoodTime']
+            if statusAge > context['sampleInterval'] * 2:
+                log.warning("Use last good UPS status read %d seconds ago", round(statusAge))
+        detector = context.get('detector')
+        if detector and (detector.powerInputType is not None) and (detector.powerInputType != powerInputType):
+            # Fast path detector sees power input changes before the next status sample
+            powerInputType = detector.powerInputType
+            powerInputVoltage = ''
+        powerFailure = not powerInputType
+
+        verbose = verbose or (powerInputType != prevStatus.get('powerInputType'))
+        logInfo = log.info if verbose else log.debug
+        logWarning = log.warning if verbose else log.debug
+
+        newStatus = {
+            'time': formatTimestamp(currentTime),
+            'powerInputType': powerInputType,
+            'powerInputVoltage': powerInputVoltage,
+            'batteryVoltage': upsStatus['batteryVoltage'] if upsStatus is not None else None,
+            'busTransactions': context.get('sampleTransactions'),
+        }
+
+        logInfo(">"*20 + " UPS Loop " + ">"*20)
+
+        shutdownNow = False
+
+        if not powerFailure:
+            logInfo("Input power OK on %s", powerInputType)
+        else:
+            if not prevPowerFailure:
+                log.warning("Input power failure detected, running on battery!")
+                powerFailureTimestamp = currentTime
+                if detector and (detector.powerInputType == '') and (detector.stateSince is not None) and (detector.stateSince <= currentTime):
+                    # Count the shutdown timeout from the first sample of the power loss
+                    powerFailureTimestamp = detector.stateSince
+                    if detector.detectLatency is not None:
+                        newStatus['powerFailureDetectLatency'] = round(detector.detectLatency, 3)
+                newStatus['powerFailureTimestamp'] = powerFailureTimestamp
+                newStatus['powerFailureTime'] = formatTimestamp(powerFailureTimestamp)
+            else:
+                logWarning("Input power failure continue, running on battery!")
+                if (prevStatus.get('powerFailureTimestamp') is None) or (prevStatus.get('powerFailureTimestamp') >= currentTime):
+                    log.warning("Power failure time not valid, reset to current time")
+                    newStatus['powerFailureTimestamp'] = currentTime
+                    newStatus['powerFailureTime'] = formatTimestamp(currentTime)
+                else:
+                    # Keep power failure time to calculate power off time
+                    newStatus['powerFailureTimestamp'] = prevStatus.get('powerFailureTimestamp')
+                    newStatus['powerFailureTime'] = prevStatus.get('powerFailureTime')
+
+            if config['powerFailureToShutdownTime'] >= 0:
+                shutdownTimeout = config['powerFailureToShutdownTime'] - round(currentTime - newStatus['powerFailureTimestamp'])
+                newStatus['shutdownTimeout'] = max(0, shutdownTimeout)
+                if shutdownTimeout > 0:
+                    logWarning("About to shutdown in %d seconds", shutdownTimeout)
+                else:
+                    log.warning("About to shutdown immediately due to power failure timeout")
+                    shutdownNow = True
+
+            if (not shutdownNow) and (newStatus['batteryVoltage'] is not None):
+                if newStatus['batteryVoltage'] > config['shutdownVoltage']:
+                    logWarning("About to shutdown after batteryVoltage[%.3f] <= shutdownVoltage[%.3f]", newStatus['batteryVoltage'], config['shutdownVoltage'])
+                else:
+                    log.warning("About to shutdown immediately due to batteryVoltage[%.3f] <= shutdownVoltage[%.3f]", newStatus['batteryVoltage'], config['shutdownVoltage'])
+                    shutdownNow = True
+
+            runtime = context['runtimeEstimator'].runtime() if context.get('runtimeEstimator') else None
+            if runtime is not None:
+                newStatus['batteryRuntime'] = round(runtime)
+                if (not shutdownNow) and (config['runtimeShutdownFactor'] > 0):
+                    minRuntime = config['runtimeShutdownFactor'] * self.shutdownDuration()
+                    if runtime > minRuntime:
+                        logWarning("About to shutdown after estimated batteryRuntime[%d] <= %d seconds", runtime, minRuntime)
+                    else:
+                        log.warning("About to shutdown immediately due to estimated batteryRuntime[%d] <= %d seconds", runtime, minRuntime)
+                        shutdownNow = True
+
+        logInfo("<"*20 + " UPS Loop " + "<"*20)
+
+        if context.get('coulombCounter'):
+            newStatus.update(context['coulombCounter'].stats())
+        newStatus['upsStatus'] = upsStatus
+        context['prevStatus'] = newStatus
+        if context.get('outageState'):
+            context['outageState'].update(newStatus.get('powerFailureTimestamp') if powerFailure else None, newStatus['batteryVoltage'])
+        return (newStatus, shutdownNow)
+
+    def updateDesiredState(self, reconciler):
+        reconciler.setDesired('batteryProtectionVoltage', self.config['batteryProtectionVoltage'])
+        reconciler.setDesired('samplePeriod', self.config['samplePeriod'])
+        reconciler.setDesired('autoPowerOn', self.config['autoPowerOn'])
+        for (name, value) in self.context.get('settingOverrides', {}).items():
+            reconciler.setDesired(name, value)
+        # Disable shutdown & restart countdowns, unless left to run for a control client
+        countdowns = self.context.get('countdowns', {})
+        now = time.monotonic()
+        for name in UpsPlusControl.COUNTDOWNS:
+            if countdowns.get(name, 0) > now:
+                reconciler.clearDesired(name)
+            else:
+                reconciler.setDesired(name, 0)
+
+    async def shutdown(self):
+        context = self.context
+        context['shutdown'] = True
+        prevStatus = context.get('prevStatus') or {}
+        if context.get('outageState'):
+            context['outageState'].update(prevStatus.get('powerFailureTimestamp'), prevStatus.get('batteryVoltage'), UpsPlusState.STAGE_SHUTDOWN)
+        log.warning("X"*20 + " Shutdown on Power Failure " + "X"*20)
+        log.warning("Shutdown the UPS after: %d seconds", self.config['shutdownCountdown'])
+        try:
+            # Bounded, the bus thread may be stuck and the OS must shutdown anyway
+            await asyncio.wait_for(self.runBus(self.ups.setShutdownCountdown, self.config['shutdownCountdown']), self.config['retryBudget'])
+        except asyncio.TimeoutError:
+            log.error("Set UPS shutdown countdown timeout after %d seconds, shutdown the OS anyway", self.config['retryBudget'])
+        except Exception:
+            log.exception("Error set UPS shutdown countdown, shutdown the OS anyway")
+
+        journal = context.get('journal')
+        syncFuncs = [ os.sync ]
+        if context.get('coulombCounter'):
+            syncFuncs.insert(0, context['coulombCounter'].save)
+        if journal:
+            self.journalAppend(UpsPlusJournal.FLAG_SHUTDOWN)
+            syncFuncs.insert(0, journal.sync)
+        await self.runShutdownHooks(syncFuncs)
+
+        shutdownCmd = self.config['shutdownCmd']
+        log.warning("Shutdown the OS by execute: %s", shutdownCmd)
+        proc = await asyncio.create_subprocess_shell(shutdownCmd)
+        returnCode = await proc.wait()
+        if returnCode != 0:
+            log.error("Shutdown command exit with code %d", returnCode)
+
+    def batteryRuntime(self):
+        """Estimate seconds until the battery reaches batteryProtectionVoltage at the current load, or None.
+
+        Falls back to the voltage trend when the runtime estimator has not got enough samples yet.
+        """
+        context = self.context
+        runtime = context['runtimeEstimator'].runtime()
+        if runtime is not None:
+            return runtime
+        status = context.get('lastGoodStatus')
+        slope = context['telemetry'].slope('batteryVoltage', context['adaptiveInterval'].trendWindow, time.time())
+        if (status is None) or (slope is None) or (slope >= 0):
+            return None
+        return max(0.0, (status['batteryVoltage'] - self.config['batteryProtectionVoltage']) / -slope)
+
+    def shutdownDuration(self):
+        """Return the seconds a shutdown is expected to take: the last recorded one, or shutdownCountdown."""
+        report = self.context.get('lastShutdownReport')
+        if report is None:
+            return self.config['shutdownCountdown']
+        return report['totalSeconds'] + self.config['shutdownReserveTime']
+
+    async def runShutdownHooks(self, syncFuncs):
+        """Run the pre-shutdown hooks within budget, overlapped with syncFuncs, and record their timings."""
+        config = self.config
+        runtime = self.batteryRuntime()
+        budget = UpsPlusShutdown.hookBudget(config['shutdownCountdown'], config['shutdownReserveTime'], runtime)
+        hooks = config['shutdownHooks']
+        log.warning("Run %d shutdown hooks in %.1f seconds budget, estimated battery runtime: %s", len(hooks), budget,
+                    'unknown' if runtime is None else '%d seconds' % runtime)
+        report = await UpsPlusShutdown.runHooks(hooks, budget, config['shutdownHookTimeout'], config['shutdownHookWorkers'], syncFuncs)
+        log.warning("Shutdown hooks done in %.3f seconds, sync %.3f seconds", report['hooksSeconds'], report['syncSeconds'])
+        if config['shutdownReportPath']:
+            UpsPlusShutdown.saveReport(config['shutdownReportPath'], report)
+
+    def createAdaptiveInterval(self):
+        return UpsPlusScheduler.AdaptiveInterval(self.config['pollIntervalMin'], self.config['loopInterval'], self.config['pollIntervalMax'])
+
+    def updatePollInterval(self):
+        """Update the status sample interval from the latest status and battery voltage trend."""
+        context = self.context
+        adaptiveInterval = context['adaptiveInterval']
+        status = context.get('lastGoodStatus')
+        onBattery = None
+        if status is not None:
+            onBattery = not getUpsPowerInput(status)[0]
+        detector = context.get('detector')
+        if detector and (detector.powerInputType is not None):
+            onBattery = not detector.powerInputType
+        slope = context['telemetry'].slope('batteryVoltage', adaptiveInterval.trendWindow, time.time())
+        (interval, reason) = adaptiveInterval.interval(onBattery, status, slope, self.config['shutdownVoltage'])
+        if reason != context.get('sampleIntervalReason'):
+            log.info("Read UPS status every %.1f seconds: %s", interval, reason)
+            context['sampleIntervalReason'] = reason
+        context['sampleInterval'] = interval
+
+    def journalAppend(self, flags=0):
+        """Append the last good status to the journal every journalInterval, or right away when flags changed."""
+        context = self.context
+        journal = context['journal']
+        upsStatus = context.get('lastGoodStatus')
+        if upsStatus is None:
+            return
+        prevStatus = context.get('prevStatus')
+        if prevStatus and not prevStatus.get('powerInputType'):
+            flags |= UpsPlusJournal.FLAG_POWER_FAILURE
+        lastTime = context.get('journalTime')
+        if (flags == context.get('journalFlags')) and (lastTime is not None) and (context['lastGoodTime'] - lastTime < self.config['journalInterval']):
+            return
+        try:
+            journal.append(context['lastGoodTime'], upsStatus, flags)
+            context['journalTime'] = context['lastGoodTime']
+            context['journalFlags'] = flags
+        except Exception:
+            log.exception("Error append UPS status to journal")
+
+    async def detectTask(self):
+        detector = self.context['detector']
+        loop = asyncio.get_running_loop()
+        while True:
+            startTime = loop.time()
+            prevPowerInputType = detector.powerInputType
+            await self.runBus(detector.sample)
+            DETECT_TIME.observe(loop.time() - startTime)
+            if detector.powerInputType != prevPowerInputType:
+                self.events['policy'].set()
+                self.events['sample'].set()
+            await asyncio.sleep(max(0, detector.interval - (loop.time() - startTime)))
+
+    async def sampleTask(self):
+        context = self.context
+        loop = asyncio.get_running_loop()
+        notifier = context['notifier']
+        while True:
+            # Bound a single status read, the bus thread may be stuck beyond the retry budget
+            timeout = self.config['retryBudget'] + self.config['loopInterval']
+            startTime = loop.time()
+            try:
+                (context['lastGoodStatus'], context['sampleTransactions']) = await asyncio.wait_for(self.runBus(self.readStatus), timeout)
+                context['lastGoodTime'] = time.time()
+                if not context.get('ready'):
+                    context['ready'] = True
+                    notifier.ready("Running")
+                    log.info("UPS daemon ready in %.1f ms", self.markStartup('ready'))
+                context['telemetry'].append(context['lastGoodTime'], context['lastGoodStatus'])
+                context['runtimeEstimator'].update(context['lastGoodTime'], context['lastGoodStatus'])
+                counter = context.get('coulombCounter')
+                if counter:
+                    counter.setVoltages(context['lastGoodStatus']['batteryFullVoltage'], context['lastGoodStatus']['batteryEmptyVoltage'])
+                    counter.seed(context['lastGoodStatus']['batteryRemaining'])
+                if context.get('journal'):
+                    self.journalAppend()
+                if context.get('changeLogger'):
+                    context['changeLogger'].update(context['lastGoodStatus'])
+                self.updatePollInterval()
+                self.events['policy'].set()
+            except asyncio.TimeoutError:
+                # The bus thread is stuck, the watchdog stops pings so systemd restarts the daemon unless it recovers
+                log.error("Read UPS status timeout after %d seconds", timeout)
+            except Exception:
+                log.exception("Error read UPS status")
+            SAMPLE_TIME.observe(loop.time() - startTime)
+            self.scheduler.schedule('sample', context['sampleInterval'])
+            await waitEvent(self.events['sample'], None)
+
+    def readStatus(self):
+        """Read the full UPS status on the bus thread. Return the status and the UPS MCU bus transactions it took."""
+        transactionCount = self.ups.transactionCount
+        status = self.ups.getStatus()
+        return (status, self.ups.transactionCount - transactionCount)
+
+    async def watchdogTask(self):
+        """Ping the systemd watchdog while the bus thread is making progress.
+
+        The bus is stalled when a call has been pending longer than a status read timeout without any call completing,
+        whatever the sample interval: every completed call counts, power loss detector & sample reads alike, and an
+        idle bus is never stalled.
+        """
+        notifier = self.context['notifier']
+        loop = asyncio.get_running_loop()
+        stalled = False
+        while True:
+            await asyncio.sleep(notifier.watchdogInterval)
+            stallTimeout = self.config['retryBudget'] + self.config['loopInterval']
+            if (self.busPending == 0) or (loop.time() - self.busProgressTime <= stallTimeout):
+                notifier.watchdog()
+                if stalled:
+                    log.warning("UPS bus recovered, resume watchdog")
+                    stalled = False
+            elif not stalled:
+                log.error("UPS bus stalled for %.1f seconds, stop watchdog", loop.time() - self.busProgressTime)
+                stalled = True
+
+    async def policyTask(self):
+        context = self.context
+        prevLogTime = None
+        while True:
+            await waitEvent(self.events['policy'], None)
+            # The policy runs after each sample, this only keeps it running if sampling stalls
+            self.scheduler.schedule('policy', context['sampleInterval'] * 2)
+            detector = context.get('detector')
+            if (context.get('lastGoodStatus') is None) and (detector is None or detector.powerInputType is None):
+                # Nothing known about the power status yet
+                continue
+
+            try:
+                currentTime = time.time()
+                config = self.config
+                verbose = (config['logMode'] != 'change') and (config['logStatusInterval'] >= 0) and (prevLogTime is None or currentTime - prevLogTime >= config['logStatusInterval'])
+                if verbose:
+                    prevLogTime = currentTime
+                startTime = time.perf_counter()
+                (newStatus, shutdownNow) = self.upsLoop(verbose)
+                POLICY_TIME.observe(time.perf_counter() - startTime)
+            except Exception:
+                log.exception("Error in UPS loop!")
+                continue
+            if context.get('exporter'):
+                # Render the new status on the next scrape
+                context['exporter'].invalidate()
+            if context.get('controlServer'):
+                context['controlServer'].invalidate()
+            if newStatus.get('shutdownTimeout'):
+                # Shutdown right when the power failure timeout expires, not at the next sample
+                self.scheduler.schedule('policy', newStatus['shutdownTimeout'], earlier=True)
+            if context.get('journal'):
+                # Record power input changes right away
+                self.journalAppend()
+
+            if shutdownNow:
+                await self.shutdown()
+                return
+
+    async def reconcileTask(self):
+        reconciler = UpsPlusReconciler.RegisterReconciler(self.ups)
+        self.context['reconciler'] = reconciler
+        while True:
+            # Never touch device settings once shutdown started, it would cancel the shutdown countdown
+            if not self.context.get('shutdown'):
+                startTime = time.perf_counter()
+                try:
+                    self.updateDesiredState(reconciler)
+                    # Diff against the registers sampled by the status loop, the bus is only touched to write & verify
+                    await self.runBus(reconciler.reconcile, self.context['sampleInterval'] * 2)
+                except Exception:
+                    log.exception("Error update UPS configuration")
+                RECONCILE_TIME.observe(time.perf_counter() - startTime)
+            self.scheduler.schedule('reconcile', self.config['reconcileInterval'])
+            await waitEvent(self.events['reconcile'], None)
+
+    async def journalTask(self):
+        journal = self.context['journal']
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                await asyncio.sleep(self.config['journalSyncInterval'])
+                try:
+                    # fsync may stall on a busy SD card, keep it off the event loop
+                    await loop.run_in_executor(None, journal.sync)
+                except Exception:
+                    log.exception("Error sync UPS journal")
+        finally:
+            journal.close()
+
+    def logSummary(self):
+        context = self.context
+        prevStatus = context['prevStatus']
+        upsStatus = prevStatus.get('upsStatus')
+        summary = {
+            'powerInputType': prevStatus.get('powerInputType') or 'Battery',
+            'batteryVoltage': prevStatus.get('batteryVoltage'),
+            'batteryRemaining': upsStatus['batteryRemaining'] if upsStatus is not None else None,
+        }
+        stats = context['telemetry'].stats('inaBatteryCurrent', self.config['logStatusInterval'], time.time())
+        if stats:
+            (summary['batteryCurrentMin'], summary['batteryCurrentMax'], summary['batteryCurrentMean'], summary['samples']) = stats
+        if context.get('coulombCounter'):
+            summary.update(context['coulombCounter'].stats())
+        summary['changes'] = context['changeLogger'].changeCount
+        log.info("UPS summary: %s", UpsPlusLogging.formatFields(summary), extra={'ups': summary})
+
+    async def logTask(self):
+        context = self.context
+        # Status dumps are replaced by journal records when the journal is enabled
+        if (self.config['logStatusInterval'] < 0) or (context.get('journal') and not context.get('changeLogger')):
+            return
+        while True:
+            await asyncio.sleep(self.config['logStatusInterval'])
+            if not context.get('prevStatus'):
+                continue
+            if context.get('changeLogger'):
+                self.logSummary()
+            else:
+                log.info("UPS status:")
+                logDict(context['prevStatus'])
+
+    def stats(self):
+        """Return a snapshot of the hot path counters & histograms (see UpsPlusStats.Registry.snapshot()), with current
+        'gauges' of the daemon."""
+        stats = UpsPlusStats.snapshot()
+        context = self.context
+        prevStatus = context.get('prevStatus')
+        gauges = {
+            'sampleInterval': context.get('sampleInterval'),
+            'onBattery': None if not prevStatus else int(not prevStatus.get('powerInputType')),
+        }
+        if self.ups is not None:
+            gauges['busTransactions'] = self.ups.transactionCount + self.ups.inaOutput.transactionCount + self.ups.inaBattery.transactionCount
+        if self.scheduler is not None:
+            gauges['schedulerWakeups'] = self.scheduler.wakeupCount
+        if context.get('coulombCounter'):
+            counter = context['coulombCounter']
+            gauges.update({ 'coulombSamples': counter.sampleCount, 'coulombErrors': counter.errorCount, 'coulombOverruns': counter.overrunCount })
+        stats['gauges'] = gauges
+        return stats
+
+    def renderMetrics(self):
+        return UpsPlusExporter.render(self.context.get('prevStatus'), self.context.get('lastGoodTime'), self.stats())
+
+    def controlStatus(self):
+        """Return the "status" response of the control socket: the last good status as raw registers & INA219 readings,
+        for clients to decode with UpsPlusRegisters.decode(), and the daemon view of the power status."""
+        context = self.context
+        upsStatus = context.get('lastGoodStatus')
+        if upsStatus is None:
+            return { 'ok': False, 'error': "No UPS status read yet" }
+        registers = bytearray(UpsPlusDevice.REGISTER_MAP_SIZE)
+        upsStatus.packInto(registers)
+        prevStatus = context.get('prevStatus') or {}
+        return {
+            'ok': True,
+            'time': context['lastGoodTime'],
+            'registers': registers.hex(),
+            'ina': upsStatus.inaValues(),
+            'daemon': { key: prevStatus[key] for key in prevStatus if key != 'upsStatus' },
+        }
+
+    async def controlSet(self, request):
+        name = request.get('name')
+        if name not in UpsPlusControl.SETTINGS:
+            raise UpsPlusControl.ControlError("Invalid setting: %s" % name)
+        field = UpsPlusRegisters.REGISTER_FIELDS[name]
+        try:
+            field.check(field.encode(request.get('value')))
+        except (TypeError, ValueError, UpsPlusRegisters.DataOutOfRangeError) as e:
+            raise UpsPlusControl.ControlError("Invalid %s: %s" % (name, e))
+        if self.context.get('shutdown'):
+            raise UpsPlusControl.ControlError("Shutdown in progress")
+        log.info("Control client set %s to %s until config reload", name, request['value'])
+        self.context.setdefault('settingOverrides', {})[name] = request['value']
+        self.events['reconcile'].set()
+        # Not written to the config file, tell the client how long it lasts
+        return { 'persistent': False, 'message': "%s set to %s until the daemon config is reloaded, set it in %s to keep it"
+                 % (name, request['value'], self.configPath or 'upsplus.conf') }
+
+    async def controlCountdown(self, request):
+        name = request.get('name')
+        value = request.get('value')
+        if name not in UpsPlusControl.COUNTDOWNS:
+            raise UpsPlusControl.ControlError("Invalid countdown: %s" % name)
+        if (type(value) is not int) or not (0 <= value <= 255):
+            raise UpsPlusControl.ControlError("Invalid %s: %s out of range [0, 255]" % (name, value))
+        if self.context.get('shutdown'):
+            raise UpsPlusControl.ControlError("Shutdown in progress")
+        log.warning("Control client set %s to %d seconds", name, value)
+        countdowns = self.context.setdefault('countdowns', {})
+        if value:
+            # Keep the reconciler off the countdown until it ran out
+            countdowns[name] = time.monotonic() + value + self.config['reconcileInterval']
+        else:
+            countdowns.pop(name, None)
+        await self.runBus(self.writeCountdown, name, value)
+        return {}
+
+    def writeCountdown(self, name, value):
+        """Write a countdown register. Runs on the bus thread, so no reconcile can run between taking the countdown out
+        of the desired state and the write."""
+        reconciler = self.context.get('reconciler')
+        if reconciler and value:
+            reconciler.clearDesired(name)
+        self.ups.writeRegister(UpsPlusRegisters.REGISTER_FIELDS[name].offset, value)
+
+    async def controlStats(self, request):
+        return { 'stats': self.stats() }
+
+    async def statsTask(self):
+        """Log a one line summary of the hot path stats changed since the last summary."""
+        previous = UpsPlusStats.snapshot()
+        while True:
+            interval = self.config['logStatsInterval']
+            # Keep checking for the summary to be enabled by a config reload
+            await asyncio.sleep(interval if interval > 0 else self.config['loopInterval'])
+            if interval <= 0:
+                continue
+            snapshot = UpsPlusStats.snapshot()
+            summary = UpsPlusStats.summary(UpsPlusStats.delta(snapshot, previous))
+            previous = snapshot
+            log.info("UPS stats: %s", UpsPlusLogging.formatFields(summary) or 'idle', extra={'ups': summary})
+
+    def resumeOutage(self):
+        """Continue the power failure of a previous daemon run, so its shutdown timeout is not restarted."""
+        state = self.context['outageState']
+        if (not state.load()) or (state.onBatterySince is None):
+            return
+        log.warning("Resume power failure since %s, battery voltage %s, shutdown stage [%s]",
+                    formatTimestamp(state.onBatterySince), state.lastBatteryVoltage, state.shutdownStage)
+        self.context['prevStatus'] = {
+            'powerInputType': '',
+            'batteryVoltage': state.lastBatteryVoltage,
+            'powerFailureTimestamp': state.onBatterySince,
+            'powerFailureTime': formatTimestamp(state.onBatterySince),
+        }
+
+    def reloadConfig(self):
+        """Reload the config file, and apply it if valid. An invalid config file is logged and ignored."""
+        configPath = UpsPlusConfig.findConfigPath() if self.configPath is None else self.configPath
+        try:
+            newConfig = UpsPlusConfig.load(configPath)
+        except UpsPlusConfig.ConfigError as e:
+            log.error("Error reload config, keep current config: %s", e)
+            return
+        except Exception:
+            log.exception("Error reload config, keep current config")
+            return
+
+        changedKeys = UpsPlusConfig.diff(self.config, newConfig)
+        if not changedKeys:
+            log.info("Reload config: %s, no change", configPath)
+            return
+        for key in changedKeys:
+            log.info("Reload config: %s changed from [%s] to [%s]%s", key, self.config[key], newConfig[key],
+                     ", take effect after restart" if key in UpsPlusConfig.RESTART_OPTIONS else "")
+        # Swap the whole config at once, tasks never see a partly updated config
+        self.config = newConfig
+        self.context['adaptiveInterval'] = self.createAdaptiveInterval()
+        self.context['runtimeEstimator'].cutoffVoltage = newConfig['batteryProtectionVoltage']
+        self.context['sampleIntervalReason'] = None
+        if self.context.pop('settingOverrides', None):
+            log.info("Reload config: drop settings of control clients")
+        # Apply device settings & shutdown policy changes now
+        self.events['reconcile'].set()
+        self.events['policy'].set()
+
+    def exitHandler(self, signo, stopEvent):
+        log.info("Receive signal[%d] to exit UPS daemon", signo)
+        stopEvent.set()
+
+    def stop(self):
+        """Stop the daemon, from any thread."""
+        if (self.loop is not None) and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.stopEvent.set)
+
+    async def checkPowerInput(self):
+        """Check the power input with a single MCU read, before the rest of the hardware is set up."""
+        try:
+            status = await self.runBus(self.ups.getPowerInput)
+        except Exception:
+            log.exception("Error check UPS power input on startup")
+            return
+        (powerInputType, powerInputVoltage) = getUpsPowerInput(status)
+        log.info("Startup power input [%s] checked in %.1f ms", powerInputType or 'Battery', self.markStartup('powerInput'))
+        detector = self.context.get('detector')
+        if detector:
+            # The detector takes the first state as is, so a power failure at startup gets the policy running now
+            detector.update(powerInputType, time.time())
+        if not powerInputType:
+            self.events['policy'].set()
+
+    async def asyncMain(self):
+        loop = asyncio.get_running_loop()
+        stopEvent = asyncio.Event()
+        self.loop = loop
+        self.stopEvent = stopEvent
+        for signo in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signo, self.exitHandler, signo, stopEvent)
+
+        context = self.context
+        config = self.config
+        context['notifier'] = UpsPlusSystemd.Notifier()
+        self.events = {
+            # Wake up the status sampling task
+            'sample': asyncio.Event(),
+            # Wake up the policy task
+            'policy': asyncio.Event(),
+            # Wake up the reconcile task
+            'reconcile': asyncio.Event(),
+        }
+        # All periodic wake ups of these tasks come from the scheduler deadlines
+        self.scheduler = UpsPlusScheduler.DeadlineScheduler()
+        for (name, event) in self.events.items():
+            self.scheduler.add(name, event.set)
+        context['adaptiveInterval'] = self.createAdaptiveInterval()
+        context['sampleInterval'] = context['adaptiveInterval'].minInterval
+
+        self.busExecutor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='UpsBus')
+        self.ups = await self.runBus(self.createDevice)
+        if config['powerDetectInterval'] > 0:
+            context['detector'] = UpsPlusDetector.PowerLossDetector(self.ups, config['powerDetectInterval'], config['powerDetectDebounce'])
+        if config['statePath']:
+            context['outageState'] = UpsPlusState.OutageState(config['statePath'])
+            self.resumeOutage()
+        await self.checkPowerInput()
+
+        # Everything below is not needed to protect the system on power failure
+        initIna = asyncio.ensure_future(self.runBus(self.ups.configureIna))
+
+        context['telemetry'] = UpsPlusTelemetry.Telemetry()
+        context['runtimeEstimator'] = UpsPlusEstimator.RuntimeEstimator(config['batteryProtectionVoltage'])
+        log.info("Telemetry history allocated %d bytes", context['telemetry'].memoryUsage())
+        if config['shutdownReportPath']:
+            context['lastShutdownReport'] = UpsPlusShutdown.loadLastReport(config['shutdownReportPath'])
+
+        if config['logMode'] == 'change':
+            context['changeLogger'] = UpsPlusLogging.ChangeLogger({
+                'Voltage': config['logVoltageDeadband'],
+                'Current': config['logCurrentDeadband'],
+                'Power': config['logPowerDeadband'],
+                'Temperature': config['logTemperatureDeadband'],
+                'Remaining': config['logRemainingDeadband'],
+            })
+
+        if config['journalPath']:
+            context['journal'] = UpsPlusJournal.JournalWriter(config['journalPath'], config['journalSegmentSize'], config['journalSegments'])
+            log.info("UPS journal enabled: %s", config['journalPath'])
+
+        tasks = [
+            asyncio.create_task(self.scheduler.run(), name='scheduler'),
+            asyncio.create_task(self.policyTask(), name='policy'),
+        ]
+        if context.get('detector'):
+            tasks.append(asyncio.create_task(self.detectTask(), name='detect'))
+            log.info("Power loss detector started: interval[%.3f] debounce[%d]", config['powerDetectInterval'], config['powerDetectDebounce'])
+        try:
+            await initIna
+        except Exception:
+            log.exception("Error configure INA219, retry on next read")
+        if config['coulombInterval'] > 0:
+            context['coulombCounter'] = UpsPlusCoulomb.CoulombCounter(self.ups, config['coulombInterval'], config['batteryDesignCapacity'], config['batteryStatePath'])
+            context['coulombCounter'].start()
+            log.info("Coulomb counter started: interval[%.3f]", config['coulombInterval'])
+        tasks.extend([
+            asyncio.create_task(self.sampleTask(), name='sample'),
+            asyncio.create_task(self.reconcileTask(), name='reconcile'),
+            asyncio.create_task(self.logTask(), name='log'),
+            asyncio.create_task(self.statsTask(), name='stats'),
+        ])
+        if context.get('journal'):
+            tasks.append(asyncio.create_task(self.journalTask(), name='journal'))
+        loop.add_signal_handler(signal.SIGHUP, self.reloadConfig)
+        configWatcher = None
+        if self.configPath:
+            configWatcher = UpsPlusConfig.ConfigWatcher(self.configPath, self.reloadConfig)
+            if configWatcher.start(loop):
+                log.info("Watch config for changes: %s", self.configPath)
+        if config['metricsPort'] > 0:
+            exporter = UpsPlusExporter.MetricsExporter(self.renderMetrics, config['metricsAddress'], config['metricsPort'])
+            try:
+                await exporter.start()
+                context['exporter'] = exporter
+                log.info("Metrics exporter listening on %s:%d", config['metricsAddress'] or '*', config['metricsPort'])
+            except OSError:
+                log.exception("Error start metrics exporter on port %d", config['metricsPort'])
+        if config['controlSocketPath']:
+            controlServer = UpsPlusControl.ControlServer(self.controlStatus, {
+                'set': self.controlSet,
+                'countdown': self.controlCountdown,
+                'stats': self.controlStats,
+            }, config['controlSocketPath'], self.ups.config['bus'])
+            try:
+                await controlServer.start()
+                context['controlServer'] = controlServer
+                log.info("Control socket listening on %s", config['controlSocketPath'])
+            except OSError:
+                log.exception("Error start control socket on %s", config['controlSocketPath'])
+        if context['notifier'].watchdogInterval:
+            tasks.append(asyncio.create_task(self.watchdogTask(), name='watchdog'))
+            log.info("Systemd watchdog enabled: interval[%.3f]", context['notifier'].watchdogInterval)
+        log.info("UPS daemon started in %.1f ms", self.markStartup('started'))
+
+        await stopEvent.wait()
+        context['notifier'].stopping()
+        if configWatcher:
+            configWatcher.close()
+        if context.get('exporter'):
+            context['exporter'].close()
+        if context.get('controlServer'):
+            context['controlServer'].close()
+
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if context.get('coulombCounter'):
+            context['coulombCounter'].stop()
+        self.busExecutor.shutdown(wait=False)
+        log.info("Exit UPS daemon")
+        context['notifier'].close()
+
+    def run(self):
+        self.setupLogging()
+        try:
+            self.loadConfig()
+            asyncio.run(self.asyncMain())
+        finally:
+            self.logListener.stop()
 
 def main():
-    signal.signal(signal.SIGTERM, exitHandler)
-    signal.signal(signal.SIGINT, exitHandler)
-
-    context = {}
-    context['prevLoopTime'] = time.time()
-    while not exit.is_set():
-        try:
-            runLoop = False
-            currentTime = time.time()
-
-            prevPowerInputType = context.get('prevStatus').get('powerInputType') if context.get('prevStatus') else 'UnKnown'
-            if getUpsPowerInputType() != prevPowerInputType:
-                runLoop = True
-            elif currentTime - context['prevLoopTime'] > UPS_CONFIG['logStatusInterval']:
-                runLoop = True
-
-            if runLoop:
-                context['prevLoopTime'] = currentTime
-                upsLoop(context)
-        except:
-            log.exception("Error in UPS daemon!")
-        exit.wait(UPS_CONFIG['loopInterval'])
-
-    log.info("Exit UPS daemon")
+    UpsPlusDaemon().run()
 
 if __name__=="__main__":
     main()
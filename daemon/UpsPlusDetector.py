@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+import time
+import logging
+
+log = logging.getLogger('UPS')
+
+# Fields sampled to detect power loss
+DETECT_FIELDS = ('typecVoltage', 'microUsbVoltage', 'inaBatteryCurrent')
+
+class PowerLossDetector:
+    """Fast-path power loss detector, sampling only the power input voltages and the battery current.
+
+    Call sample() at a sub-second interval, in parallel with the slow status loop. The power input state
+    only changes after debounceCount consecutive samples agree on the new state. Input voltage is checked with
+    hysteresis: power is lost below lostVoltage and restored above restoredVoltage. A discharging battery, i.e.
+    inaBatteryCurrent below -currentThreshold, also counts as power lost.
+    """
+
+    def __init__(self, ups, interval=0.2, debounceCount=3, lostVoltage=4.0, restoredVoltage=4.4, currentThreshold=0.0):
+        self.ups = ups
+        self.interval = interval
+        self.debounceCount = debounceCount
+        self.lostVoltage = lostVoltage
+        self.restoredVoltage = restoredVoltage
+        self.currentThreshold = currentThreshold
+
+        # Debounced power input type: 'TypeC', 'MicroUSB', '' on power lost, or None before the first state is known
+        self.powerInputType = None
+        # Wall clock time of the first sample of the current state, i.e. the best known time power was lost/restored
+        self.stateSince = None
+        # Seconds between the last sample of the previous state and the state change being raised
+        self.detectLatency = None
+
+        self.sampleCount = 0
+        self.errorCount = 0
+
+        self.__pendingType = None
+        self.__pendingCount = 0
+        self.__pendingSince = None
+        self.__lastStableSampleTime = None
+
+    def sample(self):
+        """Take one sample and update the debounced state. Return the debounced power input type."""
+        try:
+            # Reuse values read by others within half an interval, never retry: a missed sample is cheaper than a late one
+            status = self.ups.getStatus(DETECT_FIELDS, maxAge=self.interval / 2, retry=False, name='detect')
+        except Exception as e:
+            self.errorCount += 1
+            log.debug("Error sample power input: %s", e)
+            return self.powerInputType
+
+        self.sampleCount += 1
+        self.update(self.__classify(status), time.time())
+        return self.powerInputType
+
+    def __classify(self, status):
+        # Use the restore threshold when currently on battery, so a voltage near the threshold won't flap
+        threshold = self.restoredVoltage if self.powerInputType == '' else self.lostVoltage
+        if status['inaBatteryCurrent'] < -self.currentThreshold:
+            return ''
+        if status['typecVoltage'] > threshold:
+            return 'TypeC'
+        if status['microUsbVoltage'] > threshold:
+            return 'MicroUSB'
+        return ''
+
+    def update(self, powerInputType, sampleTime):
+        if powerInputType == self.powerInputType:
+            self.__pendingType = None
+            self.__pendingCount = 0
+            self.__lastStableSampleTime = sampleTime
+            return
+
+        if powerInputType != self.__pendingType:
+            self.__pendingType = powerInputType
+            self.__pendingCount = 0
+            self.__pendingSince = sampleTime
+        self.__pendingCount += 1
+        if (self.powerInputType is not None) and (self.__pendingCount < self.debounceCount):
+            return
+
+        prevType = self.powerInputType
+        self.powerInputType = powerInputType
+        self.stateSince = self.__pendingSince
+        # The change happened at some point after the last sample of the previous state, so this is an upper bound
+        self.detectLatency = None if self.__lastStableSampleTime is None else (time.time() - self.__lastStableSampleTime)
+        self.__pendingType = None
+        self.__pendingCount = 0
+        self.__lastStableSampleTime = sampleTime
+
+        if prevType is not None:
+            if powerInputType:
+                log.warning("Power input restored on %s, detected in %.3f seconds", powerInputType, self.detectLatency)
+            else:
+                log.warning("Power input lost, detected in %.3f seconds", self.detectLatency)
@@ -1,153 +1,214 @@
 #!/usr/bin/env python3
 
+import os
 import time
+import ctypes
+import threading
+from array import array
 import logging
 import smbus2
-from ina219 import INA219
+import UpsPlusRegisters
+import UpsPlusIna219
+import UpsPlusStats
+from UpsPlusRetry import RetryPolicy
+from UpsPlusRegisters import DataOutOfRangeError
 
 log = logging.getLogger('UPS')
 
+# Size of the UPS MCU register map: 0x00 - 0xFF
+REGISTER_MAP_SIZE = 0x100
+# Max length of a single SMBus block transfer
+BLOCK_SIZE_MAX = 32
+
+# Fields to read power input status
+POWER_INPUT_FIELDS = ('typecVoltage', 'microUsbVoltage')
+
+# Duration of each bus operation in seconds, failed attempts included
+MCU_READ_TIME = UpsPlusStats.histogram('busRead.mcu')
+MCU_WRITE_TIME = UpsPlusStats.histogram('busWrite.mcu')
+INA_READ_TIME = UpsPlusStats.histogram('busRead.ina')
+# Duration of getStatus() in seconds by caller name, retries included, see getStatus()
+STATUS_READ_TIMES = { name: UpsPlusStats.histogram('status.' + name) for name in ('sample', 'detect', 'reconcile') }
+
 class UpsPlusDevice:
 
     def __init__(self, config={}):
         self.config = config
 
         _setDefault(self.config, 'bus', 0x1)
+        # Bus backend, see openBus()
+        _setDefault(self.config, 'busBackend', 'smbus')
         _setDefault(self.config, 'outputAddress', 0x40)
         _setDefault(self.config, 'outputShuntOhms', 0.00725)
         _setDefault(self.config, 'batteryAddress', 0x45)
         _setDefault(self.config, 'batteryShuntOhms', 0.005)
         _setDefault(self.config, 'upsAddress', 0x17)
-
-        self.inaOutput = INA219(self.config['outputShuntOhms'], busnum=self.config['bus'], address=self.config['outputAddress'])
-        self.inaOutput.configure()
-
-        self.inaBattery = INA219(self.config['batteryShuntOhms'], busnum=self.config['bus'], address=self.config['batteryAddress'])
-        self.inaBattery.configure()
-
-        self.bus = smbus2.SMBus(self.config['bus'])
-
-    def getPowerInput(self):
-        return self.__invokeWithRetry(self.__getPowerInput, "read UPS power input status")
-
-    def getStatus(self):
-        return self.__invokeWithRetry(self.__getStatus, "read UPS status")
-
-    def __invokeWithRetry(self, func, desc):
-        retryCount = 0
-        retryMax = 10
-        while (retryCount < retryMax):
-            try:
-                return func()
-            except Exception as e:
-                log.exception("Error %s", desc)
-                retryCount += 1
-                if retryCount < retryMax:
-                    log.info("Retry %s for %d time...", desc, retryCount)
-                    time.sleep(2)
-                else:
-                    log.info("Abort %s after %d retries", desc, retryCount)
-                    raise e
-
-    def __getPowerInput(self):
-        ups = {}
-
-        # Initialize with empty prefix so we don't have to use differnt register address offset on parse data
-        buf = [ 0x0 ] * 0x07
-        # Read registers 0x07 - 0x0A
-        buf.extend(self.readRegister(0x07, 0x4))
-
-        ups['typecVoltage'] = round(float(buf[0x08] << 8 | buf[0x07]) / 1000, 2)
-        ups['microUsbVoltage'] = round(float(buf[0x0A] << 8 | buf[0x09]) / 1000, 2)
-
-        return ups
-
-    def __getStatus(self):
-        ups = {}
-
-        ups['inaOutputVoltage'] = round(self.inaOutput.voltage(), 2)
-        ups['inaOutputCurrent'] = round(self.inaOutput.current() / 1000, 3)
-        ups['inaOutputPower'] = round(self.inaOutput.power() / 1000, 3)
-
-        ups['inaBatteryVoltage'] = round(self.inaBattery.voltage(), 2)
-        ups['inaBatteryCurrent'] = round(self.inaBattery.current() / 1000, 3)
-        ups['inaBatteryPower'] = round(self.inaBattery.power() / 1000, 3)
-
-        # Read all registers
-        buf = self.readRegister(0x0, 0xFF)
-
-        ups['mcuVoltage'] = round(float(buf[0x02] << 8 | buf[0x01]) / 1000, 2)
-        ups['pogoPinVoltage'] = round(float(buf[0x04] << 8 | buf[0x03]) / 1000, 2)
-        ups['batteryVoltage'] = round(float(buf[0x06] << 8 | buf[0x05]) / 1000, 2)
-        ups['typecVoltage'] = round(float(buf[0x08] << 8 | buf[0x07]) / 1000, 2)
-        ups['microUsbVoltage'] = round(float(buf[0x0A] << 8 | buf[0x09]) / 1000, 2)
-        ups['batteryTemperature'] = round(float(buf[0x0C] << 8 | buf[0x0B]), 2)
-        ups['batteryFullVoltage'] = round(float(buf[0x0E] << 8 | buf[0x0D]) / 1000, 2)
-        ups['batteryEmptyVoltage'] = round(float(buf[0x10] << 8 | buf[0x0F]) / 1000, 2)
-        ups['batteryProtectionVoltage'] = round(float(buf[0x12] << 8 | buf[0x11]) / 1000, 2)
-        ups['batteryRemaining'] = round(float(buf[0x14] << 8 | buf[0x13]), 2)
-        ups['samplePeriod'] = buf[0x16] << 8 | buf[0x15]
-        ups['powerStatus'] = buf[0x17]
-        ups['shutdownCountdown'] = buf[0x18]
-        ups['autoPowerOn'] = buf[0x19]
-        ups['restartCountdown'] = buf[0x1A]
-        ups['reset'] = buf[0x1B]
-        ups['accumulatedRunningTime'] = buf[0x1F] << 24 | buf[0x1E] << 16 | buf[0x1D] << 8 | buf[0x1C]
-        ups['accumulatedChargingTime'] = buf[0x23] << 24 | buf[0x22] << 16 | buf[0x21] << 8 | buf[0x20]
-        ups['currentRunningTime'] = buf[0x27] << 24 | buf[0x26] << 16 | buf[0x25] << 8 | buf[0x24]
-        ups['version'] = buf[0x29] << 8 | buf[0x28]
-        ups['batteryParameters'] = buf[0x2A]
-        uid0 = "%08X" % (buf[0xF3] << 24 | buf[0xF2] << 16 | buf[0xF1] << 8 | buf[0xF0])
-        uid1 = "%08X" % (buf[0xF7] << 24 | buf[0xF6] << 16 | buf[0xF5] << 8 | buf[0xF4])
-        uid2 = "%08X" % (buf[0xFB] << 24 | buf[0xFA] << 16 | buf[0xF9] << 8 | buf[0xF8])
-        ups['serialNumber'] = uid0 + '-' + uid1 + '-' + uid2
-
-        if ups['mcuVoltage'] < 2.4 or ups['mcuVoltage'] > 3.6:
-            raise DataOutOfRangeError("MCU voltage %.2f out of range [2.4, 3.6]" % ups['mcuVoltage'])
-        if ups['pogoPinVoltage'] < 0 or ups['pogoPinVoltage'] > 5.5:
-            raise DataOutOfRangeError("Pogo pin voltage %.2f out of range [0, 5.5]" % ups['pogoPinVoltage'])
-        if ups['batteryVoltage'] < 0 or ups['batteryVoltage'] > 4.5:
-            raise DataOutOfRangeError("Battery voltage %.2f out of range [0, 4.5]" % ups['batteryVoltage'])
-        if ups['typecVoltage'] < 0 or ups['typecVoltage'] > 13.5:
-            raise DataOutOfRangeError("TypeC voltage %.2f out of range [0, 13.5]" % ups['typecVoltage'])
-        if ups['microUsbVoltage'] < 0 or ups['microUsbVoltage'] > 13.5:
-            raise DataOutOfRangeError("MicroUSB voltage %.2f out of range [0, 13.5]" % ups['microUsbVoltage'])
-        if ups['batteryTemperature'] < -20 or ups['batteryTemperature'] > 65:
-            raise DataOutOfRangeError("Battery temperature %.0f out of range [-20, 65]" % ups['batteryTemperature'])
-        if ups['batteryFullVoltage'] < 0 or ups['batteryFullVoltage'] > 4.5:
-            raise DataOutOfRangeError("Battery full voltage %.2f out of range [0, 4.5]" % ups['batteryFullVoltage'])
-        if ups['batteryEmptyVoltage'] < 0 or ups['batteryEmptyVoltage'] > 4.5:
-            raise DataOutOfRangeError("Battery empty voltage %.2f out of range [0, 4.5]" % ups['batteryEmptyVoltage'])
-        if ups['batteryProtectionVoltage'] < 0 or ups['batteryProtectionVoltage'] > 4.5:
-            raise DataOutOfRangeError("Battery protection voltage %.2f out of range [0, 4.5]" % ups['batteryProtectionVoltage'])
-        if ups['batteryRemaining'] < 0 or ups['batteryRemaining'] > 100:
-            raise DataOutOfRangeError("Batter remaining %.0f out of range [0, 100]" % ups['batteryRemaining'])
-        if ups['samplePeriod'] < 1 or ups['samplePeriod'] > 1440:
-            raise DataOutOfRangeError("Sample period %d out of range [1, 1440]" % ups['samplePeriod'])
-        if ups['powerStatus'] < 0 or ups['powerStatus'] > 1:
-            raise DataOutOfRangeError("Power status %d out of range [0, 1]" % ups['powerStatus'])
-        if ups['shutdownCountdown'] < 0 or ups['shutdownCountdown'] > 255:
-            raise DataOutOfRangeError("Shutdown countdown %d out of range [0, 255]" % ups['shutdownCountdown'])
-        if ups['autoPowerOn'] < 0 or ups['autoPowerOn'] > 1:
-            raise DataOutOfRangeError("Auto power on %d out of range [0, 1]" % ups['autoPowerOn'])
-        if ups['restartCountdown'] < 0 or ups['restartCountdown'] > 255:
-            raise DataOutOfRangeError("Restart countdown %d out of range [0, 255]" % ups['restartCountdown'])
-        if ups['reset'] < 0 or ups['reset'] > 1:
-            raise DataOutOfRangeError("Reset %d out of range [0, 1]" % ups['reset'])
-        if ups['accumulatedRunningTime'] < 0 or ups['accumulatedRunningTime'] > 2147483647:
-            raise DataOutOfRangeError("Accumulated running time %d out of range [0, 2147483647]" % ups['accumulatedRunningTime'])
-        if ups['accumulatedChargingTime'] < 0 or ups['accumulatedChargingTime'] > 2147483647:
-            raise DataOutOfRangeError("Accumulated charging time %d out of range [0, 2147483647]" % ups['accumulatedChargingTime'])
-        if ups['currentRunningTime'] < 0 or ups['currentRunningTime'] > 2147483647:
-            raise DataOutOfRangeError("Current running time %d out of range [0, 2147483647]" % ups['currentRunningTime'])
-        if ups['version'] == 0xFFFF:
-            raise DataOutOfRangeError("Version %d out of range" % ups['version'])
-        if ups['batteryParameters'] == 0xFF:
-            raise DataOutOfRangeError("Battery parameters %d out of range" % ups['batteryParameters'])
-        if ups['serialNumber'] == 'FFFFFFFF-FFFFFFFF-FFFFFFFF':
-            raise DataOutOfRangeError("Serial number %s out of range" % ups['serialNumber'])
-
-        return ups
+        # Max age in seconds of cached register & INA219 values to reuse without reading the bus again
+        _setDefault(self.config, 'snapshotMaxAge', 0.5)
+        # Retry policy of each bus operation, see UpsPlusRetry.RetryPolicy
+        _setDefault(self.config, 'retryMaxAttempts', 4)
+        _setDefault(self.config, 'retryBudget', 3.0)
+        # INA219 settings, see UpsPlusIna219.Ina219
+        _setDefault(self.config, 'inaVoltageRange', 32)
+        _setDefault(self.config, 'inaGain', UpsPlusIna219.GAIN_AUTO)
+        _setDefault(self.config, 'inaAdcSamples', 1)
+        _setDefault(self.config, 'inaTriggered', False)
+
+        self.retryPolicy = RetryPolicy(maxAttempts=self.config['retryMaxAttempts'], budget=self.config['retryBudget'])
+        # Serialize bus access between threads, held for a single attempt of an operation only
+        self.lock = threading.RLock()
+
+        self.bus = openBus(self.config['busBackend'], self.config['bus'])
+        self.__combinedTransfer = bool(self.bus.funcs & smbus2.I2cFunc.I2C)
+        if not self.__combinedTransfer:
+            log.info("I2C adapter doesn't support combined transfer, fallback to chunked register read")
+
+        self.inaOutput = self.__createIna(self.config['outputAddress'], self.config['outputShuntOhms'])
+        self.inaBattery = self.__createIna(self.config['batteryAddress'], self.config['batteryShuntOhms'])
+        # INA219 sensors in UpsPlusRegisters.INA_MAP order, each with 3 fields: voltage, current & power
+        self.__inaSensors = (self.inaOutput, self.inaBattery)
+
+        # Number of bus transactions issued to the UPS MCU since start
+        self.transactionCount = 0
+        # Number of times getStatus() went to the bus, to tell bus reads from snapshot cache hits
+        self.__busReadCount = 0
+
+        # Register snapshot indexed by register address, filled in place by register window reads
+        self.snapshot = bytearray(REGISTER_MAP_SIZE)
+
+        # Read plans by requested field set, see __getPlan()
+        self.__plans = {}
+        # Names of static fields already read into the snapshot
+        self.__staticCached = frozenset()
+        self.__snapshotPlan = _ReadPlan(self, None, [ (0x0, REGISTER_MAP_SIZE) ])
+
+        # Monotonic time each register was last read from the bus
+        self.__readTime = array('d', bytes(8 * REGISTER_MAP_SIZE))
+        # Bumped on every change of the snapshot, to tell whether a decoded status is still current
+        self.__snapshotVersion = 0
+        # Last INA219 readings in UpsPlusRegisters.INA_MAP order and the monotonic time each was read
+        self.__inaValues = [ 0.0 ] * len(UpsPlusRegisters.INA_MAP)
+        self.__inaReadTime = array('d', bytes(8 * len(self.__inaSensors)))
+        self.__inaConfigured = False
+
+    def __createIna(self, address, shuntOhms):
+        return UpsPlusIna219.Ina219(self.bus, address, shuntOhms, voltageRange=self.config['inaVoltageRange'], gain=self.config['inaGain'],
+                                    adcSamples=self.config['inaAdcSamples'], triggered=self.config['inaTriggered'],
+                                    combinedTransfer=self.__combinedTransfer)
+
+    def configureIna(self):
+        """Configure the INA219 sensors. Done on the first INA219 read if not called before."""
+        for ina in self.__inaSensors:
+            self.retryPolicy.call(lambda: self.__invokeLocked(ina.configure), "configure INA219[0x%02X]" % ina.address, name='inaConfigure')
+        self.__inaConfigured = True
+
+    def getPowerInput(self, maxAge=None):
+        return self.__invokeWithRetry(lambda: self.__getStatus(POWER_INPUT_FIELDS, maxAge), "read UPS power input status", 'powerInput')
+
+    def getStatus(self, fields=None, maxAge=None, retry=True, name='sample'):
+        """Read UPS status.
+
+        fields is an optional tuple of field names to read, see UpsPlusRegisters. Only the register windows
+        holding these fields are read, and static fields are read from the bus only once.
+
+        Values read within maxAge seconds (default: config snapshotMaxAge) are served from the snapshot without
+        touching the bus. Pass maxAge=0 to force a read.
+
+        With retry=False the read is attempted only once and errors are raised to the caller, for fast sampling
+        paths that would rather skip a sample than wait.
+
+        name is the caller, the duration of calls that read the bus is observed in the 'status.<name>' histogram;
+        snapshot cache hits are left out.
+        """
+        busReadCount = self.__busReadCount
+        startTime = time.perf_counter()
+        try:
+            if not retry:
+                with self.lock:
+                    return self.__getStatus(fields, maxAge)
+            return self.__invokeWithRetry(lambda: self.__getStatus(fields, maxAge), "read UPS status", 'status')
+        finally:
+            if self.__busReadCount != busReadCount:
+                histogram = STATUS_READ_TIMES.get(name)
+                if histogram is None:
+                    histogram = STATUS_READ_TIMES[name] = UpsPlusStats.histogram('status.' + name)
+                histogram.observe(time.perf_counter() - startTime)
+
+    def __invokeWithRetry(self, func, desc, name):
+        return self.retryPolicy.call(lambda: self.__invokeLocked(func), desc, name=name)
+
+    def __invokeLocked(self, func):
+        with self.lock:
+            return func()
+
+    def __getPlan(self, fields):
+        plans = self.__plans.get(fields)
+        if plans is None:
+            fieldSet = UpsPlusRegisters.FieldSet(fields)
+            # Plans to use before and after static fields are cached
+            plans = (_ReadPlan(self, fieldSet, fieldSet.windows(True)), _ReadPlan(self, fieldSet, fieldSet.windows(False)))
+            self.__plans[fields] = plans
+        return plans[1] if plans[0].fieldSet.staticNames <= self.__staticCached else plans[0]
+
+    def __getStatus(self, fields, maxAge):
+        plan = self.__getPlan(fields)
+        fieldSet = plan.fieldSet
+        now = time.monotonic()
+        minTime = now - (self.config['snapshotMaxAge'] if maxAge is None else maxAge)
+
+        ina = None
+        if fieldSet.inaFields:
+            # Raw INA219 readings, scaled on access. All stale sensors are read in one transaction.
+            inaValues = self.__inaValues
+            inaReadTime = self.__inaReadTime
+            sensorIndexes = { field.index // 3 for field in fieldSet.inaFields if inaReadTime[field.index // 3] <= minTime }
+            if sensorIndexes:
+                self.__busReadCount += 1
+                if not self.__inaConfigured:
+                    for sensor in self.__inaSensors:
+                        sensor.configure()
+                    self.__inaConfigured = True
+                sensorIndexes = sorted(sensorIndexes)
+                startTime = time.perf_counter()
+                try:
+                    samples = UpsPlusIna219.readSamples([ self.__inaSensors[i] for i in sensorIndexes ])
+                finally:
+                    INA_READ_TIME.observe(time.perf_counter() - startTime)
+                for (i, sample) in zip(sensorIndexes, samples):
+                    inaValues[i * 3 : i * 3 + 3] = sample
+                    inaReadTime[i] = now
+                self.__snapshotVersion += 1
+            ina = tuple(inaValues)
+
+        readTime = self.__readTime
+        read = False
+        for register in plan.registers:
+            if readTime[register] <= minTime:
+                self.__busReadCount += 1
+                self.__readWindows(plan)
+                read = True
+                for register in plan.registers:
+                    readTime[register] = now
+                break
+        else:
+            # All registers fresh, reuse the decoded status if the snapshot didn't change since
+            status = plan.status
+            if (status is not None) and (plan.statusVersion == self.__snapshotVersion):
+                return status
+
+        try:
+            status = fieldSet.decode(self.snapshot, ina, count=read)
+        except DataOutOfRangeError:
+            # Torn or garbage read, expire the windows so the retry reads the bus again instead of the same bytes
+            for (register, length) in plan.windows:
+                readTime[register : register + length] = array('d', bytes(8 * length))
+            raise
+        plan.status = status
+        plan.statusVersion = self.__snapshotVersion
+
+        if not fieldSet.staticNames <= self.__staticCached:
+            self.__staticCached = self.__staticCached | fieldSet.staticNames
+        return status
 
     def setBatteryProtectionVoltage(self, value):
         self.writeRegister(0x11, [ value & 0xFF, (value >> 8) & 0xFF ])
@@ -170,68 +231,143 @@ class UpsPlusDevice:
         log.info("Set UPS restart countdown to %d", value)
 
     def readRegister(self, register, length=1):
-        retryCount = 0
-        retryMax = 10
-        while (retryCount < retryMax):
-            try:
-                return self.__readRegister(register, length)
-            except Exception as e:
-                log.exception("Error read UPS register[%d] length[%d]", register, length)
-                retryCount += 1
-                if retryCount < retryCount:
-                    log.info("Retry read UPS register[%d] length[%d] for %d time...", register, length, retryCount)
-                    time.sleep(2)
-                else:
-                    log.info("Abort read UPS register[%d] length[%d] after %d retries", register, length, retryCount)
-                    raise e
+        return self.__invokeWithRetry(lambda: self.__readRegister(register, length), "read UPS register[%d] length[%d]" % (register, length), 'registerRead')
 
     def __readRegister(self, register, length):
+        startTime = time.perf_counter()
+        try:
+            return self.__readRegisterData(register, length)
+        finally:
+            MCU_READ_TIME.observe(time.perf_counter() - startTime)
+
+    def __readRegisterData(self, register, length):
         if length == 1:
+            self.transactionCount += 1
             return self.bus.read_byte_data(self.config['upsAddress'], register)
         else:
             datas = []
             offset = 0
             while offset < length:
-                datas.extend(self.bus.read_i2c_block_data(self.config['upsAddress'], register + offset, min(length - offset, 32)))
-                offset += min(length - offset, 32)
+                self.transactionCount += 1
+                datas.extend(self.bus.read_i2c_block_data(self.config['upsAddress'], register + offset, min(length - offset, BLOCK_SIZE_MAX)))
+                offset += min(length - offset, BLOCK_SIZE_MAX)
             return datas
 
+    def readSnapshot(self):
+        """Read the whole register map 0x00 - 0xFF into the snapshot buffer and return the buffer."""
+        return self.__invokeWithRetry(self.__readSnapshot, "read UPS register snapshot", 'snapshot')
+
+    def __readSnapshot(self):
+        self.__readWindows(self.__snapshotPlan)
+        now = time.monotonic()
+        for register in range(REGISTER_MAP_SIZE):
+            self.__readTime[register] = now
+        return self.snapshot
+
+    def __readWindows(self, plan):
+        self.__snapshotVersion += 1
+        startTime = time.perf_counter()
+        try:
+            self.__transferWindows(plan)
+        finally:
+            MCU_READ_TIME.observe(time.perf_counter() - startTime)
+        return self.snapshot
+
+    def __transferWindows(self, plan):
+        if self.__combinedTransfer:
+            # Read all windows in a single transaction so the snapshot never tears between windows
+            self.transactionCount += 1
+            self.bus.i2c_rdwr(*plan.msgs)
+        else:
+            for (register, length) in plan.windows:
+                offset = 0
+                while offset < length:
+                    chunk = min(length - offset, BLOCK_SIZE_MAX)
+                    self.transactionCount += 1
+                    self.snapshot[register + offset : register + offset + chunk] = bytes(self.bus.read_i2c_block_data(self.config['upsAddress'], register + offset, chunk))
+                    offset += chunk
+
     def writeRegister(self, register, datas):
-        retryCount = 0
-        retryMax = 10
-        while (retryCount < retryMax):
-            try:
-                return self.__writeRegister(register, datas)
-            except Exception as e:
-                log.exception("Error write UPS register[%d] values[%s]", register, _formatList2HexStr(datas))
-                retryCount += 1
-                if retryCount < retryMax:
-                    log.info("Retry write UPS register[%d] values[%s] for %d time...", register, _formatList2HexStr(datas), retryCount)
-                    time.sleep(2)
-                else:
-                    log.info("Abort write UPS register[%d] values[%s] after %d retries", register, _formatList2HexStr(datas), retryCount)
-                    raise e
+        return self.__invokeWithRetry(lambda: self.__writeRegister(register, datas),
+                                      "write UPS register[%d] values[%s]" % (register, _formatList2HexStr(datas if type(datas) is list else [ datas ])),
+                                      'registerWrite')
 
     def __writeRegister(self, register, datas):
+        startTime = time.perf_counter()
+        try:
+            self.__writeRegisterData(register, datas)
+        finally:
+            MCU_WRITE_TIME.observe(time.perf_counter() - startTime)
+
+    def __writeRegisterData(self, register, datas):
         if type(datas) is not list:
-            return self.bus.write_byte_data(self.config['upsAddress'], register, datas)
+            self.transactionCount += 1
+            self.bus.write_byte_data(self.config['upsAddress'], register, datas)
+            self.__patchSnapshot(register, [ datas ])
         else:
             offset = 0
             length = len(datas)
             while offset < length:
-                self.bus.write_i2c_block_data(self.config['upsAddress'], register + offset, datas[offset : min(length - offset, 32)])
-                offset += min(length - offset, 32)
+                chunk = min(length - offset, BLOCK_SIZE_MAX)
+                self.transactionCount += 1
+                self.bus.write_i2c_block_data(self.config['upsAddress'], register + offset, datas[offset : offset + chunk])
+                offset += chunk
+            self.__patchSnapshot(register, datas)
+
+    def __patchSnapshot(self, register, datas):
+        # Keep cached registers in line with what was just written
+        self.snapshot[register : register + len(datas)] = bytes(datas)
+        self.__snapshotVersion += 1
+
+
+
+class _ReadPlan:
+    """Register windows to read for a field set, with the prebuilt combined transfer messages to read them.
+
+    Each read message uses the window of the device snapshot as its data buffer, so the kernel fills the snapshot
+    directly without any copy.
+    """
+
+    __slots__ = ('fieldSet', 'windows', 'registers', 'msgs', 'status', 'statusVersion')
+
+    def __init__(self, device, fieldSet, windows):
+        self.fieldSet = fieldSet
+        self.windows = windows
+        # First register of each field read by the plan, to check whether the cached values are fresh
+        self.registers = ()
+        if fieldSet is not None:
+            self.registers = tuple(field.offset for field in fieldSet.registerFields
+                                   if any(register <= field.offset < register + length for (register, length) in windows))
+        # Last decoded status and the snapshot version it was decoded from
+        self.status = None
+        self.statusVersion = -1
+
+        address = device.config['upsAddress']
+        msgs = []
+        for (register, length) in windows:
+            msgs.append(smbus2.i2c_msg.write(address, [ register ]))
+            msgs.append(smbus2.i2c_msg(addr=address, flags=smbus2.smbus2.I2C_M_RD, len=length,
+                                       buf=(ctypes.c_char * length).from_buffer(device.snapshot, register)))
+        self.msgs = tuple(msgs)
 
 
 
 def get(config={}):
     return UpsPlusDevice(config)
 
-class DataOutOfRangeError(Exception):
-    pass
+def openBus(backend, bus):
+    """Open an I2C bus: 'smbus' for /dev/i2c-<bus>, or 'emulator' for an emulated UPS Plus configured by the
+    UPSPLUS_EMULATOR environment variable (see UpsPlusEmulator.EmulatedBus.fromSpec())."""
+    if backend == 'smbus':
+        return smbus2.SMBus(bus)
+    if backend == 'emulator':
+        # Only loaded when used
+        import UpsPlusEmulator
+        return UpsPlusEmulator.EmulatedBus.fromSpec(os.environ.get('UPSPLUS_EMULATOR', ''))
+    raise ValueError("Invalid bus backend: %s" % backend)
 
 def _setDefault(dict, key, value):
-    if not dict.get(key):
+    if dict.get(key) is None:
         dict[key] = value
 
 def _formatList2HexStr(list):
@@ -0,0 +1,444 @@
+#!/usr/bin/env python3
+
+import time
+import errno
+import copy
+import ctypes
+import random
+import logging
+import threading
+import smbus2
+import UpsPlusRegisters
+import UpsPlusIna219
+
+log = logging.getLogger('UPS')
+
+MCU_ADDRESS = 0x17
+# The MCU answers on this address in firmware upgrade (OTA) mode only, see OTA_firmware_upgrade.py
+OTA_ADDRESS = 0x18
+OUTPUT_INA_ADDRESS = 0x40
+BATTERY_INA_ADDRESS = 0x45
+
+# Writing OTA_ENTER to this MCU register enters OTA mode
+REG_OTA = 0x32
+OTA_ENTER = 127
+OTA_WRITE_CHUNK = 250
+OTA_FINISH = 0
+
+# Li-ion open circuit voltage at 0%, 10%, ... 100% state of charge
+OCV_CURVE = (3.00, 3.45, 3.60, 3.68, 3.74, 3.79, 3.85, 3.92, 4.00, 4.08, 4.20)
+
+FIELDS = UpsPlusRegisters.REGISTER_FIELDS
+
+class BatteryModel:
+    """Battery, charger and load of an UPS Plus.
+
+    On power input the charger feeds the load and charges the battery at chargeCurrent, tapering off over the last
+    taperFraction of the charge. On battery the load is drawn from the battery through a boost converter of the
+    given efficiency. Attributes may be changed at any time, e.g. by an emulator script.
+    """
+
+    def __init__(self, capacity=4000, charge=None, resistance=0.08, loadPower=2.5, outputVoltage=5.1, efficiency=0.9,
+                 chargeCurrent=2000, taperFraction=0.1, typecVoltage=5.1, microUsbVoltage=0.0, temperature=30):
+        # Capacity & charge left in mAh
+        self.capacity = capacity
+        self.charge = capacity * 0.8 if charge is None else charge
+        # Internal resistance in ohm
+        self.resistance = resistance
+        # Load on the UPS output in W
+        self.loadPower = loadPower
+        self.outputVoltage = outputVoltage
+        self.efficiency = efficiency
+        # Max charge current in mA
+        self.chargeCurrent = chargeCurrent
+        self.taperFraction = taperFraction
+        self.typecVoltage = typecVoltage
+        self.microUsbVoltage = microUsbVoltage
+        self.temperature = temperature
+
+        # Battery current in mA, positive when charging
+        self.current = 0.0
+        self.voltage = self.openCircuitVoltage()
+
+    @property
+    def powerInput(self):
+        return (self.typecVoltage > 4) or (self.microUsbVoltage > 4)
+
+    def openCircuitVoltage(self):
+        position = min(max(self.charge / self.capacity, 0.0), 1.0) * (len(OCV_CURVE) - 1)
+        index = min(int(position), len(OCV_CURVE) - 2)
+        return OCV_CURVE[index] + (OCV_CURVE[index + 1] - OCV_CURVE[index]) * (position - index)
+
+    def outputCurrent(self, outputOn):
+        """Return the UPS output current in mA."""
+        return self.loadPower / self.outputVoltage * 1000 if outputOn else 0.0
+
+    def step(self, seconds, outputOn):
+        ocv = self.openCircuitVoltage()
+        if self.powerInput:
+            taper = (1 - self.charge / self.capacity) / self.taperFraction
+            current = self.chargeCurrent * min(max(taper, 0.0), 1.0)
+        else:
+            load = self.loadPower if outputOn else 0.0
+            current = -load / self.efficiency / max(ocv, 2.5) * 1000
+        self.charge = min(max(self.charge + current * seconds / 3600, 0.0), self.capacity)
+        self.current = current
+        self.voltage = ocv + current / 1000 * self.resistance
+
+
+class McuEmulator:
+    """UPS Plus MCU register map: measurements refreshed from the battery model, settings, countdowns & OTA mode."""
+
+    def __init__(self, model, version=10, serialNumber=(0x12345678, 0x9ABCDEF0, 0x0F1E2D3C)):
+        self.model = model
+        self.registers = bytearray(0x100)
+        self.outputOn = True
+        self.otaMode = False
+        # Firmware received in OTA mode
+        self.firmware = bytearray()
+        self.__otaChunk = bytearray(16)
+        self.__countdownTime = 0.0
+        self.__offTime = None
+        # Running & charging times in seconds, kept fractional as the model steps may be short
+        self.__times = { 'accumulatedRunningTime': 0.0, 'currentRunningTime': 0.0, 'accumulatedChargingTime': 0.0 }
+        self.__pack('version', version)
+        self.__pack('batteryParameters', 1)
+        self.__pack('serialNumber', serialNumber)
+        self.reset()
+
+    def __pack(self, name, raw):
+        field = FIELDS[name]
+        if field.count > 1:
+            field.struct.pack_into(self.registers, field.offset, *raw)
+        else:
+            field.struct.pack_into(self.registers, field.offset, raw)
+
+    def __raw(self, name):
+        field = FIELDS[name]
+        return field.struct.unpack_from(self.registers, field.offset)[0]
+
+    def reset(self):
+        """Restore default settings."""
+        self.__pack('batteryFullVoltage', 4200)
+        self.__pack('batteryEmptyVoltage', 3300)
+        self.__pack('batteryProtectionVoltage', 3500)
+        self.__pack('samplePeriod', 2)
+        self.__pack('shutdownCountdown', 0)
+        self.__pack('autoPowerOn', 1)
+        self.__pack('restartCountdown', 0)
+
+    def step(self, now, seconds):
+        model = self.model
+        model.step(seconds, self.outputOn)
+
+        # Countdowns tick once per second
+        self.__countdownTime += seconds
+        while self.__countdownTime >= 1:
+            self.__countdownTime -= 1
+            for name in ('shutdownCountdown', 'restartCountdown'):
+                value = self.__raw(name)
+                if value:
+                    self.__pack(name, value - 1)
+                    if value == 1:
+                        log.debug("Emulated UPS %s expired, power off output", name)
+                        self.__powerOff(now)
+                        if name == 'restartCountdown':
+                            self.__offTime = now - 1
+        if self.outputOn:
+            if (not model.powerInput) and (model.voltage * 1000 < self.__raw('batteryProtectionVoltage')):
+                log.debug("Emulated UPS battery below protection voltage, power off output")
+                self.__powerOff(now)
+        elif (self.__offTime is not None) and (now - self.__offTime >= 1) and model.powerInput and self.__raw('autoPowerOn'):
+            self.outputOn = True
+            self.__offTime = None
+            self.__times['currentRunningTime'] = 0.0
+
+        self.__pack('mcuVoltage', 3300)
+        self.__pack('pogoPinVoltage', round(model.outputVoltage * 1000) if self.outputOn else 0)
+        self.__pack('batteryVoltage', round(model.voltage * 1000))
+        self.__pack('typecVoltage', round(model.typecVoltage * 1000))
+        self.__pack('microUsbVoltage', round(model.microUsbVoltage * 1000))
+        self.__pack('batteryTemperature', round(model.temperature))
+        full = self.__raw('batteryFullVoltage')
+        empty = self.__raw('batteryEmptyVoltage')
+        remaining = (model.voltage * 1000 - empty) / max(full - empty, 1) * 100
+        self.__pack('batteryRemaining', round(min(max(remaining, 0), 100)))
+        self.__pack('powerStatus', 1 if model.powerInput else 0)
+        times = self.__times
+        if self.outputOn:
+            times['accumulatedRunningTime'] += seconds
+            times['currentRunningTime'] += seconds
+        if model.current > 0:
+            times['accumulatedChargingTime'] += seconds
+        for (name, value) in times.items():
+            self.__pack(name, int(value) & 0x7FFFFFFF)
+
+    def __powerOff(self, now):
+        self.outputOn = False
+        self.__offTime = now
+
+    def write(self, register, datas):
+        for (i, value) in enumerate(datas):
+            offset = register + i
+            if offset == FIELDS['reset'].offset:
+                if value == 1:
+                    self.reset()
+            elif offset == REG_OTA:
+                if value == OTA_ENTER:
+                    log.debug("Emulated UPS enter OTA mode")
+                    self.otaMode = True
+                    self.firmware = bytearray()
+            elif offset < 0x100:
+                self.registers[offset] = value
+
+    def writeOta(self, register, datas):
+        for (i, value) in enumerate(datas):
+            offset = register + i
+            if 1 <= offset <= len(self.__otaChunk):
+                self.__otaChunk[offset - 1] = value
+            elif offset == REG_OTA:
+                if value == OTA_WRITE_CHUNK:
+                    self.firmware.extend(self.__otaChunk)
+                elif value == OTA_FINISH:
+                    log.debug("Emulated UPS OTA finished, %d bytes received", len(self.firmware))
+                    self.otaMode = False
+
+
+class InaEmulator:
+    """INA219 register map, converting the measured voltage & current like the chip does from its calibration."""
+
+    def __init__(self, shuntOhms, measure):
+        self.shuntOhms = shuntOhms
+        # Return (bus voltage in V, current in mA) to measure
+        self.measure = measure
+        self.registers = [ 0x399F, 0, 0, 0, 0, 0 ]
+
+    def step(self):
+        (voltage, current) = self.measure()
+        config = self.registers[UpsPlusIna219.REG_CONFIG]
+        gain = UpsPlusIna219.GAIN_VOLTS[(config >> 11) & 0x3]
+        shunt = current / 1000 * self.shuntOhms
+        overflow = abs(shunt) > gain
+        shunt = min(max(shunt, -gain), gain)
+        shuntRaw = round(shunt / UpsPlusIna219.SHUNT_VOLTAGE_LSB * 1000)
+        busRaw = round(voltage / UpsPlusIna219.BUS_VOLTAGE_LSB)
+        calibration = self.registers[UpsPlusIna219.REG_CALIBRATION]
+        currentRaw = shuntRaw * calibration // 4096 if calibration else 0
+        powerRaw = abs(currentRaw) * busRaw // 5000
+        self.registers[UpsPlusIna219.REG_SHUNT_VOLTAGE] = shuntRaw & 0xFFFF
+        self.registers[UpsPlusIna219.REG_BUS_VOLTAGE] = ((busRaw << 3) | UpsPlusIna219.BUS_VOLTAGE_CNVR | (UpsPlusIna219.BUS_VOLTAGE_OVF if overflow else 0)) & 0xFFFF
+        self.registers[UpsPlusIna219.REG_POWER] = min(powerRaw, 0xFFFF)
+        self.registers[UpsPlusIna219.REG_CURRENT] = max(min(currentRaw, 0x7FFF), -0x8000) & 0xFFFF
+
+    def read(self, register, length):
+        value = self.registers[register] if register < len(self.registers) else 0
+        datas = bytes(((value >> 8) & 0xFF, value & 0xFF))
+        return (datas * ((length + 1) // 2))[:length]
+
+    def write(self, register, datas):
+        if (len(datas) >= 2) and (register < len(self.registers)):
+            self.registers[register] = (datas[0] << 8) | datas[1]
+
+
+class EmulatedBus:
+    """In-process I2C bus with an emulated UPS Plus: the MCU at 0x17 (and 0x18 in OTA mode) and both INA219s.
+
+    Implements the subset of smbus2.SMBus used by the UPS tools & daemon. The battery model runs on emulated time,
+    i.e. real time multiplied by timeScale plus any advance(). A script of (emulated seconds, {attribute: value}) is
+    applied to the battery model when its time comes, e.g. [(60, {'typecVoltage': 0})] for a power failure after 1
+    minute.
+
+    Faults are injected per transaction: latency plus byteTime per byte transferred, NACKs (OSError EREMOTEIO) at
+    nackRate, 0xFF garbage reads at garbageRate, and torn MCU reads at tornReadRate, where the bytes after a random
+    point come from tornStep emulated seconds later. stick() makes transactions time out, or hang, like a bus held
+    low.
+    """
+
+    def __init__(self, bus=1, model=None, script=(), timeScale=1.0, latency=0.0, byteTime=0.0, nackRate=0.0,
+                 garbageRate=0.0, tornReadRate=0.0, tornStep=60.0, stuckTimeout=1.0, seed=None,
+                 outputShuntOhms=0.00725, batteryShuntOhms=0.005):
+        self.model = BatteryModel() if model is None else model
+        self.script = sorted(script, key=lambda item: item[0])
+        self.timeScale = timeScale
+        self.latency = latency
+        self.byteTime = byteTime
+        self.nackRate = nackRate
+        self.garbageRate = garbageRate
+        self.tornReadRate = tornReadRate
+        self.tornStep = tornStep
+        self.stuckTimeout = stuckTimeout
+        self.random = random.Random(seed)
+        self.funcs = smbus2.I2cFunc.I2C | smbus2.I2cFunc.SMBUS_BYTE_DATA | smbus2.I2cFunc.SMBUS_I2C_BLOCK
+
+        self.mcu = McuEmulator(self.model)
+        self.inas = {
+            OUTPUT_INA_ADDRESS: InaEmulator(outputShuntOhms, lambda: (self.model.outputVoltage if self.mcu.outputOn else 0.0, self.model.outputCurrent(self.mcu.outputOn))),
+            BATTERY_INA_ADDRESS: InaEmulator(batteryShuntOhms, lambda: (self.model.voltage, self.model.current)),
+        }
+        # Register pointer by device address
+        self.__pointers = {}
+
+        self.transactionCount = 0
+        # Bytes transferred, register pointers included
+        self.byteCount = 0
+        self.faultCount = 0
+        self.lock = threading.Lock()
+        self.__stuckUntil = None
+        self.__stuckHang = False
+        self.__unstuck = threading.Event()
+        self.__startTime = time.monotonic()
+        self.__offset = 0.0
+        self.__scriptIndex = 0
+        self.__modelTime = 0.0
+
+    @classmethod
+    def fromSpec(cls, spec):
+        """Create from "key=value,..." (e.g. "timeScale=60,nackRate=0.01"), setting numeric constructor arguments."""
+        kwargs = {}
+        for item in spec.split(','):
+            if item.strip():
+                (key, value) = item.split('=', 1)
+                kwargs[key.strip()] = float(value)
+        if 'seed' in kwargs:
+            kwargs['seed'] = int(kwargs['seed'])
+        return cls(**kwargs)
+
+    def now(self):
+        """Emulated seconds since start."""
+        return (time.monotonic() - self.__startTime) * self.timeScale + self.__offset
+
+    def advance(self, seconds):
+        """Move emulated time forward, e.g. to fast forward a discharge."""
+        with self.lock:
+            self.__offset += seconds
+            self.__update()
+
+    def stick(self, seconds=None, hang=False):
+        """Stick the bus for seconds (forever if None). Transactions time out after stuckTimeout, or block with hang."""
+        self.__stuckUntil = float('inf') if seconds is None else time.monotonic() + seconds
+        self.__stuckHang = hang
+        self.__unstuck.clear()
+
+    def unstick(self):
+        self.__stuckUntil = None
+        self.__unstuck.set()
+
+    def close(self):
+        pass
+
+    def __update(self):
+        now = self.now()
+        # Step the model up to each script event, then apply it
+        while True:
+            until = now
+            pending = self.__scriptIndex < len(self.script) and self.script[self.__scriptIndex][0] <= now
+            if pending:
+                until = max(self.script[self.__scriptIndex][0], self.__modelTime)
+            if until > self.__modelTime:
+                self.mcu.step(until, until - self.__modelTime)
+                self.__modelTime = until
+            if not pending:
+                break
+            for (key, value) in self.script[self.__scriptIndex][1].items():
+                setattr(self.model, key, value)
+            self.__scriptIndex += 1
+        for ina in self.inas.values():
+            ina.step()
+
+    def __device(self, address):
+        if address == MCU_ADDRESS:
+            return self.mcu
+        if (address == OTA_ADDRESS) and self.mcu.otaMode:
+            return self.mcu
+        return self.inas.get(address)
+
+    def __read(self, address, register, length):
+        if address in self.inas:
+            return self.inas[address].read(register, length)
+        return bytes(self.mcu.registers[register : register + length]).ljust(length, b'\0')
+
+    def transfer(self, ops):
+        """Run one transaction of ops: ('w', address, datas) or ('r', address, length). Return the data read."""
+        stuckUntil = self.__stuckUntil
+        if (stuckUntil is not None) and (time.monotonic() < stuckUntil):
+            self.faultCount += 1
+            if self.__stuckHang:
+                self.__unstuck.wait(None if stuckUntil == float('inf') else stuckUntil - time.monotonic())
+            else:
+                time.sleep(self.stuckTimeout)
+                raise OSError(errno.ETIMEDOUT, "Connection timed out")
+        size = sum(len(op[2]) if op[0] == 'w' else op[2] for op in ops)
+        if self.latency or self.byteTime:
+            time.sleep(self.latency + self.byteTime * size)
+
+        with self.lock:
+            self.transactionCount += 1
+            self.byteCount += size
+            rand = self.random
+            for op in ops:
+                if self.__device(op[1]) is None:
+                    raise OSError(errno.EREMOTEIO, "Remote I/O error")
+            if self.nackRate and (rand.random() < self.nackRate):
+                self.faultCount += 1
+                raise OSError(errno.EREMOTEIO, "Remote I/O error")
+            self.__update()
+
+            results = []
+            for op in ops:
+                address = op[1]
+                device = self.__device(address)
+                if op[0] == 'w':
+                    datas = op[2]
+                    if not datas:
+                        continue
+                    self.__pointers[address] = datas[0]
+                    if len(datas) > 1:
+                        if device is self.mcu:
+                            (self.mcu.writeOta if address == OTA_ADDRESS else self.mcu.write)(datas[0], datas[1:])
+                        else:
+                            device.write(datas[0], datas[1:])
+                        self.__update()
+                else:
+                    length = op[2]
+                    register = self.__pointers.get(address, 0)
+                    if self.garbageRate and (rand.random() < self.garbageRate):
+                        self.faultCount += 1
+                        datas = b'\xFF' * length
+                    elif (device is self.mcu) and (length > 1) and self.tornReadRate and (rand.random() < self.tornReadRate):
+                        self.faultCount += 1
+                        split = rand.randrange(1, length)
+                        # The rest is read from registers tornStep later, on a copy so the emulated state is untouched
+                        later = copy.deepcopy(self.mcu)
+                        later.step(self.__modelTime + self.tornStep, self.tornStep)
+                        datas = self.__read(address, register, split) + bytes(later.registers[register + split : register + length]).ljust(length - split, b'\0')
+                    else:
+                        datas = self.__read(address, register, length)
+                    if device is self.mcu:
+                        self.__pointers[address] = (register + length) & 0xFF
+                    results.append(datas)
+            return results
+
+    # smbus2.SMBus interface
+    def read_byte_data(self, i2c_addr, register, force=None):
+        return self.transfer([ ('w', i2c_addr, bytes((register,))), ('r', i2c_addr, 1) ])[0][0]
+
+    def write_byte_data(self, i2c_addr, register, value, force=None):
+        self.transfer([ ('w', i2c_addr, bytes((register, value))) ])
+
+    def read_i2c_block_data(self, i2c_addr, register, length, force=None):
+        return list(self.transfer([ ('w', i2c_addr, bytes((register,))), ('r', i2c_addr, length) ])[0])
+
+    def write_i2c_block_data(self, i2c_addr, register, data, force=None):
+        self.transfer([ ('w', i2c_addr, bytes([ register ] + list(data))) ])
+
+    def i2c_rdwr(self, *i2c_msgs):
+        ops = []
+        for msg in i2c_msgs:
+            if msg.flags & smbus2.smbus2.I2C_M_RD:
+                ops.append(('r', msg.addr, msg.len))
+            else:
+                ops.append(('w', msg.addr, ctypes.string_at(msg.buf, msg.len)))
+        results = iter(self.transfer(ops))
+        for msg in i2c_msgs:
+            if msg.flags & smbus2.smbus2.I2C_M_RD:
+                ctypes.memmove(msg.buf, next(results), msg.len)
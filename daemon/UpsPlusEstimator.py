@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+
+import math
+import logging
+
+log = logging.getLogger('UPS')
+
+class RuntimeEstimator:
+    """Online estimate of the battery runtime left at the current load, updated in O(1) per sample.
+
+    While discharging, the battery voltage is regressed against the energy drawn from the battery, by least squares
+    with exponential forgetting: voltage ~ intercept - drop * energy. The load is an exponential moving average of
+    inaBatteryPower. The runtime left is the energy left until the voltage reaches cutoffVoltage, divided by the load:
+        runtime = (fittedVoltage - cutoffVoltage) / drop / load
+    so a change of load is reflected right away, without waiting for the voltage trend to follow. The estimate is
+    reset when the battery stops discharging.
+    """
+
+    def __init__(self, cutoffVoltage, forgetting=0.99, powerTimeConstant=30.0, dischargeCurrent=0.02, minSamples=10, minEnergy=10.0):
+        self.cutoffVoltage = cutoffVoltage
+        # Weight kept by past samples on each new sample, the regression remembers about 1 / (1 - forgetting) samples
+        self.forgetting = forgetting
+        # Time constant of the load moving average, in seconds
+        self.powerTimeConstant = powerTimeConstant
+        # Battery current in A below which the battery counts as discharging
+        self.dischargeCurrent = dischargeCurrent
+        # Samples & energy in J needed before estimating
+        self.minSamples = minSamples
+        self.minEnergy = minEnergy
+        self.reset()
+
+    def reset(self):
+        self.sampleCount = 0
+        self.lastTime = None
+        # Energy drawn from the battery since discharging started, in J
+        self.energy = 0.0
+        # Load moving average in W
+        self.power = None
+        # Exponentially weighted sums of the regression of voltage (y) against energy (x)
+        self.__weight = 0.0
+        self.__sumX = 0.0
+        self.__sumY = 0.0
+        self.__sumXX = 0.0
+        self.__sumXY = 0.0
+
+    def update(self, time, status):
+        """Add a sample of an UPS status with batteryVoltage, inaBatteryCurrent & inaBatteryPower."""
+        if status['inaBatteryCurrent'] > -self.dischargeCurrent:
+            if self.sampleCount:
+                self.reset()
+            return
+        power = status['inaBatteryPower']
+        if self.lastTime is None:
+            self.power = power
+        else:
+            elapsed = max(0.0, time - self.lastTime)
+            # Trapezoid of the instant power, which is closer to the truth than the average under load steps
+            self.energy += (power + self.__lastPower) / 2 * elapsed
+            alpha = 1 - math.exp(-elapsed / self.powerTimeConstant)
+            self.power += alpha * (power - self.power)
+        self.lastTime = time
+        self.__lastPower = power
+
+        forgetting = self.forgetting
+        x = self.energy
+        y = status['batteryVoltage']
+        self.__weight = self.__weight * forgetting + 1
+        self.__sumX = self.__sumX * forgetting + x
+        self.__sumY = self.__sumY * forgetting + y
+        self.__sumXX = self.__sumXX * forgetting + x * x
+        self.__sumXY = self.__sumXY * forgetting + x * y
+        self.sampleCount += 1
+
+    def fit(self):
+        """Return (fittedVoltage, drop in V per J) at the current energy, or None before enough samples."""
+        if (self.sampleCount < self.minSamples) or (self.energy < self.minEnergy):
+            return None
+        weight = self.__weight
+        meanX = self.__sumX / weight
+        meanY = self.__sumY / weight
+        varianceX = self.__sumXX / weight - meanX * meanX
+        if varianceX <= 0:
+            return None
+        slope = (self.__sumXY / weight - meanX * meanY) / varianceX
+        return (meanY + slope * (self.energy - meanX), -slope)
+
+    def runtime(self):
+        """Return the predicted seconds left until cutoffVoltage at the current load, or None if unknown."""
+        fit = self.fit()
+        if (fit is None) or (not self.power) or (self.power <= 0):
+            return None
+        (voltage, drop) = fit
+        if drop <= 0:
+            # Voltage not dropping yet, e.g. surface charge
+            return None
+        return max(0.0, (voltage - self.cutoffVoltage) / drop / self.power)
@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+
+import re
+import math
+import asyncio
+import logging
+import UpsPlusRegisters
+
+log = logging.getLogger('UPS')
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Metric name suffix & scale of status fields by field name suffix. Fields matching none are exported as is.
+UNITS = (
+    ('Voltage', '_volts', 1),
+    ('Current', '_amperes', 1),
+    ('Power', '_watts', 1),
+    ('Temperature', '_celsius', 1),
+    ('Remaining', '_percent', 1),
+    ('RunningTime', '_seconds', 1),
+    ('ChargingTime', '_seconds', 1),
+    ('Countdown', '_seconds', 1),
+    ('samplePeriod', '_seconds', 60),
+)
+
+# Status fields exported as labels of upsplus_info instead of values
+INFO_FIELDS = ('version', 'batteryParameters', 'serialNumber')
+
+# Power input types of upsplus_power_input, '' is on battery
+POWER_INPUT_TYPES = (('TypeC', 'typec'), ('MicroUSB', 'microusb'), ('', 'battery'))
+
+# Daemon values of the shutdown policy & battery estimations: status key, metric name, help
+POLICY_METRICS = (
+    ('powerFailureTimestamp', 'upsplus_power_failure_timestamp_seconds', "Time the current power failure started"),
+    ('shutdownTimeout', 'upsplus_shutdown_timeout_seconds', "Seconds left until shutdown on the power failure timeout"),
+    ('batteryRuntime', 'upsplus_battery_runtime_seconds', "Estimated battery runtime at the current load"),
+    ('batteryCharge', 'upsplus_battery_charge_mah', "Battery charge left counted by the coulomb counter"),
+    ('batteryCapacity', 'upsplus_battery_capacity_mah', "Learned battery capacity"),
+    ('batteryStateOfHealth', 'upsplus_battery_health_percent', "Learned battery capacity in percent of the design capacity"),
+    ('batteryCycles', 'upsplus_battery_cycles', "Equivalent full battery discharge cycles"),
+)
+
+# Daemon gauges of UpsPlusDaemon.stats(): gauge name, metric name, type, help
+GAUGE_METRICS = (
+    ('sampleInterval', 'upsplus_sample_interval_seconds', 'gauge', "Current status sample interval"),
+    ('busTransactions', 'upsplus_bus_transactions_total', 'counter', "Bus transactions issued"),
+    ('schedulerWakeups', 'upsplus_scheduler_wakeups_total', 'counter', "Scheduler wake ups"),
+    ('coulombSamples', 'upsplus_coulomb_samples_total', 'counter', "Battery current samples of the coulomb counter"),
+    ('coulombErrors', 'upsplus_coulomb_errors_total', 'counter', "Battery current samples of the coulomb counter failed"),
+    ('coulombOverruns', 'upsplus_coulomb_overruns_total', 'counter', "Battery current samples of the coulomb counter late"),
+)
+
+# Label name & help of UpsPlusStats instrument families, instruments are named "<family>.<label>"
+STATS_FAMILIES = {
+    'retry': ('operation', "Bus operations retried"),
+    'failure': ('operation', "Bus operations failed after all retries"),
+    'outOfRange': ('field', "Values read out of their valid range"),
+    'busRead': ('device', "Duration of bus reads"),
+    'busWrite': ('device', "Duration of bus writes"),
+    'status': ('caller', "Duration of UPS status reads from the bus by caller, retries included"),
+    'loop': ('task', "Duration of daemon task iterations"),
+}
+
+CAMEL_PATTERN = re.compile(r'(?<=[a-z0-9])([A-Z])')
+
+def snakeCase(name):
+    return CAMEL_PATTERN.sub(r'_\1', name).lower()
+
+def fieldMetric(name):
+    """Return the metric name & scale of a status field."""
+    for (suffix, unit, scale) in UNITS:
+        if name.endswith(suffix):
+            return ('upsplus_' + snakeCase(name) + unit, scale)
+    return ('upsplus_' + snakeCase(name), 1)
+
+def fieldHelp(name):
+    field = UpsPlusRegisters.REGISTER_FIELDS.get(name)
+    if field is not None:
+        return field.label
+    return "INA219 " + snakeCase(name[len('ina'):]).replace('_', ' ')
+
+def infoLabels(upsStatus):
+    labels = {}
+    for name in INFO_FIELDS:
+        value = upsStatus.get(name)
+        if value is None:
+            labels[name] = ''
+        elif isinstance(value, tuple):
+            labels[name] = ''.join('%08X' % v for v in value)
+        else:
+            labels[name] = value
+    return labels
+
+def formatValue(value):
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, float):
+        if math.isnan(value):
+            return 'NaN'
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
+
+def escapeLabel(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+class MetricsText:
+    """Build a Prometheus text format exposition."""
+
+    def __init__(self):
+        self.lines = []
+
+    def metric(self, name, kind, help):
+        self.lines.append('# HELP %s %s' % (name, help))
+        self.lines.append('# TYPE %s %s' % (name, kind))
+
+    def sample(self, name, value, labels=None):
+        value = formatValue(value)
+        if value is None:
+            return
+        if labels:
+            name += '{%s}' % ','.join('%s="%s"' % (k, escapeLabel(v)) for (k, v) in labels.items())
+        self.lines.append('%s %s' % (name, value))
+
+    def single(self, name, kind, help, value, labels=None):
+        if formatValue(value) is not None:
+            self.metric(name, kind, help)
+            self.sample(name, value, labels)
+
+    def text(self):
+        return '\n'.join(self.lines) + '\n'
+
+
+def render(prevStatus, lastGoodTime, stats):
+    """Render the metrics of the last policy status (UpsPlusDaemon.context['prevStatus']), the time of the last good
+    status sample, and the daemon stats (UpsPlusDaemon.stats()). Return the text."""
+    out = MetricsText()
+    prevStatus = prevStatus or {}
+    upsStatus = prevStatus.get('upsStatus')
+
+    if upsStatus is not None:
+        for (name, value) in upsStatus.items():
+            if name in INFO_FIELDS:
+                continue
+            (metric, scale) = fieldMetric(name)
+            out.single(metric, 'gauge', fieldHelp(name), None if value is None else value * scale)
+        out.single('upsplus_info', 'gauge', "UPS firmware & battery parameters", 1, infoLabels(upsStatus))
+    if lastGoodTime is not None:
+        out.single('upsplus_last_sample_timestamp_seconds', 'gauge', "Time of the last good UPS status sample", lastGoodTime)
+
+    if 'powerInputType' in prevStatus:
+        out.metric('upsplus_power_input', 'gauge', "Power input in use, battery when none")
+        for (powerInputType, label) in POWER_INPUT_TYPES:
+            out.sample('upsplus_power_input', int((prevStatus['powerInputType'] or '') == powerInputType), { 'input': label })
+        out.single('upsplus_on_battery', 'gauge', "Running on battery", int(not prevStatus['powerInputType']))
+    for (key, name, help) in POLICY_METRICS:
+        out.single(name, 'gauge', help, prevStatus.get(key))
+
+    out.single('upsplus_daemon_uptime_seconds', 'gauge', "Seconds since the daemon started", round(stats['uptime'], 3))
+    gauges = stats.get('gauges', {})
+    for (key, name, kind, help) in GAUGE_METRICS:
+        out.single(name, kind, help, gauges.get(key))
+
+    families = {}
+    for (key, value) in sorted(stats['counters'].items()):
+        (family, label) = key.split('.', 1)
+        families.setdefault(family, []).append((label, value))
+    for (family, values) in families.items():
+        name = 'upsplus_' + snakeCase(family) + '_total'
+        (labelName, help) = STATS_FAMILIES.get(family, ('name', family))
+        out.metric(name, 'counter', help)
+        for (label, value) in values:
+            out.sample(name, value, { labelName: label })
+
+    families = {}
+    for (key, histogram) in sorted(stats['histograms'].items()):
+        (family, label) = key.split('.', 1)
+        families.setdefault(family, []).append((label, histogram))
+    for (family, histograms) in families.items():
+        name = 'upsplus_' + snakeCase(family) + '_seconds'
+        (labelName, help) = STATS_FAMILIES.get(family, ('name', family))
+        out.metric(name, 'histogram', help)
+        for (label, histogram) in histograms:
+            total = 0
+            for (bound, count) in zip(histogram['bounds'], histogram['counts']):
+                total += count
+                out.sample(name + '_bucket', total, { labelName: label, 'le': formatValue(float(bound)) })
+            out.sample(name + '_bucket', histogram['count'], { labelName: label, 'le': '+Inf' })
+            out.sample(name + '_sum', round(histogram['sum'], 6), { labelName: label })
+            out.sample(name + '_count', histogram['count'], { labelName: label })
+    return out.text()
+
+
+class MetricsExporter:
+    """Serve metrics over HTTP on the event loop.
+
+    The text is rendered by render() on the first scrape after invalidate(), and served as is to later scrapes, so
+    scrapes never touch the bus and cost nothing more than a socket write until the next status sample.
+    """
+
+    # Max time to receive a request
+    REQUEST_TIMEOUT = 5
+
+    def __init__(self, render, address='', port=0):
+        self.render = render
+        self.address = address
+        self.port = port
+        self.scrapeCount = 0
+        self.renderCount = 0
+        self.__body = None
+        self.__server = None
+
+    def invalidate(self):
+        self.__body = None
+
+    def body(self):
+        if self.__body is None:
+            self.__body = self.render().encode('utf-8')
+            self.renderCount += 1
+        return self.__body
+
+    async def start(self):
+        self.__server = await asyncio.start_server(self.handle, self.address or None, self.port)
+
+    def close(self):
+        if self.__server is not None:
+            self.__server.close()
+            self.__server = None
+
+    async def handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b'\r\n\r\n'), self.REQUEST_TIMEOUT)
+            (method, path) = request.split(b' ', 2)[:2]
+            path = path.split(b'?', 1)[0]
+            if method not in (b'GET', b'HEAD'):
+                self.respond(writer, 405, 'Method Not Allowed', b'Method not allowed\n', head=False)
+            elif path == b'/metrics':
+                self.scrapeCount += 1
+                self.respond(writer, 200, 'OK', self.body(), method == b'HEAD', CONTENT_TYPE)
+            elif path == b'/':
+                self.respond(writer, 200, 'OK', b'UPS Plus exporter, metrics at /metrics\n', method == b'HEAD')
+            else:
+                self.respond(writer, 404, 'Not Found', b'Not found\n', method == b'HEAD')
+            await writer.drain()
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError, ConnectionError):
+            pass
+        except Exception:
+            log.exception("Error serve metrics")
+        finally:
+            writer.close()
+
+    def respond(self, writer, code, reason, body, head=False, contentType='text/plain; charset=utf-8'):
+        writer.write(('HTTP/1.1 %d %s\r\nContent-Type: %s\r\nContent-Length: %d\r\nConnection: close\r\n\r\n'
+                      % (code, reason, contentType, len(body))).encode('ascii'))
+        if not head:
+            writer.write(body)
@@ -0,0 +1,232 @@
+#!/usr/bin/env python3
+
+import time
+import ctypes
+import struct
+import logging
+import smbus2
+import UpsPlusStats
+from UpsPlusRegisters import DataOutOfRangeError
+
+log = logging.getLogger('UPS')
+
+REG_CONFIG = 0x00
+REG_SHUNT_VOLTAGE = 0x01
+REG_BUS_VOLTAGE = 0x02
+REG_POWER = 0x03
+REG_CURRENT = 0x04
+REG_CALIBRATION = 0x05
+
+# Registers read on every sample, in this order
+SAMPLE_REGISTERS = (REG_SHUNT_VOLTAGE, REG_BUS_VOLTAGE, REG_POWER, REG_CURRENT)
+SAMPLE_STRUCT = struct.Struct('>hHHh')
+# Registers read on every fast sample, see Ina219.readFast()
+FAST_REGISTERS = (REG_BUS_VOLTAGE, REG_CURRENT)
+FAST_STRUCT = struct.Struct('>Hh')
+
+# Bus voltage range in volts: BRNG bit
+VOLTAGE_RANGES = { 16: 0, 32: 1 }
+# Shunt voltage range (PGA gain) in volts, by PG bits
+GAIN_VOLTS = (0.04, 0.08, 0.16, 0.32)
+GAIN_AUTO = -1
+# ADC setting by number of samples averaged, with the conversion time in seconds. 1 sample is a 12 bit conversion.
+ADC_SAMPLES = {
+    1: (0x3, 0.000532),
+    2: (0x9, 0.00106),
+    4: (0xA, 0.00213),
+    8: (0xB, 0.00426),
+    16: (0xC, 0.00851),
+    32: (0xD, 0.01702),
+    64: (0xE, 0.03405),
+    128: (0xF, 0.0681),
+}
+
+MODE_POWER_DOWN = 0x0
+MODE_TRIGGERED = 0x3
+MODE_CONTINUOUS = 0x7
+
+BUS_VOLTAGE_LSB = 0.004
+SHUNT_VOLTAGE_LSB = 0.01
+CALIBRATION_FACTOR = 0.04096
+CALIBRATION_MAX = 0xFFFE
+CURRENT_LSB_FACTOR = 32800
+
+BUS_VOLTAGE_OVF = 0x1
+BUS_VOLTAGE_CNVR = 0x2
+
+class Ina219:
+    """INA219 current sensor driver sharing the bus of the UPS device.
+
+    A sample of shunt voltage, bus voltage, power and current is read with a single combined transfer of 4
+    register reads (INA219 doesn't auto increment the register pointer). In triggered mode the sensor converts only
+    when sampled and stays powered down in between, trading a conversion wait per sample for idle power.
+
+    gain is the shunt voltage range in volts (one of GAIN_VOLTS) or GAIN_AUTO to start at the lowest range and step
+    up on current overflow. adcSamples is the number of 12 bit samples averaged per conversion (see ADC_SAMPLES).
+    """
+
+    def __init__(self, bus, address, shuntOhms, voltageRange=32, gain=GAIN_AUTO, adcSamples=1, triggered=False, combinedTransfer=True):
+        if voltageRange not in VOLTAGE_RANGES:
+            raise ValueError("Invalid INA219 voltage range: %s, must be one of: %s" % (voltageRange, list(VOLTAGE_RANGES)))
+        if (gain != GAIN_AUTO) and (gain not in GAIN_VOLTS):
+            raise ValueError("Invalid INA219 gain: %s, must be one of: %s" % (gain, list(GAIN_VOLTS)))
+        if adcSamples not in ADC_SAMPLES:
+            raise ValueError("Invalid INA219 ADC samples: %s, must be one of: %s" % (adcSamples, list(ADC_SAMPLES)))
+
+        self.bus = bus
+        self.address = address
+        self.shuntOhms = shuntOhms
+        self.voltageRange = voltageRange
+        self.autoGain = gain == GAIN_AUTO
+        self.gain = 0 if self.autoGain else GAIN_VOLTS.index(gain)
+        self.adcSamples = adcSamples
+        self.triggered = triggered
+        self.combinedTransfer = combinedTransfer
+        # Seconds to wait for a triggered conversion of both shunt & bus voltage
+        self.conversionTime = 2 * ADC_SAMPLES[adcSamples][1]
+
+        self.currentLsb = None
+        self.powerLsb = None
+        # Last sample: shunt voltage (mV), bus voltage (V), current (mA) & power (mW)
+        self.shuntVoltage = 0.0
+        self.voltage = 0.0
+        self.current = 0.0
+        self.power = 0.0
+
+        self.transactionCount = 0
+
+        # Sample registers read in place by combined transfer
+        self.__buffer = bytearray(SAMPLE_STRUCT.size)
+        msgs = []
+        for i, register in enumerate(SAMPLE_REGISTERS):
+            msgs.append(smbus2.i2c_msg.write(address, [ register ]))
+            msgs.append(smbus2.i2c_msg(addr=address, flags=smbus2.smbus2.I2C_M_RD, len=2,
+                                       buf=(ctypes.c_char * 2).from_buffer(self.__buffer, i * 2)))
+        # Combined transfer messages to read a sample, may be merged with those of other sensors
+        self.msgs = tuple(msgs)
+
+        self.__fastBuffer = bytearray(FAST_STRUCT.size)
+        fastMsgs = []
+        for i, register in enumerate(FAST_REGISTERS):
+            fastMsgs.append(smbus2.i2c_msg.write(address, [ register ]))
+            fastMsgs.append(smbus2.i2c_msg(addr=address, flags=smbus2.smbus2.I2C_M_RD, len=2,
+                                           buf=(ctypes.c_char * 2).from_buffer(self.__fastBuffer, i * 2)))
+        self.__fastMsgs = tuple(fastMsgs)
+
+    def configure(self):
+        """Write calibration & configuration. In triggered mode the sensor is left powered down."""
+        maxAmps = GAIN_VOLTS[self.gain] / self.shuntOhms
+        self.currentLsb = max(maxAmps / CURRENT_LSB_FACTOR, CALIBRATION_FACTOR / (self.shuntOhms * CALIBRATION_MAX))
+        self.powerLsb = self.currentLsb * 20
+        self.writeRegister(REG_CALIBRATION, int(CALIBRATION_FACTOR / (self.currentLsb * self.shuntOhms)))
+        self.writeRegister(REG_CONFIG, self.configuration(MODE_POWER_DOWN if self.triggered else MODE_CONTINUOUS))
+        log.debug("Configure INA219[0x%02X]: range[%dV] gain[%.2fV] adcSamples[%d] triggered[%s]",
+                  self.address, self.voltageRange, GAIN_VOLTS[self.gain], self.adcSamples, self.triggered)
+
+    def ensureConfigured(self):
+        """Configure the sensor if it wasn't, e.g. when configure() failed on a bus error: samples can't be scaled
+        without the calibration, and the sampling caller gets the bus error of configure() instead."""
+        if self.currentLsb is None:
+            self.configure()
+
+    def configuration(self, mode):
+        adc = ADC_SAMPLES[self.adcSamples][0]
+        return (VOLTAGE_RANGES[self.voltageRange] << 13) | (self.gain << 11) | (adc << 7) | (adc << 3) | mode
+
+    def trigger(self):
+        """Start a single conversion in triggered mode."""
+        self.writeRegister(REG_CONFIG, self.configuration(MODE_TRIGGERED))
+
+    def writeRegister(self, register, value):
+        self.transactionCount += 1
+        self.bus.write_i2c_block_data(self.address, register, [ (value >> 8) & 0xFF, value & 0xFF ])
+
+    def readSample(self):
+        """Read a sample of this sensor alone. Return (voltage, current, power) in V, mA & mW."""
+        self.ensureConfigured()
+        if self.triggered:
+            self.trigger()
+            time.sleep(self.conversionTime)
+        self.readRegisters()
+        return self.update()
+
+    def readFast(self):
+        """Read bus voltage & current only, into voltage & current, for high rate sampling.
+
+        Takes a single combined transfer into a preallocated buffer. Falls back to readSample() in triggered mode,
+        without combined transfer support, and on current overflow.
+        """
+        self.ensureConfigured()
+        if self.triggered or not self.combinedTransfer:
+            self.readSample()
+            return
+        self.transactionCount += 1
+        self.bus.i2c_rdwr(*self.__fastMsgs)
+        (bus, current) = FAST_STRUCT.unpack_from(self.__fastBuffer)
+        if bus & BUS_VOLTAGE_OVF:
+            self.readSample()
+            return
+        self.voltage = (bus >> 3) * BUS_VOLTAGE_LSB
+        self.current = current * self.currentLsb * 1000
+
+    def readRegisters(self):
+        """Read the sample registers into the buffer, see update()."""
+        if self.combinedTransfer:
+            self.transactionCount += 1
+            self.bus.i2c_rdwr(*self.msgs)
+        else:
+            for i, register in enumerate(SAMPLE_REGISTERS):
+                self.transactionCount += 1
+                self.__buffer[i * 2 : i * 2 + 2] = bytes(self.bus.read_i2c_block_data(self.address, register, 2))
+
+    def update(self):
+        """Decode the sample registers read by readRegisters() or the combined transfer of msgs.
+
+        Return (voltage, current, power) in V, mA & mW. On current overflow, step up the gain with auto gain and
+        read again, otherwise raise DataOutOfRangeError.
+        """
+        (shunt, bus, power, current) = SAMPLE_STRUCT.unpack_from(self.__buffer)
+        if self.triggered and not (bus & BUS_VOLTAGE_CNVR):
+            # Conversion took longer than specified, wait for one more conversion time
+            time.sleep(self.conversionTime)
+            self.readRegisters()
+            (shunt, bus, power, current) = SAMPLE_STRUCT.unpack_from(self.__buffer)
+        if bus & BUS_VOLTAGE_OVF:
+            if (not self.autoGain) or (self.gain >= len(GAIN_VOLTS) - 1):
+                UpsPlusStats.counter('outOfRange.ina%02X' % self.address).inc()
+                raise DataOutOfRangeError("INA219[0x%02X] current overflow on gain %.2fV" % (self.address, GAIN_VOLTS[self.gain]))
+            self.gain += 1
+            log.info("INA219[0x%02X] current overflow, increase gain to %.2fV", self.address, GAIN_VOLTS[self.gain])
+            self.configure()
+            # New configuration takes effect after 1ms
+            time.sleep(0.001)
+            return self.readSample()
+
+        self.shuntVoltage = shunt * SHUNT_VOLTAGE_LSB
+        self.voltage = (bus >> 3) * BUS_VOLTAGE_LSB
+        self.current = current * self.currentLsb * 1000
+        self.power = power * self.powerLsb * 1000
+        return (self.voltage, self.current, self.power)
+
+
+def readSamples(sensors):
+    """Read a sample of each sensor with as few transactions as possible, the sensors must share a bus.
+
+    Return the (voltage, current, power) tuple of each sensor.
+    """
+    triggered = [ sensor for sensor in sensors if sensor.triggered ]
+    for sensor in triggered:
+        sensor.trigger()
+    if triggered:
+        time.sleep(max(sensor.conversionTime for sensor in triggered))
+
+    if all(sensor.combinedTransfer for sensor in sensors):
+        msgs = []
+        for sensor in sensors:
+            msgs.extend(sensor.msgs)
+        sensors[0].transactionCount += 1
+        sensors[0].bus.i2c_rdwr(*msgs)
+    else:
+        for sensor in sensors:
+            sensor.readRegisters()
+    return [ sensor.update() for sensor in sensors ]
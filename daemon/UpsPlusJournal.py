@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import mmap
+import time
+import struct
+import logging
+import UpsPlusRegisters
+
+log = logging.getLogger('UPS')
+
+# Segment file header: magic, format version, record size
+HEADER = struct.Struct('<4sHH')
+MAGIC = b'UPSJ'
+VERSION = 1
+
+# Live register window stored in each record
+REGISTER_START = 0x01
+REGISTER_END = 0x28
+
+# Record: time (seconds, milliseconds), flags, live registers, then voltage (mV), current (mA) & power (mW) of the
+# output and battery INA219.
+RECORD = struct.Struct('<IHB%dsHhHHhH' % (REGISTER_END - REGISTER_START))
+
+# Record flags
+FLAG_POWER_FAILURE = 0x01
+FLAG_SHUTDOWN = 0x02
+
+SEGMENT_PREFIX = 'upsplus-'
+SEGMENT_SUFFIX = '.journal'
+
+class JournalWriter:
+    """Append-only journal of fixed-size binary UPS status records, in size-rotated segment files.
+
+    Appends are buffered and synced to disk by sync(), which the caller runs periodically. A segment is rotated
+    when it reaches segmentSize bytes, and the oldest segments beyond maxSegments are removed.
+    """
+
+    def __init__(self, path, segmentSize=1024 * 1024, maxSegments=8):
+        self.path = path
+        self.segmentSize = max(segmentSize, HEADER.size + RECORD.size)
+        self.maxSegments = maxSegments
+        self.file = None
+        self.fileSize = 0
+        self.recordCount = 0
+        # Registers of the record, 0x00 - 0xFB packed from the status
+        self.__registers = bytearray(UpsPlusRegisters.REGISTER_STRUCT.size)
+        self.__record = bytearray(RECORD.size)
+        os.makedirs(self.path, exist_ok=True)
+
+    def append(self, timestamp, status, flags=0):
+        """Append the status (UpsStatus with INA219 readings) read at timestamp."""
+        if (self.file is None) or (self.fileSize + RECORD.size > self.segmentSize):
+            self.rotate(timestamp)
+
+        status.packInto(self.__registers)
+        RECORD.pack_into(self.__record, 0,
+            int(timestamp), int(timestamp * 1000) % 1000, flags,
+            bytes(self.__registers[REGISTER_START : REGISTER_END]),
+            _clip(round(status['inaOutputVoltage'] * 1000), 0, 0xFFFF),
+            _clip(round(status['inaOutputCurrent'] * 1000), -0x8000, 0x7FFF),
+            _clip(round(status['inaOutputPower'] * 1000), 0, 0xFFFF),
+            _clip(round(status['inaBatteryVoltage'] * 1000), 0, 0xFFFF),
+            _clip(round(status['inaBatteryCurrent'] * 1000), -0x8000, 0x7FFF),
+            _clip(round(status['inaBatteryPower'] * 1000), 0, 0xFFFF))
+        self.file.write(self.__record)
+        self.fileSize += RECORD.size
+        self.recordCount += 1
+
+    def rotate(self, timestamp):
+        self.close()
+        segmentPath = os.path.join(self.path, '%s%010d%s' % (SEGMENT_PREFIX, int(timestamp), SEGMENT_SUFFIX))
+        self.file = open(segmentPath, 'ab')
+        self.fileSize = self.file.tell()
+        if self.fileSize == 0:
+            self.file.write(HEADER.pack(MAGIC, VERSION, RECORD.size))
+            self.fileSize = HEADER.size
+        log.info("Open journal segment: %s", segmentPath)
+
+        segments = listSegments(self.path)
+        for segment in segments[: max(0, len(segments) - self.maxSegments)]:
+            log.info("Remove journal segment: %s", segment)
+            os.remove(segment)
+
+    def sync(self):
+        """Flush buffered records and fsync the segment file."""
+        if self.file:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self):
+        if self.file:
+            self.sync()
+            self.file.close()
+            self.file = None
+
+
+class JournalReader:
+    """Read journal records through memory mapped segment files."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def records(self, since=None, until=None):
+        """Yield (timestamp, flags, status) of records with since <= timestamp < until, oldest first."""
+        for segment in listSegments(self.path):
+            yield from self.__readSegment(segment, since, until)
+
+    def __readSegment(self, segment, since, until):
+        with open(segment, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size < HEADER.size + RECORD.size:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                (magic, version, recordSize) = HEADER.unpack_from(mm)
+                if (magic != MAGIC) or (version != VERSION) or (recordSize != RECORD.size):
+                    log.warning("Skip journal segment with unknown format: %s", segment)
+                    return
+                # Ignore a partial record at the end of an unclean segment
+                count = (size - HEADER.size) // RECORD.size
+                begin = 0 if since is None else self.__bisect(mm, count, since)
+                registers = bytearray(UpsPlusRegisters.REGISTER_STRUCT.size)
+                for i in range(begin, count):
+                    record = RECORD.unpack_from(mm, HEADER.size + i * RECORD.size)
+                    timestamp = record[0] + record[1] / 1000
+                    if (until is not None) and (timestamp >= until):
+                        return
+                    registers[REGISTER_START : REGISTER_END] = record[3]
+                    ina = (record[4] / 1000, record[5], record[6], record[7] / 1000, record[8], record[9])
+                    yield (timestamp, record[2], JOURNAL_FIELDS.decode(registers, ina, validate=False))
+
+    def __bisect(self, mm, count, since):
+        lo = 0
+        hi = count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            (seconds, millis) = struct.unpack_from('<IH', mm, HEADER.size + mid * RECORD.size)
+            if seconds + millis / 1000 < since:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+
+# Fields stored in journal records
+JOURNAL_FIELDS = UpsPlusRegisters.FieldSet(
+    [ field.name for field in UpsPlusRegisters.INA_MAP ] +
+    [ field.name for field in UpsPlusRegisters.REGISTER_MAP if REGISTER_START <= field.offset and field.offset + field.size <= REGISTER_END ])
+
+def listSegments(path):
+    if not os.path.isdir(path):
+        return []
+    names = sorted(name for name in os.listdir(path) if name.startswith(SEGMENT_PREFIX) and name.endswith(SEGMENT_SUFFIX))
+    return [ os.path.join(path, name) for name in names ]
+
+def _clip(value, minimum, maximum):
+    return min(max(value, minimum), maximum)
+
+
+def main(argv):
+    """Dump journal records as tab separated values: journal path, optional since and until as epoch seconds."""
+    if len(argv) < 2:
+        print("Usage: %s <journal path> [since] [until]" % argv[0])
+        return 1
+    since = float(argv[2]) if len(argv) > 2 else None
+    until = float(argv[3]) if len(argv) > 3 else None
+
+    print('\t'.join(('time', 'flags') + JOURNAL_FIELDS.names))
+    for (timestamp, flags, status) in JournalReader(argv[1]).records(since, until):
+        values = [ time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(timestamp)), str(flags) ]
+        values.extend(str(value) for (_, value) in status.items())
+        print('\t'.join(values))
+    return 0
+
+if __name__=="__main__":
+    sys.exit(main(sys.argv))
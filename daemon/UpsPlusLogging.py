@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import queue
+import logging
+from logging.handlers import TimedRotatingFileHandler, QueueHandler, QueueListener
+
+log = logging.getLogger('UPS')
+
+LOG_FORMAT = '%(asctime)s [%(name)s][%(levelname)-4s] - %(message)s'
+
+# Default deadband of fields by name suffix, in the unit of the field. Fields without a deadband are not tracked.
+DEADBANDS = {
+    'Voltage': 0.05,
+    'Current': 0.05,
+    'Power': 0.25,
+    'Temperature': 1,
+    'Remaining': 1,
+}
+
+# Settings fields, tracked on any change
+SETTING_FIELDS = (
+    'batteryFullVoltage', 'batteryEmptyVoltage', 'batteryProtectionVoltage', 'samplePeriod', 'shutdownCountdown',
+    'autoPowerOn', 'restartCountdown', 'batteryParameters', 'version',
+)
+
+def setupLogging(logFilePath, level=logging.INFO):
+    """Log to a daily rotated file and the console through a queue, so log I/O never blocks the caller.
+
+    Return the started QueueListener; stop it on exit to flush queued records.
+    """
+    os.makedirs(os.path.dirname(logFilePath), exist_ok=True)
+
+    logFileHandler = TimedRotatingFileHandler(logFilePath, when='D', interval=1, backupCount=7, encoding='utf-8', utc=True)
+    logStreamHandler = logging.StreamHandler()
+    formatter = logging.Formatter(LOG_FORMAT)
+    formatter.converter = time.gmtime
+    for handler in (logFileHandler, logStreamHandler):
+        handler.setFormatter(formatter)
+
+    logQueue = queue.SimpleQueue()
+    queueHandler = QueueHandler(logQueue)
+    # Records are formatted by the listener handlers, the queue handler only merges the message arguments
+    queueHandler.setFormatter(logging.Formatter('%(message)s'))
+    logging.basicConfig(level=level, handlers=[queueHandler])
+    listener = QueueListener(logQueue, logFileHandler, logStreamHandler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+
+class ChangeLogger:
+    """Log UPS status fields only when they changed by more than a deadband since last logged.
+
+    deadbands maps a field name suffix (see DEADBANDS) to its deadband. Changed fields of a status are logged in
+    one structured line of key=value pairs, also passed as the 'ups' attribute of the log record.
+    """
+
+    def __init__(self, deadbands=DEADBANDS):
+        self.deadbands = dict(deadbands)
+        # Logged value of tracked fields
+        self.values = {}
+        self.changeCount = 0
+        self.__fieldDeadbands = {}
+
+    def deadband(self, name):
+        if name not in self.__fieldDeadbands:
+            deadband = 0 if name in SETTING_FIELDS else None
+            for (suffix, value) in self.deadbands.items():
+                if name.endswith(suffix):
+                    deadband = value
+                    break
+            self.__fieldDeadbands[name] = deadband
+        return self.__fieldDeadbands[name]
+
+    def update(self, status):
+        """Log the fields of status out of deadband. Return the dict of changed fields."""
+        changes = {}
+        for (name, value) in status.items():
+            deadband = self.deadband(name)
+            if (deadband is None) or (value is None):
+                continue
+            prevValue = self.values.get(name)
+            if prevValue is None:
+                changed = True
+            elif isinstance(value, (int, float)) and isinstance(prevValue, (int, float)):
+                changed = abs(value - prevValue) > deadband
+            else:
+                changed = value != prevValue
+            if changed:
+                changes[name] = value
+                self.values[name] = value
+
+        if changes:
+            self.changeCount += 1
+            log.info("UPS change: %s", formatFields(changes), extra={'ups': changes})
+        return changes
+
+def formatFields(fields):
+    return ' '.join('%s=%s' % (k, round(v, 3) if isinstance(v, float) else v) for (k, v) in fields.items())
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+import logging
+import UpsPlusRegisters
+
+log = logging.getLogger('UPS')
+
+class RegisterReconciler:
+    """Keep UPS setting registers at a desired state.
+
+    The desired state is held in raw register units, and compared with the device snapshot as is, so a value
+    that doesn't round trip through its scale never causes a write. Dirty registers next to each other are written
+    in one block, then read back to verify.
+    """
+
+    def __init__(self, ups):
+        self.ups = ups
+        # Desired raw value by field name
+        self.desired = {}
+        self.writeCount = 0
+
+    def setDesired(self, name, value):
+        """Set the desired value of a field, in the unit of the field (e.g. volts)."""
+        field = UpsPlusRegisters.REGISTER_FIELDS[name]
+        raw = field.encode(value)
+        field.check(raw)
+        self.desired[name] = raw
+
+    def clearDesired(self, name):
+        """Stop keeping a field at a desired value."""
+        self.desired.pop(name, None)
+
+    def diff(self, status):
+        """Return [(field, raw)] of the desired fields that differ from status, ordered by register."""
+        dirty = []
+        for (name, raw) in self.desired.items():
+            if status.raw(name) != raw:
+                dirty.append((UpsPlusRegisters.REGISTER_FIELDS[name], raw))
+        dirty.sort(key=lambda item: item[0].offset)
+        return dirty
+
+    def reconcile(self, maxAge=None):
+        """Write the desired fields that differ from the device and verify them. Return the number of fields written.
+
+        The device state is read through the snapshot, so with the default maxAge this costs no bus transaction
+        unless something has to be written.
+        """
+        if not self.desired:
+            return 0
+        fields = tuple(self.desired)
+        dirty = self.diff(self.ups.getStatus(fields, maxAge=maxAge, name='reconcile'))
+        if not dirty:
+            return 0
+
+        for (register, datas) in _mergeBlocks(dirty):
+            self.ups.writeRegister(register, datas if len(datas) > 1 else datas[0])
+            self.writeCount += 1
+
+        # Read back the written registers from the bus
+        status = self.ups.getStatus(tuple(field.name for (field, _) in dirty), maxAge=0, name='reconcile')
+        failed = self.diff(status)
+        for (field, raw) in dirty:
+            if any(field is failedField for (failedField, _) in failed):
+                log.error("Verify UPS %s failed: expected %s, read %s", field.name, field.formatValue(raw), field.formatValue(status.raw(field.name)))
+            else:
+                log.info("Set UPS %s to %s", field.name, field.formatValue(raw))
+        return len(dirty)
+
+def _mergeBlocks(dirty):
+    """Merge dirty fields on adjacent registers into [(register, [byte])] block writes."""
+    blocks = []
+    for (field, raw) in dirty:
+        datas = list(field.struct.pack(raw))
+        if blocks and (blocks[-1][0] + len(blocks[-1][1]) == field.offset):
+            blocks[-1][1].extend(datas)
+        else:
+            blocks.append((field.offset, datas))
+    return blocks
@@ -0,0 +1,326 @@
+#!/usr/bin/env python3
+
+import struct
+import UpsPlusStats
+
+
+class DataOutOfRangeError(Exception):
+    pass
+
+
+class RegisterField:
+    """A value stored in the UPS MCU register map.
+
+    The raw value is scaled by `scale` and rounded to `digits` on decode. Fields without a scale are decoded as
+    raw integers. The valid range is given in decoded units and checked against the raw value, so validation
+    never needs to decode a field. Static fields never change at runtime and only need to be read once.
+    """
+
+    __slots__ = ('name', 'offset', 'format', 'label', 'scale', 'digits', 'minimum', 'maximum', 'invalid', 'static',
+                 'struct', 'count', 'index', 'rawMin', 'rawMax')
+
+    def __init__(self, name, offset, format, label, scale=None, digits=2, minimum=None, maximum=None, invalid=None, static=False):
+        self.name = name
+        self.offset = offset
+        self.format = format
+        self.label = label
+        self.scale = None if scale is None else float(scale)
+        self.digits = digits
+        self.minimum = minimum
+        self.maximum = maximum
+        self.invalid = invalid
+        self.static = static
+
+        self.struct = struct.Struct('<' + format)
+        self.count = len(self.struct.unpack(bytes(self.struct.size)))
+        # Position of the field in the tuple unpacked by REGISTER_STRUCT
+        self.index = None
+        self.rawMin = None if minimum is None else round(minimum / (scale or 1))
+        self.rawMax = None if maximum is None else round(maximum / (scale or 1))
+
+    @property
+    def size(self):
+        return self.struct.size
+
+    def decode(self, raw):
+        if self.count > 1:
+            return '-'.join(["%08X" % value for value in raw])
+        if self.scale is None:
+            return raw
+        return round(raw * self.scale, self.digits)
+
+    def read(self, buffer):
+        """Decode the field directly from a register buffer indexed by register address."""
+        raw = self.struct.unpack_from(buffer, self.offset)
+        return self.decode(raw if self.count > 1 else raw[0])
+
+    def encode(self, value):
+        """Convert a decoded value to the raw register value."""
+        if self.scale is None:
+            return int(value)
+        return round(value / self.scale)
+
+    def check(self, raw):
+        if (self.invalid is not None) and (raw == self.invalid):
+            raise DataOutOfRangeError("%s %s out of range" % (self.label, self.formatValue(raw)))
+        if (self.rawMin is not None) and (raw < self.rawMin or raw > self.rawMax):
+            raise DataOutOfRangeError("%s %s out of range [%s, %s]" % (self.label, self.formatValue(raw), self.minimum, self.maximum))
+
+    def formatValue(self, raw):
+        if self.count > 1:
+            return self.decode(raw)
+        if self.scale is None:
+            return "%d" % raw
+        if self.scale >= 1:
+            return "%.0f" % self.decode(raw)
+        return "%.2f" % self.decode(raw)
+
+
+REGISTER_MAP = (
+    RegisterField('mcuVoltage',               0x01, 'H',  "MCU voltage",                scale=0.001, minimum=2.4, maximum=3.6),
+    RegisterField('pogoPinVoltage',           0x03, 'H',  "Pogo pin voltage",           scale=0.001, minimum=0, maximum=5.5),
+    RegisterField('batteryVoltage',           0x05, 'H',  "Battery voltage",            scale=0.001, minimum=0, maximum=4.5),
+    RegisterField('typecVoltage',             0x07, 'H',  "TypeC voltage",              scale=0.001, minimum=0, maximum=13.5),
+    RegisterField('microUsbVoltage',          0x09, 'H',  "MicroUSB voltage",           scale=0.001, minimum=0, maximum=13.5),
+    RegisterField('batteryTemperature',       0x0B, 'H',  "Battery temperature",        scale=1, minimum=-20, maximum=65),
+    RegisterField('batteryFullVoltage',       0x0D, 'H',  "Battery full voltage",       scale=0.001, minimum=0, maximum=4.5),
+    RegisterField('batteryEmptyVoltage',      0x0F, 'H',  "Battery empty voltage",      scale=0.001, minimum=0, maximum=4.5),
+    RegisterField('batteryProtectionVoltage', 0x11, 'H',  "Battery protection voltage", scale=0.001, minimum=0, maximum=4.5),
+    RegisterField('batteryRemaining',         0x13, 'H',  "Battery remaining",          scale=1, minimum=0, maximum=100),
+    RegisterField('samplePeriod',             0x15, 'H',  "Sample period",              minimum=1, maximum=1440),
+    RegisterField('powerStatus',              0x17, 'B',  "Power status",               minimum=0, maximum=1),
+    RegisterField('shutdownCountdown',        0x18, 'B',  "Shutdown countdown",         minimum=0, maximum=255),
+    RegisterField('autoPowerOn',              0x19, 'B',  "Auto power on",              minimum=0, maximum=1),
+    RegisterField('restartCountdown',         0x1A, 'B',  "Restart countdown",          minimum=0, maximum=255),
+    RegisterField('reset',                    0x1B, 'B',  "Reset",                      minimum=0, maximum=1),
+    RegisterField('accumulatedRunningTime',   0x1C, 'I',  "Accumulated running time",   minimum=0, maximum=2147483647),
+    RegisterField('accumulatedChargingTime',  0x20, 'I',  "Accumulated charging time",  minimum=0, maximum=2147483647),
+    RegisterField('currentRunningTime',       0x24, 'I',  "Current running time",       minimum=0, maximum=2147483647),
+    RegisterField('version',                  0x28, 'H',  "Version",                    invalid=0xFFFF, static=True),
+    RegisterField('batteryParameters',        0x2A, 'B',  "Battery parameters",         invalid=0xFF, static=True),
+    RegisterField('serialNumber',             0xF0, '3I', "Serial number",              invalid=(0xFFFFFFFF, 0xFFFFFFFF, 0xFFFFFFFF), static=True),
+)
+REGISTER_FIELDS = { field.name: field for field in REGISTER_MAP }
+
+# Max gap in bytes between two fields still read in the same window. Reading a few unused registers is cheaper
+# than starting another transfer.
+WINDOW_MERGE_GAP = 16
+
+
+class InaField:
+    """A value read from one of the INA219 sensors, stored as returned by the sensor and scaled on decode."""
+
+    __slots__ = ('name', 'scale', 'digits', 'index')
+
+    def __init__(self, name, scale, digits):
+        self.name = name
+        self.scale = scale
+        self.digits = digits
+        self.index = None
+
+    def decode(self, raw):
+        return round(raw * self.scale, self.digits)
+
+
+INA_FIELDS = {}
+INA_MAP = (
+    InaField('inaOutputVoltage',  1,     2),
+    InaField('inaOutputCurrent',  0.001, 3),
+    InaField('inaOutputPower',    0.001, 3),
+    InaField('inaBatteryVoltage', 1,     2),
+    InaField('inaBatteryCurrent', 0.001, 3),
+    InaField('inaBatteryPower',   0.001, 3),
+)
+
+
+def _compileRegisterStruct(fields):
+    """Compile the register map into a single struct covering all fields, padding the gaps between them."""
+    fmt = '<'
+    offset = 0
+    index = 0
+    for field in sorted(fields, key=lambda f: f.offset):
+        if field.offset < offset:
+            raise ValueError("Register field %s overlaps previous field" % field.name)
+        if field.offset > offset:
+            fmt += '%dx' % (field.offset - offset)
+        fmt += field.format
+        field.index = index
+        offset = field.offset + field.size
+        index += field.count
+    return struct.Struct(fmt)
+
+REGISTER_STRUCT = _compileRegisterStruct(REGISTER_MAP)
+
+for i, field in enumerate(INA_MAP):
+    field.index = i
+    INA_FIELDS[field.name] = field
+
+
+class _RegisterValue:
+    __slots__ = ('field',)
+
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, status, owner):
+        if status is None:
+            return self
+        field = self.field
+        if field.count > 1:
+            return field.decode(status._raw[field.index : field.index + field.count])
+        return field.decode(status._raw[field.index])
+
+
+class _InaValue:
+    __slots__ = ('field',)
+
+    def __init__(self, field):
+        self.field = field
+
+    def __get__(self, status, owner):
+        if status is None:
+            return self
+        if status._ina is None:
+            return None
+        return self.field.decode(status._ina[self.field.index])
+
+
+class UpsStatus:
+    """UPS status decoded lazily from raw register and INA219 values.
+
+    Fields are available as attributes as well as by key (status['batteryVoltage']), and are only scaled when
+    accessed. keys() lists the fields the status was read for, other keys raise KeyError.
+    """
+
+    __slots__ = ('_raw', '_ina', '_names')
+
+    def __init__(self, raw, ina=None, names=None):
+        self._raw = raw
+        self._ina = ina
+        self._names = names if names is not None else ALL_FIELDS.names
+
+    def __getitem__(self, key):
+        # Fields outside of the set read would return stale snapshot values
+        if key not in self._names:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in self._names
+
+    def __iter__(self):
+        return iter(self._names)
+
+    def __len__(self):
+        return len(self._names)
+
+    def __repr__(self):
+        return 'UpsStatus(%r)' % self.asDict()
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return self._names
+
+    def items(self):
+        return ((key, getattr(self, key)) for key in self._names)
+
+    def asDict(self):
+        return dict(self.items())
+
+    def raw(self, key):
+        """Return the raw register value of a field, e.g. millivolts for voltages."""
+        field = REGISTER_FIELDS[key]
+        if field.count > 1:
+            return self._raw[field.index : field.index + field.count]
+        return self._raw[field.index]
+
+    def inaValues(self):
+        """Return the raw INA219 readings in INA_MAP order, or None if the status was read without them."""
+        return self._ina
+
+    def packInto(self, buffer, offset=0):
+        """Pack the raw register values back into a register buffer indexed by register address."""
+        REGISTER_STRUCT.pack_into(buffer, offset, *self._raw)
+
+for field in REGISTER_MAP:
+    setattr(UpsStatus, field.name, _RegisterValue(field))
+for field in INA_MAP:
+    setattr(UpsStatus, field.name, _InaValue(field))
+
+
+class FieldSet:
+    """A set of status fields, precompiled into the register windows that hold them and the checks to run on them.
+
+    names is an iterable of field names from REGISTER_MAP and INA_MAP, or None for all fields.
+    """
+
+    __slots__ = ('names', 'registerFields', 'inaFields', 'staticNames', '_checks', '_multiChecks')
+
+    def __init__(self, names=None):
+        if names is None:
+            names = [ field.name for field in INA_MAP ] + [ field.name for field in REGISTER_MAP ]
+        for name in names:
+            if (name not in REGISTER_FIELDS) and (name not in INA_FIELDS):
+                raise KeyError("Unknown UPS status field: %s" % name)
+
+        self.registerFields = tuple(field for field in REGISTER_MAP if field.name in names)
+        self.inaFields = tuple(field for field in INA_MAP if field.name in names)
+        self.names = tuple(field.name for field in self.inaFields + self.registerFields)
+        self.staticNames = frozenset(field.name for field in self.registerFields if field.static)
+
+        # (field, index) pairs precomputed to keep validation a tight loop
+        self._checks = tuple((field, field.index) for field in self.registerFields if field.count == 1 and (field.rawMin is not None or field.invalid is not None))
+        self._multiChecks = tuple((field, field.index, field.index + field.count) for field in self.registerFields if field.count > 1 and field.invalid is not None)
+
+    def windows(self, includeStatic=True):
+        """Return the smallest list of (register, length) windows covering the register fields.
+
+        Static fields are left out unless includeStatic is set. Windows separated by no more than WINDOW_MERGE_GAP
+        bytes are merged.
+        """
+        windows = []
+        for field in self.registerFields:
+            if field.static and not includeStatic:
+                continue
+            start = field.offset
+            end = field.offset + field.size
+            if windows and start - windows[-1][1] <= WINDOW_MERGE_GAP:
+                windows[-1][1] = max(windows[-1][1], end)
+            else:
+                windows.append([start, end])
+        return [ (start, end - start) for (start, end) in windows ]
+
+    def decode(self, buffer, ina=None, validate=True, count=True):
+        """Decode a register buffer indexed by register address into an UpsStatus.
+
+        ina is an optional tuple of INA219 readings in INA_MAP order. Raises DataOutOfRangeError if validate is set
+        and any register field of the set is out of its valid range. Out of range values are counted in UpsPlusStats
+        if count is set, i.e. when the buffer was just read from the bus, so each bad read is counted once.
+        """
+        raw = REGISTER_STRUCT.unpack_from(buffer)
+        if validate:
+            for field, index in self._checks:
+                value = raw[index]
+                if (value == field.invalid) or (field.rawMin is not None and (value < field.rawMin or value > field.rawMax)):
+                    if count:
+                        UpsPlusStats.counter('outOfRange.' + field.name).inc()
+                    field.check(value)
+            for field, start, end in self._multiChecks:
+                if raw[start : end] == field.invalid:
+                    if count:
+                        UpsPlusStats.counter('outOfRange.' + field.name).inc()
+                    field.check(raw[start : end])
+        return UpsStatus(raw, ina, self.names)
+
+ALL_FIELDS = FieldSet()
+ALL_REGISTER_FIELDS = FieldSet([ field.name for field in REGISTER_MAP ])
+
+
+def decode(buffer, ina=None, validate=True):
+    """Decode all fields of a register buffer indexed by register address, see FieldSet.decode()."""
+    return (ALL_FIELDS if ina is not None else ALL_REGISTER_FIELDS).decode(buffer, ina, validate)
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+
+import time
+import random
+import logging
+import UpsPlusStats
+
+log = logging.getLogger('UPS')
+
+class RetryPolicy:
+    """Retry an operation with exponential backoff and jitter, bounded by both an attempt count and a time budget.
+
+    The time budget covers the whole operation including all attempts and delays, so a flaky bus never blocks the
+    caller much longer than budget seconds. Apply the policy at one layer only: retries must not nest.
+    """
+
+    def __init__(self, maxAttempts=4, initialDelay=0.1, maxDelay=1.0, multiplier=2.0, jitter=0.5, budget=3.0):
+        self.maxAttempts = maxAttempts
+        self.initialDelay = initialDelay
+        self.maxDelay = maxDelay
+        self.multiplier = multiplier
+        # Fraction of each delay randomized, so concurrent callers don't retry in lock step
+        self.jitter = jitter
+        self.budget = budget
+
+    def delay(self, retryCount):
+        """Return the delay before the given retry (1 for the first retry)."""
+        delay = min(self.initialDelay * (self.multiplier ** (retryCount - 1)), self.maxDelay)
+        return delay * (1 - self.jitter * random.random())
+
+    def call(self, func, desc, budget=None, name=None):
+        """Invoke func until it returns, retrying on exception. Re-raise the last exception when giving up.
+
+        With name set, retries & failures are counted in the "retry.<name>" & "failure.<name>" counters.
+        """
+        deadline = time.monotonic() + (self.budget if budget is None else budget)
+        retryCount = 0
+        while True:
+            try:
+                return func()
+            except Exception as e:
+                retryCount += 1
+                if retryCount >= self.maxAttempts:
+                    self.__count('failure.', name)
+                    log.exception("Error %s, abort after %d attempts", desc, retryCount)
+                    raise e
+                delay = self.delay(retryCount)
+                if time.monotonic() + delay >= deadline:
+                    self.__count('failure.', name)
+                    log.exception("Error %s, abort after %d attempts on retry budget exhausted", desc, retryCount)
+                    raise e
+                self.__count('retry.', name)
+                log.warning("Error %s: %s, retry for %d time in %.2f seconds...", desc, e, retryCount, delay)
+                time.sleep(delay)
+
+    def __count(self, family, name):
+        if name is not None:
+            UpsPlusStats.counter(family + name).inc()
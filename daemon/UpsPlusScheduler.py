@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+import heapq
+import asyncio
+import logging
+
+log = logging.getLogger('UPS')
+
+# Cap the poll interval to this fraction of the estimated time for the battery voltage to reach shutdownVoltage
+TIME_TO_SHUTDOWN_FRACTION = 10
+
+class DeadlineScheduler:
+    """Run jobs at their deadlines, kept in a heap so a single timer sleeps until the earliest one.
+
+    A job is a callback run on the asyncio loop, typically setting the event a task waits on. Each job has at most
+    one pending deadline: scheduling a job again replaces it, and the replaced heap entry is skipped when popped.
+    """
+
+    def __init__(self):
+        # [(deadline, name)], may hold replaced entries
+        self.__heap = []
+        # Pending deadline by job name
+        self.__deadlines = {}
+        self.__callbacks = {}
+        self.__wake = asyncio.Event()
+        # Number of timer wake ups since start
+        self.wakeupCount = 0
+
+    def add(self, name, callback):
+        self.__callbacks[name] = callback
+
+    def schedule(self, name, delay, earlier=False):
+        """Run a job after delay seconds. With earlier set, a pending deadline coming first is kept."""
+        deadline = asyncio.get_running_loop().time() + delay
+        pending = self.__deadlines.get(name)
+        if earlier and (pending is not None) and (pending <= deadline):
+            return
+        self.__deadlines[name] = deadline
+        heapq.heappush(self.__heap, (deadline, name))
+        if self.__heap[0][0] == deadline:
+            # New earliest deadline, restart the timer
+            self.__wake.set()
+
+    def deadline(self, name):
+        """Return the pending deadline of a job in loop time, or None."""
+        return self.__deadlines.get(name)
+
+    def cancel(self, name):
+        self.__deadlines.pop(name, None)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        heap = self.__heap
+        deadlines = self.__deadlines
+        while True:
+            while heap and (deadlines.get(heap[0][1]) != heap[0][0]):
+                heapq.heappop(heap)
+            timeout = max(0, heap[0][0] - loop.time()) if heap else None
+            try:
+                await asyncio.wait_for(self.__wake.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+            self.__wake.clear()
+            self.wakeupCount += 1
+
+            now = loop.time()
+            while heap and (heap[0][0] <= now):
+                (deadline, name) = heapq.heappop(heap)
+                if deadlines.get(name) == deadline:
+                    del deadlines[name]
+                    self.__callbacks[name]()
+
+
+class AdaptiveInterval:
+    """Choose the UPS status poll interval from the power state and battery voltage trend.
+
+    - On battery, or with an unknown power state: minInterval.
+    - On power input with a full battery and a stable voltage: maxInterval.
+    - Otherwise, e.g. while charging: normalInterval.
+    A dropping battery voltage, on battery or not, also caps the interval to a fraction of the estimated time to
+    reach shutdownVoltage. The voltage is stable or dropping when it changed by less or more than stableVoltage over
+    trendWindow seconds.
+    """
+
+    def __init__(self, minInterval, normalInterval, maxInterval, fullRemaining=95, stableVoltage=0.02, trendWindow=300):
+        self.minInterval = minInterval
+        self.maxInterval = max(minInterval, maxInterval)
+        self.normalInterval = min(max(normalInterval, self.minInterval), self.maxInterval)
+        self.fullRemaining = fullRemaining
+        self.stableVoltage = stableVoltage
+        self.trendWindow = trendWindow
+
+    def interval(self, onBattery, status, voltageSlope, shutdownVoltage):
+        """Return (interval, reason). voltageSlope is the battery voltage trend in volt per second, or None if unknown."""
+        if (status is None) or (onBattery is None):
+            return (self.minInterval, 'power state unknown')
+
+        change = None if voltageSlope is None else voltageSlope * self.trendWindow
+        if (change is not None) and (change < -self.stableVoltage):
+            margin = status['batteryVoltage'] - shutdownVoltage
+            interval = self.minInterval if onBattery else self.normalInterval
+            if margin > 0:
+                interval = min(interval, margin / -voltageSlope / TIME_TO_SHUTDOWN_FRACTION)
+            else:
+                interval = self.minInterval
+            return (max(self.minInterval, interval), 'battery voltage dropping')
+        if onBattery:
+            return (self.minInterval, 'on battery')
+        if (change is not None) and (abs(change) <= self.stableVoltage) and (status['batteryRemaining'] >= self.fullRemaining):
+            return (self.maxInterval, 'battery full')
+        return (self.normalInterval, 'charging')
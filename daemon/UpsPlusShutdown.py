@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import json
+import time
+import signal
+import asyncio
+import logging
+from collections import namedtuple
+import UpsPlusState
+
+log = logging.getLogger('UPS')
+
+# Suffixes of systemd unit names, a hook named like this stops the unit
+UNIT_SUFFIXES = ('.service', '.socket', '.target', '.mount', '.scope', '.slice')
+
+HOOK_PATTERN = re.compile(r'^(?:(\d+(?:\.\d*)?)\s*:\s*)?(.+)$')
+
+# A pre-shutdown hook, with its own timeout in seconds or None for the default timeout
+Hook = namedtuple('Hook', ('target', 'timeout'))
+
+def parseHooks(value):
+    """Parse hooks, one per line: a systemd unit to stop or a shell command, optionally prefixed by "<timeout>:"."""
+    hooks = []
+    for line in value.splitlines():
+        line = line.strip()
+        if not line:
+            continue
+        match = HOOK_PATTERN.match(line)
+        timeout = float(match.group(1)) if match.group(1) else None
+        if timeout is not None and timeout <= 0:
+            raise ValueError("hook timeout must be positive: %s" % line)
+        hooks.append(Hook(match.group(2).strip(), timeout))
+    return tuple(hooks)
+
+def isUnit(hook):
+    return (' ' not in hook.target) and hook.target.endswith(UNIT_SUFFIXES)
+
+def hookBudget(shutdownCountdown, reserveTime, runtime=None):
+    """Return the seconds hooks may run before the OS shutdown must start: the UPS countdown or the estimated
+    battery runtime, whichever ends first, less the time reserved for the OS shutdown itself."""
+    available = shutdownCountdown if runtime is None else min(shutdownCountdown, runtime)
+    return max(0.0, available - reserveTime)
+
+async def runHook(hook, timeout):
+    """Run a hook, killing it on timeout. Return its timing record."""
+    startTime = time.monotonic()
+    record = { 'hook': hook.target, 'timeout': round(timeout, 3) }
+    try:
+        if isUnit(hook):
+            proc = await asyncio.create_subprocess_exec('systemctl', 'stop', hook.target, stdin=asyncio.subprocess.DEVNULL)
+        else:
+            # In its own process group, so a timeout kills the whole command and not only the shell
+            proc = await asyncio.create_subprocess_shell(hook.target, stdin=asyncio.subprocess.DEVNULL, start_new_session=True)
+    except Exception as e:
+        log.error("Error start shutdown hook [%s]: %s", hook.target, e)
+        record['result'] = 'error'
+        record['seconds'] = round(time.monotonic() - startTime, 3)
+        return record
+    try:
+        returnCode = await asyncio.wait_for(proc.wait(), timeout)
+        record['result'] = 'ok' if returnCode == 0 else 'exit %d' % returnCode
+    except asyncio.TimeoutError:
+        record['result'] = 'timeout'
+        try:
+            if isUnit(hook):
+                proc.kill()
+            else:
+                os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        await proc.wait()
+    record['seconds'] = round(time.monotonic() - startTime, 3)
+    logFunc = log.warning if record['result'] == 'ok' else log.error
+    logFunc("Shutdown hook [%s] %s in %.3f seconds (timeout %.1f)", hook.target, record['result'], record['seconds'], timeout)
+    return record
+
+async def runHooks(hooks, budget, defaultTimeout, workers, syncFuncs=()):
+    """Run hooks concurrently, at most `workers` at a time, all within budget seconds. syncFuncs (e.g. os.sync) run
+    in threads alongside the hooks. Return the shutdown report."""
+    loop = asyncio.get_running_loop()
+    startTime = time.monotonic()
+    deadline = startTime + budget
+    semaphore = asyncio.Semaphore(workers)
+
+    async def runLimited(hook):
+        async with semaphore:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                log.error("Shutdown hook [%s] skipped, out of budget", hook.target)
+                return { 'hook': hook.target, 'timeout': 0, 'result': 'skipped', 'seconds': 0.0 }
+            timeout = min(defaultTimeout if hook.timeout is None else hook.timeout, remaining)
+            return await runHook(hook, timeout)
+
+    async def runSync(func):
+        syncStartTime = time.monotonic()
+        try:
+            await loop.run_in_executor(None, func)
+        except Exception:
+            log.exception("Error sync before shutdown")
+        return time.monotonic() - syncStartTime
+
+    syncTasks = [ asyncio.ensure_future(runSync(func)) for func in syncFuncs ]
+    records = await asyncio.gather(*(runLimited(hook) for hook in hooks))
+    syncSeconds = await asyncio.gather(*syncTasks)
+    return {
+        'time': time.time(),
+        'budget': round(budget, 3),
+        'hooksSeconds': round(max((record['seconds'] for record in records), default=0.0), 3),
+        'syncSeconds': round(max(syncSeconds, default=0.0), 3),
+        'totalSeconds': round(time.monotonic() - startTime, 3),
+        'hooks': records,
+    }
+
+def saveReport(path, report):
+    try:
+        UpsPlusState.saveAtomic(path, json.dumps(report, indent=2).encode('utf-8'))
+    except Exception:
+        log.exception("Error save shutdown report: %s", path)
+
+def loadLastReport(path):
+    """Load and log the timings of the last shutdown, to size shutdownCountdown against. Return the report or None."""
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            report = json.load(f)
+        log.info("Last shutdown hooks took %.3f of %.3f seconds budget, sync %.3f seconds: %s", report['hooksSeconds'], report['budget'],
+                 report['syncSeconds'], ', '.join('%s %s %.3f' % (record['hook'], record['result'], record['seconds']) for record in report['hooks']))
+        return report
+    except Exception:
+        log.exception("Error read shutdown report: %s", path)
+        return None
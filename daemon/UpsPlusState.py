@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+
+import os
+import json
+import logging
+
+log = logging.getLogger('UPS')
+
+BOOT_ID_PATH = '/proc/sys/kernel/random/boot_id'
+
+# Shutdown stages
+STAGE_NONE = ''
+STAGE_SHUTDOWN = 'shutdown'
+
+class OutageState:
+    """Power failure state persisted across daemon restarts.
+
+    The state is saved atomically to path, and only when it changes, i.e. on power failure, power restore and
+    shutdown. A state saved during a previous boot is discarded on load: the outage it recorded is over.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # Time the UPS is running on battery since, None when on power input
+        self.onBatterySince = None
+        # Battery voltage when the state last changed
+        self.lastBatteryVoltage = None
+        self.shutdownStage = STAGE_NONE
+
+    def load(self):
+        """Load the state saved during the current boot. Return whether a state was loaded."""
+        if not os.path.exists(self.path):
+            return False
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+        except Exception:
+            log.exception("Error read UPS state: %s", self.path)
+            return False
+        if state.get('bootId') != bootId():
+            log.info("Discard UPS state saved before last boot: %s", self.path)
+            return False
+        self.onBatterySince = state.get('onBatterySince')
+        self.lastBatteryVoltage = state.get('lastBatteryVoltage')
+        self.shutdownStage = state.get('shutdownStage', STAGE_NONE)
+        return True
+
+    def update(self, onBatterySince, batteryVoltage, shutdownStage=None):
+        """Update the state, and save it if the outage state changed."""
+        if shutdownStage is None:
+            shutdownStage = self.shutdownStage if onBatterySince is not None else STAGE_NONE
+        if (onBatterySince == self.onBatterySince) and (shutdownStage == self.shutdownStage):
+            return
+        self.onBatterySince = onBatterySince
+        self.lastBatteryVoltage = batteryVoltage
+        self.shutdownStage = shutdownStage
+        self.save()
+
+    def save(self):
+        state = {
+            'bootId': bootId(),
+            'onBatterySince': self.onBatterySince,
+            'lastBatteryVoltage': self.lastBatteryVoltage,
+            'shutdownStage': self.shutdownStage,
+        }
+        try:
+            saveAtomic(self.path, json.dumps(state).encode('utf-8'))
+        except Exception:
+            log.exception("Error save UPS state: %s", self.path)
+
+
+def saveAtomic(path, data):
+    """Replace the file at path with data, so a crash leaves either the old or the new file but never a partial one."""
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    tmpPath = path + '.tmp'
+    with open(tmpPath, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmpPath, path)
+    # Persist the rename itself
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def bootId():
+    try:
+        with open(BOOT_ID_PATH, 'r') as f:
+            return f.read().strip()
+    except OSError:
+        return None
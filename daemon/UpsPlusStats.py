@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+import time
+import bisect
+import logging
+import threading
+from array import array
+
+log = logging.getLogger('UPS')
+
+# Upper bounds in seconds of the latency histogram buckets, the last bucket counts everything above
+LATENCY_BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0, 2.0, 5.0)
+
+class Counter:
+
+    __slots__ = ('name', 'value')
+
+    def __init__(self, name):
+        self.name = name
+        self.value = 0
+
+    def inc(self, count=1):
+        self.value += count
+
+
+class Histogram:
+    """Count observed values into fixed buckets, with their count & sum. Observing never allocates a bucket."""
+
+    __slots__ = ('name', 'bounds', 'counts', 'count', 'sum')
+
+    def __init__(self, name, bounds=LATENCY_BUCKETS):
+        self.name = name
+        self.bounds = tuple(bounds)
+        # Count of values <= each bound, and of values above the last bound
+        self.counts = array('Q', bytes(8 * (len(self.bounds) + 1)))
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Registry:
+    """Named counters & histograms of the hot paths.
+
+    Instruments are created once, usually at import, and updated without locking: bus operations are already
+    serialized by the device lock, so concurrent updates of an instrument are rare and at worst lose a count.
+    Names are "<family>.<label>", e.g. "retry.status" or "outOfRange.batteryVoltage".
+    """
+
+    def __init__(self):
+        self.startTime = time.monotonic()
+        self.counters = {}
+        self.histograms = {}
+        self.__lock = threading.Lock()
+
+    def counter(self, name):
+        """Return the counter of name, created on first use."""
+        counter = self.counters.get(name)
+        if counter is None:
+            with self.__lock:
+                counter = self.counters.setdefault(name, Counter(name))
+        return counter
+
+    def histogram(self, name, bounds=LATENCY_BUCKETS):
+        """Return the histogram of name, created on first use."""
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            with self.__lock:
+                histogram = self.histograms.setdefault(name, Histogram(name, bounds))
+        return histogram
+
+    def snapshot(self):
+        """Return a copy of all values: {'uptime', 'counters': {name: value}, 'histograms': {name: {'bounds', 'counts',
+        'count', 'sum'}}}, with non-cumulative bucket counts."""
+        with self.__lock:
+            counters = list(self.counters.values())
+            histograms = list(self.histograms.values())
+        return {
+            'uptime': time.monotonic() - self.startTime,
+            'counters': { counter.name: counter.value for counter in counters },
+            'histograms': { histogram.name: {
+                'bounds': histogram.bounds,
+                'counts': histogram.counts.tolist(),
+                'count': histogram.count,
+                'sum': histogram.sum,
+            } for histogram in histograms },
+        }
+
+
+def quantile(histogram, fraction):
+    """Estimate a quantile of a histogram snapshot as the upper bound of the bucket holding it.
+
+    Return None for an empty histogram, and infinity when in the bucket above the last bound.
+    """
+    if histogram['count'] <= 0:
+        return None
+    rank = fraction * histogram['count']
+    total = 0
+    for (bound, count) in zip(histogram['bounds'] + (float('inf'),), histogram['counts']):
+        total += count
+        if total >= rank:
+            return bound
+    return float('inf')
+
+def delta(snapshot, previous):
+    """Return the change from the previous snapshot to snapshot, in the snapshot format."""
+    if previous is None:
+        return snapshot
+    histograms = {}
+    for (name, histogram) in snapshot['histograms'].items():
+        prev = previous['histograms'].get(name)
+        if prev is None:
+            histograms[name] = histogram
+        else:
+            histograms[name] = {
+                'bounds': histogram['bounds'],
+                'counts': [ a - b for (a, b) in zip(histogram['counts'], prev['counts']) ],
+                'count': histogram['count'] - prev['count'],
+                'sum': histogram['sum'] - prev['sum'],
+            }
+    return {
+        'uptime': snapshot['uptime'] - previous['uptime'],
+        'counters': { name: value - previous['counters'].get(name, 0) for (name, value) in snapshot['counters'].items() },
+        'histograms': histograms,
+    }
+
+def summary(stats):
+    """Return the fields of a one line summary of a snapshot or delta: "<count>/<p50>/<p99>ms" of each histogram with
+    values, and each non-zero counter."""
+    fields = {}
+    for (name, histogram) in sorted(stats['histograms'].items()):
+        if histogram['count'] > 0:
+            fields[name] = '%d/%s/%sms' % (histogram['count'], _formatMs(quantile(histogram, 0.5)), _formatMs(quantile(histogram, 0.99)))
+    for (name, value) in sorted(stats['counters'].items()):
+        if value:
+            fields[name] = value
+    return fields
+
+def _formatMs(seconds):
+    return 'inf' if seconds == float('inf') else '%g' % (seconds * 1000)
+
+
+# Registry of the process, updated by all modules
+registry = Registry()
+
+def counter(name):
+    return registry.counter(name)
+
+def histogram(name, bounds=LATENCY_BUCKETS):
+    return registry.histogram(name, bounds)
+
+def snapshot():
+    return registry.snapshot()
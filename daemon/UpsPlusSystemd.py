@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+
+import os
+import socket
+import logging
+
+log = logging.getLogger('UPS')
+
+class Notifier:
+    """Send service state notifications to systemd (sd_notify protocol), without the systemd library.
+
+    Notifications are datagrams sent to the unix socket in $NOTIFY_SOCKET. Outside systemd, or with a unit not of
+    Type=notify, the variable is not set and every notification is a no-op.
+    """
+
+    def __init__(self, environ=os.environ):
+        self.address = environ.get('NOTIFY_SOCKET')
+        if self.address and self.address.startswith('@'):
+            # Abstract namespace socket
+            self.address = '\0' + self.address[1:]
+        # Interval in seconds to send watchdog pings, None when the watchdog is not enabled
+        self.watchdogInterval = None
+        watchdogUsec = environ.get('WATCHDOG_USEC')
+        watchdogPid = environ.get('WATCHDOG_PID')
+        if watchdogUsec and ((not watchdogPid) or (int(watchdogPid) == os.getpid())):
+            # Ping twice per watchdog timeout, as recommended by sd_watchdog_enabled(3)
+            self.watchdogInterval = int(watchdogUsec) / 1000000 / 2
+        self.socket = None
+
+    @property
+    def enabled(self):
+        return bool(self.address)
+
+    def notify(self, state):
+        """Send a notification, e.g. 'READY=1'. Return whether it was sent."""
+        if not self.address:
+            return False
+        try:
+            if self.socket is None:
+                self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM | socket.SOCK_CLOEXEC)
+            self.socket.sendto(state.encode('utf-8'), self.address)
+            return True
+        except OSError as e:
+            log.warning("Error send systemd notification[%s]: %s", state, e)
+            return False
+
+    def ready(self, status=None):
+        return self.notify('READY=1' if status is None else 'READY=1\nSTATUS=%s' % status)
+
+    def status(self, status):
+        return self.notify('STATUS=%s' % status)
+
+    def watchdog(self):
+        return self.notify('WATCHDOG=1')
+
+    def stopping(self):
+        return self.notify('STOPPING=1')
+
+    def close(self):
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
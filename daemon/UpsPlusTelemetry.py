@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+import math
+from array import array
+
+# UPS status fields kept in telemetry history
+TELEMETRY_FIELDS = (
+    'inaOutputVoltage', 'inaOutputCurrent', 'inaOutputPower',
+    'inaBatteryVoltage', 'inaBatteryCurrent', 'inaBatteryPower',
+    'batteryVoltage', 'batteryTemperature', 'batteryRemaining',
+    'typecVoltage', 'microUsbVoltage',
+)
+
+# Rollup levels: (name, bucket seconds, capacity in buckets). Defaults keep 15 minutes of 1 second, 1 day of 1 minute
+# and 30 days of 1 hour rollups.
+ROLLUP_LEVELS = (
+    ('1s', 1, 900),
+    ('1m', 60, 1440),
+    ('1h', 3600, 720),
+)
+
+class RingBuffer:
+    """Fixed capacity ring buffer of samples stored column-wise in preallocated arrays.
+
+    Column 'time' holds the sample time and must be appended in non-decreasing order. All other columns hold
+    single precision floats. Append is O(1) and never allocates; time range lookups are O(log n).
+    """
+
+    def __init__(self, columns, capacity):
+        self.columns = tuple(columns)
+        self.capacity = capacity
+        self.time = array('d', bytes(8 * capacity))
+        self.data = { column: array('f', bytes(4 * capacity)) for column in self.columns }
+        # Arrays in column order, to append without a dict lookup per column
+        self.__arrays = tuple(self.data[column] for column in self.columns)
+        # Physical index of the oldest sample, and number of samples
+        self.start = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def memoryUsage(self):
+        return sum(a.itemsize * len(a) for a in self.__arrays) + self.time.itemsize * len(self.time)
+
+    def append(self, time, values):
+        """Append a sample, values in column order. The oldest sample is overwritten when the buffer is full."""
+        if self.count < self.capacity:
+            index = (self.start + self.count) % self.capacity
+            self.count += 1
+        else:
+            index = self.start
+            self.start = (self.start + 1) % self.capacity
+        self.time[index] = time
+        for column, value in zip(self.__arrays, values):
+            column[index] = value
+
+    def index(self, i):
+        """Physical index of the i-th oldest sample."""
+        return (self.start + i) % self.capacity
+
+    def lastTime(self):
+        return self.time[self.index(self.count - 1)] if self.count else None
+
+    def bisect(self, time):
+        """Return the logical index of the first sample at or after time."""
+        lo = 0
+        hi = self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.time[self.index(mid)] < time:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def values(self, column, since=None, until=None):
+        """Return [(time, value)] of a column with since <= time < until."""
+        data = self.data[column]
+        begin = 0 if since is None else self.bisect(since)
+        end = self.count if until is None else self.bisect(until)
+        return [ (self.time[self.index(i)], data[self.index(i)]) for i in range(begin, end) ]
+
+
+class _Rollup:
+    """Accumulate samples into fixed time buckets, flushing min/max/mean of each bucket into a RingBuffer."""
+
+    def __init__(self, name, seconds, capacity, fields):
+        self.name = name
+        self.seconds = seconds
+        columns = []
+        for field in fields:
+            columns.extend((field + 'Min', field + 'Max', field + 'Mean'))
+        self.ring = RingBuffer(columns, capacity)
+
+        size = len(fields)
+        self.bucket = None
+        self.bucketCount = 0
+        self.sum = array('d', bytes(8 * size))
+        self.min = array('d', bytes(8 * size))
+        self.max = array('d', bytes(8 * size))
+        # Row to flush, reused for every bucket
+        self.row = array('d', bytes(8 * size * 3))
+
+    def add(self, time, values):
+        bucket = int(time // self.seconds)
+        if bucket != self.bucket:
+            self.flush()
+            self.bucket = bucket
+        count = self.bucketCount
+        for i, value in enumerate(values):
+            if count == 0:
+                self.sum[i] = value
+                self.min[i] = value
+                self.max[i] = value
+            else:
+                self.sum[i] += value
+                if value < self.min[i]:
+                    self.min[i] = value
+                if value > self.max[i]:
+                    self.max[i] = value
+        self.bucketCount = count + 1
+
+    def flush(self):
+        if not self.bucketCount:
+            return
+        row = self.row
+        for i in range(len(self.sum)):
+            row[i * 3] = self.min[i]
+            row[i * 3 + 1] = self.max[i]
+            row[i * 3 + 2] = self.sum[i] / self.bucketCount
+        self.ring.append(self.bucket * self.seconds, row)
+        self.bucketCount = 0
+
+
+class Telemetry:
+    """In-memory UPS telemetry history with bounded memory.
+
+    Raw samples are kept in a ring buffer of `capacity` samples, and rolled up automatically into min/max/mean
+    buckets of each of the `levels` (see ROLLUP_LEVELS).
+    """
+
+    def __init__(self, capacity=720, fields=TELEMETRY_FIELDS, levels=ROLLUP_LEVELS):
+        self.fields = tuple(fields)
+        self.samples = RingBuffer(self.fields, capacity)
+        self.rollups = tuple(_Rollup(name, seconds, bucketCapacity, self.fields) for (name, seconds, bucketCapacity) in levels)
+        # Sample values reused for every append
+        self.__values = array('d', bytes(8 * len(self.fields)))
+
+    def memoryUsage(self):
+        """Return the memory used by sample & rollup arrays in bytes."""
+        return self.samples.memoryUsage() + sum(rollup.ring.memoryUsage() for rollup in self.rollups)
+
+    def append(self, time, status):
+        """Append a sample of an UPS status (any mapping with TELEMETRY_FIELDS). Missing values are stored as NaN."""
+        values = self.__values
+        for i, field in enumerate(self.fields):
+            value = status.get(field)
+            values[i] = math.nan if value is None else value
+        self.samples.append(time, values)
+        for rollup in self.rollups:
+            rollup.add(time, values)
+
+    def values(self, field, seconds, now):
+        """Return raw [(time, value)] samples of a field in the last `seconds` before now."""
+        return self.samples.values(field, now - seconds)
+
+    def stats(self, field, seconds, now):
+        """Return (min, max, mean, count) of a field over the last `seconds` before now, or None without data.
+
+        Uses raw samples while they cover the window, otherwise the finest rollup level that does.
+        """
+        since = now - seconds
+        samples = self.samples
+        if samples.count and (samples.time[samples.index(0)] <= since or all(not rollup.ring.count for rollup in self.rollups)):
+            return _stats([ value for (_, value) in samples.values(field, since) ])
+
+        for rollup in self.rollups:
+            ring = rollup.ring
+            if ring.count and ((ring.time[ring.index(0)] <= since) or (rollup is self.rollups[-1])):
+                rows = ring.values(field + 'Mean', since)
+                if not rows:
+                    continue
+                minimums = [ value for (_, value) in ring.values(field + 'Min', since) ]
+                maximums = [ value for (_, value) in ring.values(field + 'Max', since) ]
+                means = [ value for (_, value) in rows if not math.isnan(value) ]
+                if not means:
+                    return None
+                return (min(minimums), max(maximums), sum(means) / len(means), len(means))
+        return _stats([ value for (_, value) in samples.values(field, since) ])
+
+    def slope(self, field, seconds, now):
+        """Return the least squares slope of a field in unit per second over the last `seconds` of raw samples, or
+        None with less than 2 samples."""
+        return _slope(self.samples.values(field, now - seconds))
+
+def _stats(values):
+    values = [ value for value in values if not math.isnan(value) ]
+    if not values:
+        return None
+    return (min(values), max(values), sum(values) / len(values), len(values))
+
+def _slope(samples):
+    samples = [ (time, value) for (time, value) in samples if not math.isnan(value) ]
+    if len(samples) < 2:
+        return None
+    meanTime = sum(time for (time, _) in samples) / len(samples)
+    meanValue = sum(value for (_, value) in samples) / len(samples)
+    variance = sum((time - meanTime) ** 2 for (time, _) in samples)
+    if variance == 0:
+        return None
+    return sum((time - meanTime) * (value - meanValue) for (time, value) in samples) / variance
@@ -91,7 +91,6 @@ pip_library_install() {
     fi
 }
 
-pip_library_check pi-ina219
 pip_library_check smbus2
 pip_library_install
 
@@ -100,6 +99,26 @@ echo
 # Copy script
 echo "Copy daemon scripts into $BIN_DIR directory..."
 sudo cp $SCRIPT_DIR/UpsPlusDevice.py $BIN_DIR
+sudo cp $SCRIPT_DIR/UpsPlusEmulator.py $BIN_DIR
+sudo cp $SCRIPT_DIR/UpsPlusBenchmark.py $BIN_DIR
+sudo cp $SCRIPT_DIR/UpsPlusConfig.py $BIN_DIR
+sudo cp $SCRIPT_DIR/UpsPlusRegisters.py $BIN_DIR
+sudo cp $SCRIPT_DIR/UpsPlusRetry.py $BIN_DIR
+sudo cp $SCRIPT_DIR/UpsPlusStats.py $BIN_DIR
+sudo cp $SCRIPT_DIR/UpsPlusExporter.py $BIN_DIR
+sudo cp $SCRIPT_DIR/UpsPlusControl.py $BIN_DIR
+sudo cp $SCRIPT_DIR/UpsPlusIna219.py $BIN_DIR
+sudo cp $SCRIPT_DIR/UpsPlusDetector.py $BIN_DIR
+sudo cp $SCRIPT_DIR/UpsPlusEstimator.py $BIN_DIR
+sudo cp $SCRIPT_DIR/UpsPlusCoulomb.py $BIN_DIR
+sudo cp $SCRIPT_DIR/UpsPlusTelemetry.py $BIN_DIR
+sudo cp $SCRIPT_DIR/UpsPlusJournal.py $BIN_DIR
+sudo cp $SCRIPT_DIR/UpsPlusLogging.py $BIN_DIR
+sudo cp $SCRIPT_DIR/UpsPlusReconciler.py $BIN_DIR
+sudo cp $SCRIPT_DIR/UpsPlusState.py $BIN_DIR
+sudo cp $SCRIPT_DIR/UpsPlusSystemd.py $BIN_DIR
+sudo cp $SCRIPT_DIR/UpsPlusScheduler.py $BIN_DIR
+sudo cp $SCRIPT_DIR/UpsPlusShutdown.py $BIN_DIR
 sudo cp $SCRIPT_DIR/UpsPlusDaemon.py $BIN_DIR
 sudo chmod +x $BIN_DIR/*.py
 
@@ -6,6 +6,7 @@ SCRIPT_DIR=$(cd $(dirname "${BASH_SOURCE[0]}") && pwd)
 BIN_DIR="/usr/local/lib/upsplus"
 SRV_DIR="/etc/systemd/system/"
 CONF_DIR="/etc"
+STATE_DIR="/var/lib/upsplus"
 
 echo "Uninstall daemon for Geeek Pi UPS Plus start..."
 
@@ -17,6 +18,21 @@ sudo systemctl stop upsplus
 echo "Remove $BIN_DIR directory..."
 sudo rm -rf $BIN_DIR
 
+# Remove state files, at the paths set in the conf file if moved out of the state directory. Only the files the
+# daemon creates are removed: state files with their .tmp siblings, and journal segments (the journal directory
+# itself only if left empty).
+echo "Remove state directory $STATE_DIR and state files ..."
+sed -n -E 's/^[[:space:]]*(statePath|batteryStatePath|shutdownReportPath|journalPath)[[:space:]]*=[[:space:]]*(.*[^[:space:]])[[:space:]]*$/\1=\2/p' $CONF_DIR/upsplus.conf 2>/dev/null |
+while IFS='=' read -r STATE_KEY STATE_PATH; do
+    if [ "$STATE_KEY" = "journalPath" ]; then
+        sudo find "$STATE_PATH" -maxdepth 1 -type f -name 'upsplus-*.journal' -delete 2>/dev/null
+        sudo rmdir "$STATE_PATH" 2>/dev/null
+    else
+        sudo rm -f "$STATE_PATH" "$STATE_PATH.tmp"
+    fi
+done
+sudo rm -rf $STATE_DIR
+
 # Remove conf file
 echo "Remove conf file $CONF_DIR/upsplus.conf ..."
 sudo rm $CONF_DIR/upsplus.conf
@@ -2,11 +2,17 @@
 
 # '''Enable Auto-Shutdown Protection Function '''
 import os
+import sys
 import time
 import smbus2
 import logging
 from ina219 import INA219,DeviceRangeError
 
+# Share the register map decoder & control socket client with the daemon
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'daemon'))
+import UpsPlusRegisters
+import UpsPlusControl
+
 
 # Define I2C bus
 DEVICE_BUS = 1
@@ -20,12 +26,28 @@ PROTECT_VOLT = 3500
 # Set the sample period, Unit: min default: 2 min.
 SAMPLE_TIME = 2
 
+# Use the status sampled by the UPS daemon when it runs, rather than reading the bus alongside it.
+client = UpsPlusControl.connect()
+if client:
+    try:
+        (status, _) = client.getStatus()
+    except (UpsPlusControl.ControlError, OSError) as e:
+        # No status sampled yet, or the daemon doesn't answer: read the bus instead
+        print("UPS daemon status unavailable, read the UPS directly: %s" % e)
+        client.close()
+        client = None
+
 # Instance INA219 and getting information from it.
-ina_supply = INA219(0.00725, busnum=DEVICE_BUS, address=0x40)
-ina_supply.configure()
-supply_voltage = ina_supply.voltage()
-supply_current = ina_supply.current()
-supply_power = ina_supply.power()
+if client:
+    supply_voltage = status.inaOutputVoltage
+    supply_current = status.inaOutputCurrent * 1000
+    supply_power = status.inaOutputPower * 1000
+else:
+    ina_supply = INA219(0.00725, busnum=DEVICE_BUS, address=0x40)
+    ina_supply.configure()
+    supply_voltage = ina_supply.voltage()
+    supply_current = ina_supply.current()
+    supply_power = ina_supply.power()
 print("-"*60)
 print("------Current information of the detected Raspberry Pi------")
 print("-"*60)
@@ -35,11 +57,16 @@ print("Raspberry Pi Current Power Consumption: %.3f mW" % supply_power)
 print("-"*60)
 
 # Batteries information
-ina_batt = INA219(0.005, busnum=DEVICE_BUS, address=0x45)
-ina_batt.configure()
-batt_voltage = ina_batt.voltage()
-batt_current = ina_batt.current()
-batt_power = ina_batt.power()
+if client:
+    batt_voltage = status.inaBatteryVoltage
+    batt_current = status.inaBatteryCurrent * 1000
+    batt_power = status.inaBatteryPower * 1000
+else:
+    ina_batt = INA219(0.005, busnum=DEVICE_BUS, address=0x45)
+    ina_batt.configure()
+    batt_voltage = ina_batt.voltage()
+    batt_current = ina_batt.current()
+    batt_power = ina_batt.power()
 print("-------------------Batteries information-------------------")
 print("-"*60)
 print("Voltage of Batteries: %.3f V" % batt_voltage)
@@ -56,35 +83,48 @@ except DeviceRangeError:
      print('Battery power is too high.')
 
 # Raspberry Pi Communicates with MCU via i2c protocol.
-bus = smbus2.SMBus(DEVICE_BUS)
+if not client:
+    bus = smbus2.SMBus(DEVICE_BUS)
 
-aReceiveBuf = []
-aReceiveBuf.append(0x00)
+    aReceiveBuf = []
+    aReceiveBuf.append(0x00)
 
-# Read register and add the data to the list: aReceiveBuf
-for i in range(1, 255):
-    aReceiveBuf.append(bus.read_byte_data(DEVICE_ADDR, i))
+    # Read register and add the data to the list: aReceiveBuf
+    for i in range(1, 255):
+        aReceiveBuf.append(bus.read_byte_data(DEVICE_ADDR, i))
+    status = UpsPlusRegisters.decode(bytearray(aReceiveBuf), validate=False)
 
 # Enable Back-to-AC fucntion.
 # Enable: write 1 to register 0x19 == 25
 # Disable: write 0 to register 0x19 == 25
-
-bus.write_byte_data(DEVICE_ADDR, 25, 1)
+# With the UPS daemon running, settings are kept by the daemon until its config is reloaded, not written to
+# /etc/upsplus.conf: set them there to keep them.
+if client:
+    try:
+        print(client.set('autoPowerOn', 1)['message'])
+    except (UpsPlusControl.ControlError, OSError) as e:
+        print("UPS daemon refused to enable auto power on: %s" % e)
+else:
+    bus.write_byte_data(DEVICE_ADDR, 25, 1)
 
 # Reset Protect voltage
-bus.write_byte_data(DEVICE_ADDR, 17, PROTECT_VOLT & 0xFF)
-bus.write_byte_data(DEVICE_ADDR, 18, (PROTECT_VOLT >> 8)& 0xFF)
-print("Successfully set the protection voltage to: %d mV" % PROTECT_VOLT)
+if client:
+    try:
+        print(client.set('batteryProtectionVoltage', PROTECT_VOLT / 1000)['message'])
+        print("Successfully set the protection voltage to: %d mV" % PROTECT_VOLT)
+    except (UpsPlusControl.ControlError, OSError) as e:
+        print("UPS daemon refused to set the protection voltage: %s" % e)
+else:
+    bus.write_byte_data(DEVICE_ADDR, 17, PROTECT_VOLT & 0xFF)
+    bus.write_byte_data(DEVICE_ADDR, 18, (PROTECT_VOLT >> 8)& 0xFF)
+    print("Successfully set the protection voltage to: %d mV" % PROTECT_VOLT)
 
-UID0 = "%08X" % (aReceiveBuf[243] << 24 | aReceiveBuf[242] << 16 | aReceiveBuf[241] << 8 | aReceiveBuf[240])
-UID1 = "%08X" % (aReceiveBuf[247] << 24 | aReceiveBuf[246] << 16 | aReceiveBuf[245] << 8 | aReceiveBuf[244])
-UID2 = "%08X" % (aReceiveBuf[251] << 24 | aReceiveBuf[250] << 16 | aReceiveBuf[249] << 8 | aReceiveBuf[248])
-print('UID:' + UID0 + '/' + UID1 + '/' + UID2)
+print('UID:' + status.serialNumber.replace('-', '/'))
 
-if (aReceiveBuf[8] << 8 | aReceiveBuf[7]) > 4000:
+if status.raw('typecVoltage') > 4000:
     print('-'*60)
     print('Currently charging via Type C Port.')
-elif (aReceiveBuf[10] << 8 | aReceiveBuf[9])> 4000:
+elif status.raw('microUsbVoltage') > 4000:
     print('-'*60)
     print('Currently charging via Micro USB Port.')
 else:
@@ -98,7 +138,13 @@ else:
             print('-'*60)
             print('The battery is going to dead! Ready to shut down!')
 # It will cut off power when initialized shutdown sequence.
-            bus.write_byte_data(DEVICE_ADDR, 24,240)
+            if client:
+                try:
+                    client.countdown('shutdownCountdown', 240)
+                except (UpsPlusControl.ControlError, OSError) as e:
+                    print("UPS daemon refused the shutdown countdown: %s" % e)
+            else:
+                bus.write_byte_data(DEVICE_ADDR, 24,240)
             os.system("sudo sync && sudo halt")
             while True:
                 time.sleep(10)